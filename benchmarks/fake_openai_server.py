@@ -0,0 +1,238 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI chat completions endpoint. It answers the
+# pipeline's classification and extraction prompts from the page text, so the
+# whole pipeline can be run without API keys or costs. Latency, server errors
+# and rate limiting (429 with Retry-After) are configurable.
+
+CATEGORY_KEYWORDS = [
+    ("BILL AUDIT FORM", "Bill Audit Form"),
+    ("TAX INVOICE", "Invoice"),
+    ("LETTER OF GUARANTEE", "Letter of Guarantee"),
+    ("MEDICAL REPORT", "Medical Report"),
+]
+PAGE_PATTERN = re.compile(r'<page number="\d+">\n(.*?)\n</page>', re.DOTALL)
+LINE_ITEM_PATTERN = re.compile(
+    r"^(?P<drug>.+?)\s+(?P<quantity>\d+)\s+(?P<date>\d{2}\.\d{2}\.\d{4})$"
+)
+DIAGNOSIS_PATTERN = re.compile(r"^Diagnosis:\s*(?P<diagnosis>.+)$")
+
+
+def classify_text(text):
+    upper = text.upper()
+    for keyword, category in CATEGORY_KEYWORDS:
+        if keyword in upper:
+            return category
+    return "Medical Report"
+
+
+def document_text(prompt):
+    # The document text sits between "Here is the text" and the closing
+    # instruction of the extraction prompts
+    text = prompt.split("Here is the text", 1)[-1]
+    return text.split("Return only", 1)[0]
+
+
+def line_items(text):
+    items = []
+    for line in text.splitlines():
+        match = LINE_ITEM_PATTERN.match(line.strip())
+        if match:
+            items.append(
+                {
+                    "transaction_id": "NA",
+                    "drug_services": match["drug"].strip(),
+                    "quantity": float(match["quantity"]),
+                    "date": match["date"],
+                }
+            )
+    return items
+
+
+def diagnoses(text):
+    found = []
+    for line in text.splitlines():
+        match = DIAGNOSIS_PATTERN.match(line.strip())
+        if match:
+            found.append(
+                {"diagnosis": match["diagnosis"].strip(), "diagnosis_type": "NA"}
+            )
+    return found
+
+
+def csv_field(value):
+    value = str(value)
+    return f'"{value}"' if "," in value else value
+
+
+def answer(body):
+    prompt = body["messages"][-1]["content"]
+    response_format = body.get("response_format") or {}
+
+    if response_format.get("type") == "json_schema":
+        name = response_format["json_schema"]["name"]
+        text = document_text(prompt)
+        if "invoice" in name:
+            return json.dumps({"line_items": line_items(text)})
+        return json.dumps({"diagnoses": diagnoses(text)})
+    if response_format.get("type") == "json_object":
+        pages = PAGE_PATTERN.findall(prompt)
+        return json.dumps({"labels": [classify_text(page) for page in pages]})
+    if "Transaction_ID" in prompt:
+        rows = ["Transaction_ID,Drug/Services,Quantity,Date"]
+        for item in line_items(document_text(prompt)):
+            rows.append(
+                f"{item['transaction_id']},{csv_field(item['drug_services'])},"
+                f"{int(item['quantity'])},{item['date']}"
+            )
+        return "\n".join(rows)
+    if "Diagnosis Type" in prompt:
+        rows = ["Diagnosis,Diagnosis Type"]
+        for item in diagnoses(document_text(prompt)):
+            rows.append(f"{csv_field(item['diagnosis'])},{item['diagnosis_type']}")
+        return "\n".join(rows)
+    if "Text: " in prompt:
+        page_text = prompt.split("Text: ", 1)[1].rsplit("Provide only", 1)[0]
+        return classify_text(page_text)
+    return "Medical Report"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API, so connection pooling is exercised
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # Request counters, handy for checking cache hit rates
+        self._send_json(200, self.server.stats())
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        settings = self.server.settings
+        self.server.count("requests")
+
+        delay = settings["latency"] + random.uniform(0, settings["jitter"])
+        time.sleep(delay)
+
+        roll = random.random()
+        if roll < settings["rate_limit_rate"]:
+            self.server.count("rate_limited")
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                {"retry-after": str(settings["retry_after"])},
+            )
+            return
+        if roll < settings["rate_limit_rate"] + settings["error_rate"]:
+            self.server.count("errors")
+            self._send_json(
+                500, {"error": {"message": "Internal error", "type": "server_error"}}
+            )
+            return
+
+        content = answer(body)
+        prompt = body["messages"][-1]["content"]
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "fake"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": len(prompt) // 4,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": (len(prompt) + len(content)) // 4,
+                },
+            },
+        )
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, FakeOpenAIHandler)
+        self.settings = settings
+        self._counts = {"requests": 0, "rate_limited": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a fake OpenAI-compatible chat completions server."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port.")
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="Seconds added to every request."
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.1, help="Random extra latency, 0 to this."
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Share of requests failing with 500.",
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="Share of requests rejected with 429.",
+    )
+    parser.add_argument(
+        "--retry-after", type=float, default=1.0, help="Retry-After sent with 429s."
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    server = FakeOpenAIServer(
+        (args.host, args.port),
+        {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "rate_limit_rate": args.rate_limit_rate,
+            "retry_after": args.retry_after,
+        },
+    )
+    # The benchmark runner reads the base URL from the first line
+    print(f"http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    server.serve_forever()
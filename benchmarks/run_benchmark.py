@@ -0,0 +1,406 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs the pipeline stages on synthetic claim PDFs against the fake OpenAI
+# server and reports pages/sec, documents/sec and peak RSS per stage. Every
+# stage runs in its own subprocess, so its peak RSS is its own and not the
+# high-water mark of the stages before it. Only documents a stage finished
+# count towards its throughput; the benchmark fails if any document failed.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+RESULT_MARKER = "BENCHMARK_RESULT "
+STAGES = {
+    "barrier": ("ocr", "classify", "extract", "combine"),
+    "streaming": ("pipeline", "combine"),
+}
+
+
+def pdf_page_count(folder, include=None):
+    # Documents and pages in folder, only of the files include() accepts
+    import fitz
+
+    pages = 0
+    documents = 0
+    for filename in os.listdir(folder):
+        if filename.endswith(".pdf") and (include is None or include(filename)):
+            with fitz.open(os.path.join(folder, filename)) as pdf_document:
+                pages += pdf_document.page_count
+            documents += 1
+    return documents, pages
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; children covers ocrmypdf and the OCR
+    # worker processes
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / 1024
+
+
+def work_paths(work_dir):
+    return {
+        "input": os.path.join(work_dir, "input"),
+        "ocr": os.path.join(work_dir, "ocr_files"),
+        "split": os.path.join(work_dir, "split_pdfs"),
+        "csv": os.path.join(work_dir, "extracted_csv"),
+    }
+
+
+def patients_with_output(csv_dir):
+    from combine_extracted_csv import is_combined_output
+    from document_translator import patient_id_from_filename
+
+    return {
+        patient_id_from_filename(name)
+        for name in os.listdir(csv_dir)
+        if name.endswith(".csv") and not is_combined_output(name)
+    }
+
+
+def copy_unconverted_files(input_dir, ocr_dir):
+    # Without ocrmypdf, files with image-only pages fail OCR; copy them as they
+    # are so the later stages still see every document (those pages come out
+    # empty)
+    from ocr import ocr_output_filename
+
+    for filename in os.listdir(input_dir):
+        output_path = os.path.join(ocr_dir, ocr_output_filename(filename))
+        if filename.endswith(".pdf") and not os.path.exists(output_path):
+            shutil.copyfile(os.path.join(input_dir, filename), output_path)
+
+
+def run_stage(stage, args):
+    # Runs in the stage subprocess; returns the measurements for one stage
+    from combine_extracted_csv import combine_csv_files
+    from document_translator import patient_id_from_filename, process_and_combine
+    from llm_cache import configure_cache
+    from llm_client import configure_client
+    from metrics import get_metrics
+    from ocr import generate_ocr_files, ocr_output_filename
+    from pdf_splitting import process_all_pdfs_in_folder, split_source_filename
+    from pipeline import StreamingPipeline, run_streaming_pipeline
+
+    paths = work_paths(args.work_dir)
+    configure_client(base_url=args.base_url, api_key="benchmark")
+    if args.cache:
+        configure_cache(os.path.join(args.work_dir, "llm_cache.sqlite"))
+
+    classify_options = {
+        "max_workers": args.classify_workers,
+        "local_threshold": args.local_threshold,
+        "batch_size": args.classify_batch_size,
+        "normalize_text": not args.no_normalize_text,
+    }
+    extractor_options = {
+        "structured": args.structured_extraction,
+        "normalize_text": not args.no_normalize_text,
+    }
+    ocr_available = shutil.which("ocrmypdf") is not None
+    if stage in ("ocr", "pipeline") and not ocr_available:
+        print("ocrmypdf not found; image-only pages will not be OCR'd")
+
+    if stage == "ocr":
+        submitted, _ = pdf_page_count(paths["input"])
+        start = time.perf_counter()
+        generate_ocr_files(paths["input"], paths["ocr"], ocr_workers=args.ocr_workers)
+        elapsed = time.perf_counter() - start
+        if not ocr_available:
+            copy_unconverted_files(paths["input"], paths["ocr"])
+        documents, pages = pdf_page_count(
+            paths["input"],
+            lambda name: os.path.exists(
+                os.path.join(paths["ocr"], ocr_output_filename(name))
+            ),
+        )
+    elif stage == "classify":
+        submitted, _ = pdf_page_count(paths["ocr"])
+        start = time.perf_counter()
+        process_all_pdfs_in_folder(paths["ocr"], paths["split"], **classify_options)
+        elapsed = time.perf_counter() - start
+        split = {split_source_filename(name) for name in os.listdir(paths["split"])}
+        documents, pages = pdf_page_count(paths["ocr"], lambda name: name in split)
+    elif stage == "extract":
+        submitted, _ = pdf_page_count(paths["split"])
+        start = time.perf_counter()
+        process_and_combine(
+            paths["split"], paths["csv"], extractor_options=extractor_options
+        )
+        elapsed = time.perf_counter() - start
+        patients = patients_with_output(paths["csv"])
+        documents, pages = pdf_page_count(
+            paths["split"], lambda name: patient_id_from_filename(name) in patients
+        )
+    elif stage == "pipeline":
+        submitted, _ = pdf_page_count(paths["input"])
+
+        class BenchmarkPipeline(StreamingPipeline):
+            def _run_ocr(self, document):
+                # Same fallback as copy_unconverted_files in barrier mode, so
+                # both modes do the same work
+                try:
+                    super()._run_ocr(document)
+                except RuntimeError:
+                    if ocr_available:
+                        raise
+                    shutil.copyfile(document["input"], document["ocr_path"])
+
+        pipeline = BenchmarkPipeline(
+            paths["ocr"],
+            paths["split"],
+            paths["csv"],
+            ocr_workers=args.ocr_workers,
+            classify_workers=args.stream_classify_workers,
+            extract_workers=args.extract_workers,
+            classify_options=classify_options,
+            extractor_options=extractor_options,
+        )
+        start = time.perf_counter()
+        results = run_streaming_pipeline(paths["input"], pipeline)
+        elapsed = time.perf_counter() - start
+        finished = {
+            result["filename"]
+            for result in results
+            if result["status"] == "ok" and result.get("csv_path")
+        }
+        documents, pages = pdf_page_count(paths["input"], lambda name: name in finished)
+    elif stage == "combine":
+        submitted = documents = len(
+            [name for name in os.listdir(paths["csv"]) if name.endswith(".csv")]
+        )
+        pages = None
+        start = time.perf_counter()
+        combine_csv_files(paths["csv"], paths["csv"])
+        elapsed = time.perf_counter() - start
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+
+    api = get_metrics().report()["api"]
+    return {
+        "stage": stage,
+        "elapsed_seconds": elapsed,
+        "documents": documents,
+        "failed_documents": submitted - documents,
+        "pages": pages,
+        "documents_per_second": documents / elapsed if elapsed else None,
+        "pages_per_second": pages / elapsed if pages and elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "api_calls": sum(entry["calls"] for entry in api),
+        "api_cache_hits": sum(entry["cache_hits"] for entry in api),
+        "api_retries": sum(entry["retries"] for entry in api),
+        "api_failures": sum(entry["failures"] for entry in api),
+    }
+
+
+@contextlib.contextmanager
+def fake_server(args):
+    command = [
+        sys.executable,
+        os.path.join(BENCHMARK_DIR, "fake_openai_server.py"),
+        "--latency",
+        str(args.latency),
+        "--jitter",
+        str(args.jitter),
+        "--error-rate",
+        str(args.error_rate),
+        "--rate-limit-rate",
+        str(args.rate_limit_rate),
+        "--retry-after",
+        str(args.retry_after),
+        "--seed",
+        str(args.seed),
+    ]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        yield server.stdout.readline().strip()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_stage_subprocess(stage, base_url, work_dir):
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    command += ["--run-stage", stage, "--base-url", base_url, "--work-dir", work_dir]
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=REPO_DIR)
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER) :])
+    print(completed.stdout[-2000:])
+    print(completed.stderr[-2000:])
+    raise RuntimeError(f"Benchmark stage {stage} failed")
+
+
+def format_rate(value):
+    return f"{value:9.2f}" if value is not None else f"{'-':>9}"
+
+
+def print_results(results):
+    print(
+        f"{'stage':<10}{'seconds':>9}{'docs':>7}{'failed':>7}{'pages':>7}"
+        f"{'docs/s':>9}{'pages/s':>9}{'RSS MB':>9}{'calls':>7}{'hits':>7}{'retries':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['stage']:<10}{result['elapsed_seconds']:9.2f}"
+            f"{result['documents']:7d}{result['failed_documents']:7d}"
+            f"{result['pages'] or 0:7d}"
+            f"{format_rate(result['documents_per_second'])}"
+            f"{format_rate(result['pages_per_second'])}"
+            f"{result['peak_rss_mb']:9.1f}{result['api_calls']:7d}"
+            f"{result['api_cache_hits']:7d}{result['api_retries']:9d}"
+        )
+
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    # Returns the stages whose throughput dropped by more than max_regression
+    with open(baseline_path) as f:
+        baseline = {result["stage"]: result for result in json.load(f)["stages"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["stage"])
+        if previous is None:
+            continue
+        for metric in ("pages_per_second", "documents_per_second"):
+            if previous.get(metric) and result.get(metric) is not None:
+                change = result[metric] / previous[metric] - 1
+                if change < -max_regression:
+                    regressions.append(
+                        f"{result['stage']} {metric}: {previous[metric]:.2f} -> "
+                        f"{result[metric]:.2f} ({change:.0%})"
+                    )
+    return regressions
+
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    paths = work_paths(work_dir)
+    if not args.keep_outputs:
+        for key in ("ocr", "split", "csv"):
+            shutil.rmtree(paths[key], ignore_errors=True)
+
+    if not os.path.isdir(paths["input"]):
+        from synthetic_pdfs import generate_documents
+
+        _, total_pages = generate_documents(
+            paths["input"],
+            documents=args.documents,
+            invoice_pages=args.invoice_pages,
+            report_pages=args.report_pages,
+            image_page_share=args.image_page_share,
+            seed=args.seed,
+        )
+        print(f"Generated {args.documents} documents ({total_pages} pages)")
+
+    results = []
+    with fake_server(args) as base_url:
+        print(f"Fake OpenAI server at {base_url}")
+        for stage in STAGES[args.mode]:
+            print(f"Running {stage}...")
+            results.append(run_stage_subprocess(stage, base_url, work_dir))
+
+    print_results(results)
+    report = {
+        "settings": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("run_stage", "base_url")
+        },
+        "stages": results,
+    }
+    output_path = args.output or os.path.join(work_dir, "benchmark_results.json")
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output_path}")
+
+    failed = False
+    for result in results:
+        if result["failed_documents"]:
+            print(
+                f"{result['stage']}: {result['failed_documents']} documents failed; "
+                f"the throughput only counts the finished ones"
+            )
+            failed = True
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic PDFs with a fake OpenAI server."
+    )
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        help="Where inputs and outputs go (default: a new temporary directory). "
+        "Existing synthetic inputs there are reused.",
+    )
+    parser.add_argument("--mode", choices=sorted(STAGES), default="barrier")
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--invoice-pages", type=int, default=3)
+    parser.add_argument("--report-pages", type=int, default=2)
+    parser.add_argument("--image-page-share", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--ocr-workers", type=int, default=2)
+    parser.add_argument("--classify-workers", type=int, default=4)
+    parser.add_argument("--classify-batch-size", type=int, default=1)
+    parser.add_argument("--local-threshold", type=float, default=None)
+    parser.add_argument("--stream-classify-workers", type=int, default=2)
+    parser.add_argument("--extract-workers", type=int, default=4)
+    parser.add_argument("--structured-extraction", action="store_true")
+    parser.add_argument("--no-normalize-text", action="store_true")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Use the LLM cache in the work directory; rerun with the same "
+        "--work-dir and --keep-outputs to measure a warm cache.",
+    )
+    parser.add_argument(
+        "--keep-outputs",
+        action="store_true",
+        help="Do not clear the stage outputs of a previous run in --work-dir.",
+    )
+    parser.add_argument("--output", default=None, help="Path of the JSON results.")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Earlier results JSON; exit with status 1 if throughput regressed.",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="Allowed throughput drop against --baseline, as a share.",
+    )
+    # Used internally to run one stage in a subprocess
+    parser.add_argument("--run-stage", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        result = run_stage(args.run_stage, args)
+        print(RESULT_MARKER + json.dumps(result), flush=True)
+    else:
+        main(args)
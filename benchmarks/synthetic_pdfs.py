@@ -0,0 +1,195 @@
+import argparse
+import os
+import random
+
+import fitz  # PyMuPDF
+
+# Synthetic claim documents shaped like the real ones: one PDF per patient with
+# a letter of guarantee, invoice pages, medical report pages and a bill audit
+# form, every page carrying the hospital letterhead and a "Page x of y" footer.
+# Some pages are rendered to images so they have no text layer and need OCR.
+
+HOSPITALS = [
+    "City General Hospital Sdn Bhd",
+    "Riverside Specialist Centre",
+    "Northern Medical Centre",
+]
+DRUGS = [
+    "Paracetamol 500mg tablet",
+    "Amoxicillin 250mg capsule",
+    "Augmentin 625mg tablet",
+    "Omeprazole 20mg capsule",
+    "Metformin 500mg tablet",
+    "Ceftriaxone 1g injection",
+    "Normal Saline 0.9% 500ml",
+    "Salbutamol inhaler 100mcg",
+    "Ibuprofen 400mg tablet",
+    "Losartan 50mg tablet",
+]
+DIAGNOSES = [
+    "Community acquired pneumonia",
+    "Acute gastroenteritis",
+    "Dengue fever without warning signs",
+    "Type 2 diabetes mellitus with hyperglycaemia",
+    "Acute exacerbation of asthma",
+    "Urinary tract infection",
+]
+
+LINE_HEIGHT = 14
+PAGE_MARGIN = 56
+
+
+def letter_of_guarantee_lines(patient_id, rng):
+    return [
+        "LETTER OF GUARANTEE",
+        f"Guarantee reference: LOG-{rng.randint(10000, 99999)}",
+        f"Patient: {patient_id}",
+        "We hereby guarantee payment of the hospital charges for the above",
+        "patient, subject to the coverage conditions of the policy.",
+        f"Coverage limit: RM {rng.randint(5, 50) * 1000}.00",
+        "Exclusions: non-medical items, personal convenience items.",
+        "Authorised signatory, Claims Department",
+    ]
+
+
+def invoice_lines(patient_id, rng, items):
+    lines = [
+        "TAX INVOICE",
+        f"Invoice number: INV-{rng.randint(100000, 999999)}",
+        f"Bill to patient: {patient_id}",
+        "Description  Quantity  Date",
+    ]
+    for _ in range(items):
+        lines.append(
+            f"{rng.choice(DRUGS)}  {rng.randint(1, 30)}  "
+            f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2024"
+        )
+    lines.append(f"Total amount due: RM {rng.randint(200, 9000)}.00")
+    return lines
+
+
+def medical_report_lines(patient_id, rng):
+    diagnosis = rng.choice(DIAGNOSES)
+    return [
+        "MEDICAL REPORT",
+        f"Patient: {patient_id}",
+        "History of presenting illness: fever and cough for three days.",
+        f"Diagnosis: {diagnosis}",
+        "Clinical findings: patient presents with mild dehydration.",
+        "Treatment plan: intravenous fluids and oral medication.",
+        "Attending physician, Department of Internal Medicine",
+    ]
+
+
+def bill_audit_form_lines(patient_id, rng):
+    return [
+        "BILL AUDIT FORM",
+        f"Patient: {patient_id}",
+        f"Audit number: AUD-{rng.randint(1000, 9999)}",
+        "Itemized charges reviewed against the policy schedule.",
+        "Audit notes: charges within the guarantee letter limit.",
+        "Auditor signature and date",
+    ]
+
+
+def document_pages(patient_id, rng, invoice_pages, report_pages, items_per_page):
+    pages = [letter_of_guarantee_lines(patient_id, rng)]
+    pages += [
+        invoice_lines(patient_id, rng, items_per_page) for _ in range(invoice_pages)
+    ]
+    pages += [medical_report_lines(patient_id, rng) for _ in range(report_pages)]
+    pages.append(bill_audit_form_lines(patient_id, rng))
+    return pages
+
+
+def write_text_page(pdf_document, lines, header, footer):
+    page = pdf_document.new_page()
+    y = PAGE_MARGIN
+    for line in [header, ""] + lines:
+        page.insert_text((PAGE_MARGIN, y), line, fontsize=10)
+        y += LINE_HEIGHT
+    page.insert_text((PAGE_MARGIN, page.rect.height - PAGE_MARGIN), footer, fontsize=9)
+    return page
+
+
+def write_image_page(pdf_document, lines, header, footer):
+    # Render the page in a scratch document and insert it as an image, so the
+    # page looks the same but has no text layer
+    scratch = fitz.open()
+    write_text_page(scratch, lines, header, footer)
+    pixmap = scratch[0].get_pixmap(dpi=150)
+    page = pdf_document.new_page(
+        width=scratch[0].rect.width, height=scratch[0].rect.height
+    )
+    page.insert_image(page.rect, pixmap=pixmap)
+    scratch.close()
+    return page
+
+
+def generate_documents(
+    output_dir,
+    documents=10,
+    invoice_pages=3,
+    report_pages=2,
+    items_per_page=12,
+    image_page_share=0.1,
+    seed=0,
+):
+    # Returns the paths of the generated PDFs and their total page count
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    total_pages = 0
+    for index in range(documents):
+        patient_id = f"B{index + 1:04d}"
+        header = rng.choice(HOSPITALS)
+        pages = document_pages(
+            patient_id, rng, invoice_pages, report_pages, items_per_page
+        )
+
+        pdf_document = fitz.open()
+        for page_number, lines in enumerate(pages, start=1):
+            footer = f"Page {page_number} of {len(pages)}"
+            if rng.random() < image_page_share:
+                write_image_page(pdf_document, lines, header, footer)
+            else:
+                write_text_page(pdf_document, lines, header, footer)
+
+        path = os.path.join(output_dir, f"{patient_id}.pdf")
+        pdf_document.save(path)
+        pdf_document.close()
+        paths.append(path)
+        total_pages += len(pages)
+    return paths, total_pages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic multi-section claim PDFs."
+    )
+    parser.add_argument("output_dir")
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--invoice-pages", type=int, default=3)
+    parser.add_argument("--report-pages", type=int, default=2)
+    parser.add_argument("--items-per-page", type=int, default=12)
+    parser.add_argument(
+        "--image-page-share",
+        type=float,
+        default=0.1,
+        help="Share of pages written as images without a text layer.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths, total_pages = generate_documents(
+        args.output_dir,
+        documents=args.documents,
+        invoice_pages=args.invoice_pages,
+        report_pages=args.report_pages,
+        items_per_page=args.items_per_page,
+        image_page_share=args.image_page_share,
+        seed=args.seed,
+    )
+    print(
+        f"Generated {len(paths)} documents with {total_pages} pages in {args.output_dir}"
+    )
@@ -0,0 +1,503 @@
+import argparse
+import json
+import os
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+
+import fitz  # PyMuPDF
+
+# Known bill formats are recognised from the page layout and parsed from the
+# word coordinates, without an API call. Each format is a JSON template in the
+# bill format directory:
+#
+# {
+#   "name": "city_general",
+#   "fingerprint": {"width": 595, "height": 842, "header_tokens": [...]},
+#   "columns": {"Drug/Services": "Description", "Quantity": "Qty", "Date": "Date"},
+#   "ignore_labels": ["Unit Price Amount"],
+#   "column_ranges": {"Quantity": [310, 350]},
+#   "date_format": "%d/%m/%Y",
+#   "end_pattern": "^(sub)?total",
+#   "skip_pattern": "ward|room charge"
+# }
+#
+# "columns" maps output columns to the header label printed above them on the
+# bill. "ignore_labels" are the labels of columns that are not extracted; each
+# column ends where the next label, mapped or ignored, starts, and words under
+# an ignored label are dropped. "column_ranges" optionally pins a column to an
+# x-range in points, for bills whose values do not line up with their labels.
+# Rows matching NON_DRUG_PATTERN are always skipped, like the rows the
+# extraction prompt excludes; "skip_pattern" adds format-specific ones.
+# Templates are created with `python bill_format.py learn`.
+
+# Top share of the page whose words make up the header fingerprint
+HEADER_SHARE = 0.2
+# Bottom share of the page holding the footer, never part of the table
+FOOTER_SHARE = 0.08
+# Header token overlap (Jaccard) needed to call a page a known format
+MATCH_THRESHOLD = 0.6
+# Page sizes within this share of each other count as the same geometry
+SIZE_TOLERANCE = 0.02
+# Words whose vertical centres are this close (in points) are on one row
+ROW_TOLERANCE = 3.0
+# Words may start this far left of their column's header label
+COLUMN_MARGIN = 4.0
+OUTPUT_DATE_FORMAT = "%d.%m.%Y"
+INVOICE_COLUMNS = ["Transaction_ID", "Drug/Services", "Quantity", "Date"]
+
+DIGITS = re.compile(r"\d+")
+# Totals, warding, services and generic invoice lines, which are not drugs
+NON_DRUG_PATTERN = (
+    r"\b(sub\s*total|total|balance|amount due|ward(ing)?|room|bed charges?"
+    r"|consultation|procedures?|scans?|x-?rays?|dressings?|services? charges?"
+    r"|pharmacy invoice|inpatient invoice)\b"
+)
+NON_DRUG_ROWS = re.compile(NON_DRUG_PATTERN, re.IGNORECASE)
+
+# Template matches and fallbacks for the whole run
+bill_format_stats = Counter()
+_bill_format_stats_lock = threading.Lock()
+
+
+def record_bill_format_stat(name, count=1):
+    with _bill_format_stats_lock:
+        bill_format_stats[name] += count
+
+
+def print_bill_format_stats():
+    if not bill_format_stats:
+        return
+    formats = ", ".join(
+        f"{name.split(':', 1)[1]}: {count}"
+        for name, count in sorted(bill_format_stats.items())
+        if name.startswith("format:")
+    )
+    print(
+        f"Bill formats: {bill_format_stats['template_documents']} invoices parsed "
+        f"from templates ({formats or 'none'}), "
+        f"{bill_format_stats['unknown_documents']} unknown and "
+        f"{bill_format_stats['template_failures']} unparseable sent to ChatGPT"
+    )
+
+
+def page_words(page):
+    # (x0, y0, x1, y1, text) for every word on the page
+    return [word[:5] for word in page.get_text("words")]
+
+
+def header_tokens(words, page_height):
+    # Words in the page header, with numbers masked so invoice numbers and
+    # dates do not change the fingerprint
+    tokens = set()
+    for x0, y0, x1, y1, text in words:
+        if y1 > page_height * HEADER_SHARE:
+            continue
+        token = DIGITS.sub("#", text.lower()).strip(".,:;()")
+        if len(token) > 1 and any(char.isalpha() for char in token):
+            tokens.add(token)
+    return tokens
+
+
+def page_fingerprint(page, words=None):
+    words = page_words(page) if words is None else words
+    return {
+        "width": round(page.rect.width),
+        "height": round(page.rect.height),
+        "header_tokens": sorted(header_tokens(words, page.rect.height)),
+    }
+
+
+def same_geometry(fingerprint, other):
+    return all(
+        abs(fingerprint[side] - other[side]) <= SIZE_TOLERANCE * other[side]
+        for side in ("width", "height")
+    )
+
+
+def fingerprint_similarity(fingerprint, other):
+    if not same_geometry(fingerprint, other):
+        return 0.0
+    tokens = set(fingerprint["header_tokens"])
+    other_tokens = set(other["header_tokens"])
+    if not tokens or not other_tokens:
+        return 0.0
+    return len(tokens & other_tokens) / len(tokens | other_tokens)
+
+
+def group_rows(words):
+    # Words sorted into rows by vertical centre, each row sorted left to right
+    rows = []
+    for word in sorted(words, key=lambda word: ((word[1] + word[3]) / 2, word[0])):
+        centre = (word[1] + word[3]) / 2
+        if rows and abs(centre - rows[-1]["centre"]) <= ROW_TOLERANCE:
+            rows[-1]["words"].append(word)
+        else:
+            rows.append({"centre": centre, "words": [word]})
+    return [sorted(row["words"], key=lambda word: word[0]) for row in rows]
+
+
+def label_index(row, label):
+    # Index of the first word of label in the row, or None
+    label_words = label.lower().split()
+    texts = [word[4].lower() for word in row]
+    for index in range(len(texts) - len(label_words) + 1):
+        if texts[index : index + len(label_words)] == label_words:
+            return index
+    return None
+
+
+def find_label(row, label):
+    # x0 of the first word of label in the row, or None
+    index = label_index(row, label)
+    return None if index is None else row[index][0]
+
+
+def find_table_header(rows, columns, ignore_labels=()):
+    # Index of the row holding every column label, with the (x0, column) of
+    # each label in it; ignored labels found in the row have column None
+    for index, row in enumerate(rows):
+        starts = {column: find_label(row, label) for column, label in columns.items()}
+        if all(start is not None for start in starts.values()):
+            boundaries = [(start, column) for column, start in starts.items()]
+            for label in ignore_labels:
+                start = find_label(row, label)
+                if start is not None:
+                    boundaries.append((start, None))
+            return index, boundaries
+    return None, None
+
+
+def unmapped_labels(row, labels):
+    # Runs of header words outside the given labels, e.g. "Unit Price Amount"
+    mapped = set()
+    for label in labels:
+        index = label_index(row, label)
+        if index is not None:
+            mapped.update(range(index, index + len(label.split())))
+    runs, run = [], []
+    for index, word in enumerate(row):
+        if index not in mapped:
+            run.append(word[4])
+        elif run:
+            runs.append(" ".join(run))
+            run = []
+    if run:
+        runs.append(" ".join(run))
+    return runs
+
+
+def split_row(row, boundaries, column_ranges=None):
+    # Text per column: a word belongs to the last label starting left of it,
+    # and is dropped if that label is ignored. A column with an x-range takes
+    # exactly the words centred in it instead.
+    ordered = sorted(boundaries, key=lambda boundary: boundary[0])
+    column_ranges = column_ranges or {}
+    cells = {column: [] for _, column in ordered if column is not None}
+    for word in row:
+        centre = (word[0] + word[2]) / 2
+        column = next(
+            (
+                candidate
+                for candidate, (left, right) in column_ranges.items()
+                if left <= centre < right
+            ),
+            None,
+        )
+        if column is None:
+            column = ordered[0][1]
+            for start, candidate in ordered:
+                if word[0] >= start - COLUMN_MARGIN:
+                    column = candidate
+            if column in column_ranges:
+                column = None
+        if column is not None:
+            cells.setdefault(column, []).append(word[4])
+    return {column: " ".join(texts) for column, texts in cells.items()}
+
+
+def table_rows(page, words):
+    # Rows of words above the footer
+    footer_top = page.rect.height * (1 - FOOTER_SHARE)
+    return group_rows([word for word in words if word[3] <= footer_top])
+
+
+def parse_quantity(text):
+    try:
+        return float(text.replace(",", ""))
+    except ValueError:
+        return None
+
+
+def parse_date(text, date_format):
+    try:
+        return datetime.strptime(text, date_format).strftime(OUTPUT_DATE_FORMAT)
+    except ValueError:
+        return None
+
+
+def parse_table_page(page, template, words=None):
+    # Line items of one invoice page as dicts with INVOICE_COLUMNS keys. Returns
+    # None when the page does not look like the template (no table header, or
+    # rows whose quantity or date cannot be read), so the caller can fall back
+    # to ChatGPT rather than return wrong data.
+    columns = template["columns"]
+    date_format = template.get("date_format", OUTPUT_DATE_FORMAT)
+    end_pattern = re.compile(template.get("end_pattern") or "$^", re.IGNORECASE)
+    skip_pattern = re.compile(template.get("skip_pattern") or "$^", re.IGNORECASE)
+
+    words = page_words(page) if words is None else words
+    rows = table_rows(page, words)
+    header_index, boundaries = find_table_header(
+        rows, columns, template.get("ignore_labels", ())
+    )
+    if header_index is None:
+        return None
+
+    items = []
+    for row in rows[header_index + 1 :]:
+        row_text = " ".join(word[4] for word in row)
+        if end_pattern.search(row_text):
+            break
+        # Checked before merging continuation rows, so a total printed under
+        # the description column is not appended to the last drug
+        if NON_DRUG_ROWS.search(row_text) or skip_pattern.search(row_text):
+            continue
+        cells = split_row(row, boundaries, template.get("column_ranges"))
+        description = cells.get("Drug/Services", "").strip()
+        quantity_text = cells.get("Quantity", "").strip()
+        date_text = cells.get("Date", "").strip()
+
+        # A row with only a description continues the one above it
+        if description and not quantity_text and not date_text:
+            if items:
+                items[-1]["Drug/Services"] += f" {description}"
+            continue
+
+        quantity = parse_quantity(quantity_text) if quantity_text else None
+        date = parse_date(date_text, date_format) if date_text else ""
+        if not description or (quantity_text and quantity is None) or date is None:
+            return None
+        items.append(
+            {
+                "Transaction_ID": cells.get("Transaction_ID", "").strip() or "NA",
+                "Drug/Services": description,
+                "Quantity": quantity,
+                "Date": date,
+            }
+        )
+    return items
+
+
+def load_templates(directory):
+    templates = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename)) as f:
+                templates.append(json.load(f))
+    return templates
+
+
+class BillFormatIndex:
+    # Known bill formats, looked up by the fingerprint of an invoice page
+    def __init__(self, templates, match_threshold=MATCH_THRESHOLD):
+        self.templates = templates
+        self.match_threshold = match_threshold
+
+    @classmethod
+    def from_directory(cls, directory, match_threshold=MATCH_THRESHOLD):
+        if not os.path.isdir(directory):
+            print(f"Bill format directory {directory} not found, no templates loaded")
+            return cls([], match_threshold)
+        return cls(load_templates(directory), match_threshold)
+
+    def identify(self, fingerprint):
+        # Best matching template, or None for an unknown format
+        best, best_score = None, self.match_threshold
+        for template in self.templates:
+            score = fingerprint_similarity(fingerprint, template["fingerprint"])
+            if score >= best_score:
+                best, best_score = template, score
+        return best
+
+    def parse_pages(self, pages):
+        # Line items of an invoice whose pages are all in one known format.
+        # Returns (template name, items), or (None, None) if the format is
+        # unknown or a page could not be parsed.
+        template = None
+        items = []
+        for page in pages:
+            words = page_words(page)
+            page_template = self.identify(page_fingerprint(page, words))
+            if page_template is None:
+                if template is None:
+                    record_bill_format_stat("unknown_documents")
+                    return None, None
+                # Continuation pages often have no letterhead; keep the format
+                # of the first page
+                page_template = template
+            elif template is not None and page_template["name"] != template["name"]:
+                record_bill_format_stat("unknown_documents")
+                return None, None
+            template = page_template
+            page_items = parse_table_page(page, template, words)
+            if page_items is None:
+                record_bill_format_stat("template_failures")
+                return None, None
+            items.extend(page_items)
+        if template is None:
+            return None, None
+        if not items:
+            record_bill_format_stat("template_failures")
+            return None, None
+        record_bill_format_stat("template_documents")
+        record_bill_format_stat(f"format:{template['name']}")
+        return template["name"], items
+
+    def settings(self):
+        return sorted(self.templates, key=lambda template: template["name"])
+
+
+# Module-level index, set up by main.py; None means every invoice goes to
+# ChatGPT
+_index = None
+
+
+def configure_bill_formats(directory, match_threshold=MATCH_THRESHOLD):
+    global _index
+    _index = BillFormatIndex.from_directory(directory, match_threshold)
+    print(f"Loaded {len(_index.templates)} bill formats from {directory}")
+    return _index
+
+
+def get_bill_format_index():
+    return _index
+
+
+# Settings that change template extraction, used to invalidate resumed runs
+def bill_format_settings():
+    if _index is None:
+        return None
+    return {
+        "match_threshold": _index.match_threshold,
+        "non_drug_pattern": NON_DRUG_PATTERN,
+        "templates": _index.settings(),
+    }
+
+
+def learn_template(pdf_path, name, columns, page_number=0, **options):
+    # Template for the bill format of one page of a sample invoice. Without
+    # ignore_labels, every header word outside the column labels is ignored.
+    with fitz.open(pdf_path) as pdf_document:
+        page = pdf_document.load_page(page_number)
+        if not options.get("ignore_labels"):
+            rows = table_rows(page, page_words(page))
+            header_index, _ = find_table_header(rows, columns)
+            if header_index is not None:
+                options["ignore_labels"] = unmapped_labels(
+                    rows[header_index], columns.values()
+                )
+        template = {
+            "name": name,
+            "fingerprint": page_fingerprint(page),
+            "columns": columns,
+            **{key: value for key, value in options.items() if value},
+        }
+        items = parse_table_page(page, template)
+    if items is None:
+        raise ValueError(
+            f"Could not parse page {page_number + 1} of {pdf_path} with columns "
+            f"{columns}; check the header labels and date format"
+        )
+    return template, items
+
+
+def parse_column_mapping(values):
+    columns = {}
+    for value in values:
+        column, _, label = value.partition("=")
+        if column not in INVOICE_COLUMNS or not label:
+            raise argparse.ArgumentTypeError(
+                f"Expected <column>=<header label> with column one of "
+                f"{INVOICE_COLUMNS}, got {value!r}"
+            )
+        columns[column] = label
+    return columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create and test bill format templates."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    learn_parser = subparsers.add_parser(
+        "learn", help="Create a template from a sample invoice."
+    )
+    learn_parser.add_argument("pdf_path")
+    learn_parser.add_argument("--name", required=True)
+    learn_parser.add_argument(
+        "--column",
+        action="append",
+        required=True,
+        help='Output column and its header label, e.g. "Drug/Services=Description".',
+    )
+    learn_parser.add_argument(
+        "--ignore-label",
+        action="append",
+        help=(
+            'Header label of a column that is not extracted, e.g. "Unit Price". '
+            "Defaults to every header word outside the --column labels."
+        ),
+    )
+    learn_parser.add_argument("--page", type=int, default=1)
+    learn_parser.add_argument("--date-format", default=OUTPUT_DATE_FORMAT)
+    learn_parser.add_argument(
+        "--end-pattern", help="Regex for the row that ends the table."
+    )
+    learn_parser.add_argument(
+        "--skip-pattern",
+        help=(
+            "Regex for further rows that are not drugs; totals, warding, "
+            "services and scans are always skipped."
+        ),
+    )
+    learn_parser.add_argument("--bill-formats", default="bill_formats")
+
+    identify_parser = subparsers.add_parser(
+        "identify", help="Identify and parse the bill format of an invoice PDF."
+    )
+    identify_parser.add_argument("pdf_path")
+    identify_parser.add_argument("--bill-formats", default="bill_formats")
+
+    args = parser.parse_args()
+
+    if args.command == "learn":
+        template, items = learn_template(
+            args.pdf_path,
+            args.name,
+            parse_column_mapping(args.column),
+            page_number=args.page - 1,
+            date_format=args.date_format,
+            end_pattern=args.end_pattern,
+            skip_pattern=args.skip_pattern,
+            ignore_labels=args.ignore_label,
+        )
+        os.makedirs(args.bill_formats, exist_ok=True)
+        template_path = os.path.join(args.bill_formats, f"{args.name}.json")
+        with open(template_path, "w") as f:
+            json.dump(template, f, indent=2)
+        print(f"Template saved to {template_path}; sample page has {len(items)} rows:")
+        for item in items:
+            print(item)
+    else:
+        index = BillFormatIndex.from_directory(args.bill_formats)
+        with fitz.open(args.pdf_path) as pdf_document:
+            name, items = index.parse_pages(list(pdf_document))
+        if name is None:
+            print("Unknown bill format")
+        else:
+            print(f"Bill format {name}, {len(items)} line items:")
+            for item in items:
+                print(item)
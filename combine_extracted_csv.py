@@ -1,24 +1,67 @@
 import os
-from datetime import datetime
+import shutil
+import sqlite3
+from datetime import date, datetime
 
 import pandas as pd
 
+from manifest import file_sha256
+from output_tables import TABLE_COLUMNS, TRANSFORMED_DATA, is_table_file
+from parquet_output import (
+    TABLE_SCHEMAS,
+    PartitionedParquetWriter,
+    writes_csv,
+    writes_parquet,
+)
 
-def combine_csv_files(input_folder, output_folder):
+DEFAULT_CHUNK_ROWS = 50000
+# Per-patient CSVs are read as text so IDs like "0012" and values like "NA"
+# survive; to_arrow_table types the columns for Parquet. Only empty cells are
+# missing.
+CSV_READ_OPTIONS = {"dtype": str, "keep_default_na": False, "na_values": [""]}
+
+
+def combined_name(table):
+    return f"combined_{table}"
+
+
+def is_combined_output(filename):
+    # Combined files are written next to the per-patient CSVs and must never be
+    # read back in as input
+    return filename.startswith("combined_")
+
+
+def is_input_file(filename, table):
+    return is_table_file(filename, table) and not is_combined_output(filename)
+
+
+def combine_csv_files(
+    input_folder, output_folder, output_format="csv", table=TRANSFORMED_DATA
+):
     # Ensure the output folder exists
     os.makedirs(output_folder, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    if writes_parquet(output_format):
+        combine_csv_files_to_parquet(
+            input_folder,
+            os.path.join(output_folder, f"{combined_name(table)}_{timestamp}"),
+            table=table,
+        )
+        if not writes_csv(output_format):
+            return None
 
     # List to hold DataFrames for each CSV file
     dataframes = []
 
-    # Loop through all CSV files in the specified folder
+    # Loop through the per-patient CSVs of this table in the specified folder
     for filename in os.listdir(input_folder):
-        if filename.endswith(".csv"):
+        if is_input_file(filename, table):
             file_path = os.path.join(input_folder, filename)
             print(f"Processing {file_path}...")
             try:
                 # Read each CSV file into a DataFrame and append it to the list
-                df = pd.read_csv(file_path)
+                df = pd.read_csv(file_path, **CSV_READ_OPTIONS)
                 dataframes.append(df)
             except Exception as e:
                 print(f"Error reading {file_path}: {e}")
@@ -27,9 +70,8 @@ def combine_csv_files(input_folder, output_folder):
     if dataframes:
         combined_df = pd.concat(dataframes, ignore_index=True)
 
-        # Get the current time and format it for the output filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"combined_transformed_data_{timestamp}.csv"
+        # Format the current time for the output filename
+        output_filename = f"{combined_name(table)}_{timestamp}.csv"
         output_path = os.path.join(output_folder, output_filename)
 
         # Save the combined DataFrame as a CSV
@@ -40,3 +82,227 @@ def combine_csv_files(input_folder, output_folder):
     else:
         print("No CSV files found in the specified folder.")
         return None
+
+
+def extraction_date(mtime):
+    # Per-patient CSVs are written right after extraction, so their
+    # modification date is the extraction date
+    return date.fromtimestamp(mtime).isoformat()
+
+
+def combine_csv_files_to_parquet(
+    input_folder, dataset_dir, chunk_rows=DEFAULT_CHUNK_ROWS, table=TRANSFORMED_DATA
+):
+    # Parquet counterpart of combine_csv_files: a dataset directory partitioned
+    # by extraction date, with explicit types and dictionary-encoded
+    # categorical columns. Files are streamed, not concatenated in memory.
+    writer = PartitionedParquetWriter(
+        dataset_dir, "part-0", chunk_rows, TABLE_SCHEMAS[table]
+    )
+    files = 0
+    try:
+        with os.scandir(input_folder) as entries:
+            for entry in entries:
+                if not is_input_file(entry.name, table):
+                    continue
+                print(f"Processing {entry.path}...")
+                try:
+                    df = pd.read_csv(entry.path, **CSV_READ_OPTIONS)
+                except Exception as e:
+                    print(f"Error reading {entry.path}: {e}")
+                    continue
+                writer.write(df, extraction_date(entry.stat().st_mtime))
+                files += 1
+    finally:
+        writer.close()
+
+    if not files:
+        print("No CSV files found in the specified folder.")
+        return None
+    print(f"Combined data saved to {dataset_dir} ({writer.rows} rows)")
+    return dataset_dir
+
+
+def open_consolidated_store(store_path):
+    directory = os.path.dirname(store_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(store_path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS source_files ("
+        "filename TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+        "sha256 TEXT NOT NULL, rows INTEGER NOT NULL, consolidated TEXT NOT NULL)"
+    )
+    # One SQLite table per output table, named after it
+    for table, table_columns in TABLE_COLUMNS.items():
+        columns = ", ".join(f'"{column}"' for column in table_columns)
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (source_file TEXT NOT NULL, {columns})"
+        )
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_source ON {table} (source_file)"
+        )
+    connection.commit()
+    return connection
+
+
+def consolidate_file(connection, file_path, filename, chunk_rows, table):
+    # Replace the rows of one patient file, reading it chunk by chunk so a large
+    # file never has to fit in memory. Nothing is committed here: the caller
+    # commits once the whole file is read, or rolls back, so a file that fails
+    # part way leaves its old rows in place.
+    rows = 0
+    table_columns = TABLE_COLUMNS[table]
+    columns = ", ".join(f'"{column}"' for column in ["source_file"] + table_columns)
+    placeholders = ", ".join("?" for _ in range(len(table_columns) + 1))
+    insert = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+    connection.execute(f"DELETE FROM {table} WHERE source_file = ?", (filename,))
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows, **CSV_READ_OPTIONS):
+        extra_columns = set(chunk.columns) - set(table_columns)
+        if extra_columns:
+            print(f"Ignoring unexpected columns in {filename}: {sorted(extra_columns)}")
+        chunk = chunk.reindex(columns=table_columns)
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        connection.executemany(
+            insert, ([filename, *values] for values in chunk.itertuples(index=False))
+        )
+        rows += len(chunk)
+    return rows
+
+
+def consolidate_csv_files(
+    input_folder, store_path, chunk_rows=DEFAULT_CHUNK_ROWS, table=TRANSFORMED_DATA
+):
+    # Incremental counterpart of combine_csv_files: only per-patient CSVs that
+    # are new or changed since the last run (by size and mtime, then content
+    # hash) are read, and their rows replace the earlier ones in a SQLite store.
+    # Memory use depends on chunk_rows, not on the number of patients.
+    connection = open_consolidated_store(store_path)
+    counts = {"added": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    try:
+        with os.scandir(input_folder) as entries:
+            for entry in entries:
+                filename = entry.name
+                if not is_input_file(filename, table):
+                    continue
+                stat = entry.stat()
+                stored = connection.execute(
+                    "SELECT size, mtime, sha256 FROM source_files WHERE filename = ?",
+                    (filename,),
+                ).fetchone()
+                if stored is not None and stored[:2] == (stat.st_size, stat.st_mtime):
+                    counts["unchanged"] += 1
+                    continue
+
+                sha256 = file_sha256(entry.path)
+                if stored is not None and stored[2] == sha256:
+                    # Touched but not changed
+                    connection.execute(
+                        "UPDATE source_files SET size = ?, mtime = ? WHERE filename = ?",
+                        (stat.st_size, stat.st_mtime, filename),
+                    )
+                    connection.commit()
+                    counts["unchanged"] += 1
+                    continue
+
+                try:
+                    rows = consolidate_file(
+                        connection, entry.path, filename, chunk_rows, table
+                    )
+                except Exception as e:
+                    connection.rollback()
+                    print(f"Error reading {entry.path}: {e}")
+                    counts["failed"] += 1
+                    continue
+                connection.execute(
+                    "INSERT OR REPLACE INTO source_files "
+                    "(filename, size, mtime, sha256, rows, consolidated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        filename,
+                        stat.st_size,
+                        stat.st_mtime,
+                        sha256,
+                        rows,
+                        datetime.now().isoformat(timespec="seconds"),
+                    ),
+                )
+                connection.commit()
+                counts["added" if stored is None else "updated"] += 1
+    finally:
+        connection.close()
+
+    print(
+        f"Consolidated {counts['added']} new and {counts['updated']} changed {table} "
+        f"files into {store_path} ({counts['unchanged']} unchanged, "
+        f"{counts['failed']} failed)"
+    )
+    return counts
+
+
+def export_consolidated_csv(
+    store_path, output_path, chunk_rows=DEFAULT_CHUNK_ROWS, table=TRANSFORMED_DATA
+):
+    # Stream one table of the store into one CSV, written under a temporary
+    # name and renamed, so readers never see a half-written file
+    connection = open_consolidated_store(store_path)
+    columns = ", ".join(f'"{column}"' for column in TABLE_COLUMNS[table])
+    temp_path = f"{output_path}.tmp"
+    rows = 0
+    try:
+        with open(temp_path, "w", newline="") as f:
+            header = True
+            for chunk in pd.read_sql_query(
+                f"SELECT {columns} FROM {table} ORDER BY source_file, rowid",
+                connection,
+                chunksize=chunk_rows,
+            ):
+                chunk.to_csv(f, header=header, index=False)
+                header = False
+                rows += len(chunk)
+            if header:
+                pd.DataFrame(columns=TABLE_COLUMNS[table]).to_csv(f, index=False)
+    finally:
+        connection.close()
+    os.replace(temp_path, output_path)
+    print(f"Combined data saved to {output_path} ({rows} rows)")
+    return output_path
+
+
+def export_consolidated_parquet(
+    store_path, dataset_dir, chunk_rows=DEFAULT_CHUNK_ROWS, table=TRANSFORMED_DATA
+):
+    # Stream one table of the store into a Parquet dataset partitioned by the
+    # date each patient file was consolidated. Written to a temporary directory and
+    # swapped in, so readers never see a half-written dataset.
+    connection = open_consolidated_store(store_path)
+    columns = ", ".join(f'data."{column}"' for column in TABLE_COLUMNS[table])
+    temp_dir = f"{dataset_dir}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    writer = PartitionedParquetWriter(
+        temp_dir, "part-0", chunk_rows, TABLE_SCHEMAS[table]
+    )
+    try:
+        for chunk in pd.read_sql_query(
+            f"SELECT {columns}, substr(files.consolidated, 1, 10) AS extraction_date "
+            f"FROM {table} AS data "
+            "JOIN source_files AS files ON files.filename = data.source_file "
+            "ORDER BY data.source_file, data.rowid",
+            connection,
+            chunksize=chunk_rows,
+        ):
+            for partition_date, rows in chunk.groupby("extraction_date"):
+                writer.write(rows, partition_date)
+    finally:
+        writer.close()
+        connection.close()
+    os.makedirs(temp_dir, exist_ok=True)
+    old_dir = f"{dataset_dir}.old"
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(dataset_dir, old_dir)
+    os.replace(temp_dir, dataset_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Combined data saved to {dataset_dir} ({writer.rows} rows)")
+    return dataset_dir
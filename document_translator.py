@@ -1,11 +1,146 @@
+import json
 import os
+import re
+import threading
 import unicodedata  # Import for non-ASCII character handling
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from typing import Optional
 
 import fitz  # PyMuPDF for text extraction
 import pandas as pd
-from openai import OpenAI
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+
+from bill_format import INVOICE_COLUMNS, bill_format_settings, get_bill_format_index
+from llm_cache import cached_chat_completion
+from llm_client import LLMRequestError, get_client
+from metrics import bind_context, get_metrics
+from model_cascade import get_model_cascade
+from ocr import source_filename
+from output_tables import build_output_tables, table_filename
+from page_store import read_page_texts
+from parquet_output import (
+    TABLE_SCHEMAS,
+    write_patient_parquet,
+    writes_csv,
+    writes_parquet,
+)
+from pdf_splitting import split_source_filename
+from rate_limiter import estimate_tokens
+from text_normalizer import normalization_settings, normalize_for_document
+
+EXTRACTION_MODEL = "gpt-4o-mini"
+EXTRACTION_MAX_TOKENS = 5700
+# Per-request timeout in seconds; long invoices take a while to generate
+EXTRACTION_TIMEOUT = 180
+
+# Structured extraction counters for the whole run, see print_extraction_stats
+extraction_stats = Counter()
+_extraction_stats_lock = threading.Lock()
+
+DATE_PATTERN = re.compile(r"^(\d{2}\.\d{2}\.\d{4})?$")
+
+
+# Typed schemas for structured extraction. They are sent to the API as strict
+# JSON schemas and every returned row is validated against them again.
+class InvoiceLineItem(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    transaction_id: str
+    drug_services: str
+    quantity: Optional[float]
+    date: str
+
+    @field_validator("drug_services")
+    @classmethod
+    def drug_services_not_empty(cls, value):
+        if not value.strip():
+            raise ValueError("Drug/Services is empty")
+        return value.strip()
+
+    @field_validator("date")
+    @classmethod
+    def date_format(cls, value):
+        if not DATE_PATTERN.match(value.strip()):
+            raise ValueError("Date is not in DD.MM.YYYY format")
+        return value.strip()
+
+
+class InvoiceExtraction(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    line_items: list[InvoiceLineItem]
+
+
+class DiagnosisItem(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    diagnosis: str
+    diagnosis_type: str
+
+    @field_validator("diagnosis")
+    @classmethod
+    def diagnosis_not_empty(cls, value):
+        if not value.strip():
+            raise ValueError("Diagnosis is empty")
+        return value.strip()
+
+
+class MedicalReportExtraction(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    diagnoses: list[DiagnosisItem]
+
+
+def json_schema_response_format(name, model):
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": model.model_json_schema(),
+        },
+    }
+
+
+def record_extraction_stat(name, count=1):
+    with _extraction_stats_lock:
+        extraction_stats[name] += count
+
+
+def print_extraction_stats():
+    if not extraction_stats["structured_responses"]:
+        return
+    print(
+        f"Structured extraction: {extraction_stats['structured_responses']} responses, "
+        f"{extraction_stats['schema_failures']} failed schema validation, "
+        f"{extraction_stats['schema_retries']} retried, "
+        f"{extraction_stats['invalid_rows']} invalid rows dropped"
+    )
+
+
+# Validate a structured response. Returns (rows, invalid_row_count), with
+# rows set to None when the response as a whole is unusable.
+def parse_structured_rows(response, envelope_key, row_model):
+    if response is None:
+        return None, 0
+    try:
+        data = json.loads(response)
+    except json.JSONDecodeError:
+        return None, 0
+    items = data.get(envelope_key) if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return None, 0
+
+    rows = []
+    invalid_rows = 0
+    for item in items:
+        try:
+            rows.append(row_model.model_validate(item))
+        except ValidationError:
+            invalid_rows += 1
+    return rows, invalid_rows
 
 
 # Function to remove non-ASCII characters
@@ -14,33 +149,229 @@ def remove_non_ascii(text):
     return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("utf-8")
 
 
+# Patient ID is the first part of the filename
+def patient_id_from_filename(filename):
+    return os.path.basename(filename).split("_")[0].strip()
+
+
+# Split page texts into chunks of at most max_tokens, on page boundaries where
+# possible and on line boundaries inside pages that are too long on their own.
+# Each chunk after the first repeats the last overlap_pages pieces of the
+# previous one, so items cut by a chunk boundary are seen whole at least once.
+# Returns (chunk text, text repeated from the previous chunk) per chunk.
+def chunk_pages(pages, max_tokens, overlap_pages=0):
+    pieces = []
+    for page in pages:
+        if estimate_tokens(page) <= max_tokens:
+            pieces.append(page)
+            continue
+        lines = []
+        lines_tokens = 0
+        for line in page.splitlines():
+            line_tokens = estimate_tokens(line)
+            if lines and lines_tokens + line_tokens > max_tokens:
+                pieces.append("\n".join(lines))
+                lines = []
+                lines_tokens = 0
+            lines.append(line)
+            lines_tokens += line_tokens
+        if lines:
+            pieces.append("\n".join(lines))
+
+    chunks = []
+    current = []
+    repeated = 0
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece)
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append((current, repeated))
+            current = current[-overlap_pages:] if overlap_pages else []
+            current_tokens = sum(estimate_tokens(overlap) for overlap in current)
+            if current_tokens + piece_tokens > max_tokens:
+                current = []
+                current_tokens = 0
+            repeated = len(current)
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append((current, repeated))
+    return [
+        ("\n".join(chunk), "\n".join(chunk[:repeated])) for chunk, repeated in chunks
+    ]
+
+
+def _compact(text):
+    return " ".join(str(text).lower().split())
+
+
+def _comparable_keys(frame, key_columns):
+    # Key tuples as strings, with numbers as floats so that a quantity of 2 in
+    # one chunk matches 2.0 or "2" in the next
+    columns = []
+    for column in key_columns:
+        values = frame[column]
+        numbers = pd.to_numeric(values, errors="coerce")
+        columns.append(
+            numbers.astype(float).astype(str).where(numbers.notna(), values.astype(str))
+        )
+    return zip(*columns)
+
+
+# Only rows from the pages two neighbouring chunks share can be duplicates.
+# Rows do not say which page they come from, so a row of the later chunk is
+# dropped only if the earlier chunk has the same row and its text_column
+# value is printed on the shared pages, at most as many times as it is
+# printed there. Without key columns rows cannot be matched and the chunks
+# are simply concatenated.
+def drop_overlap_duplicates(frames, overlaps, key_columns, text_column="Drug/Services"):
+    if not key_columns or text_column not in key_columns:
+        return pd.concat(frames, ignore_index=True)
+    merged = [frames[0]]
+    for previous, current, overlap in zip(frames, frames[1:], overlaps[1:]):
+        shared_text = _compact(overlap)
+        previous_counts = Counter(_comparable_keys(previous, key_columns))
+        dropped = Counter()
+        keep = []
+        keys = _comparable_keys(current, key_columns)
+        for key, text in zip(keys, current[text_column]):
+            text = _compact(text) if pd.notna(text) else ""
+            limit = min(previous_counts[key], shared_text.count(text) if text else 0)
+            drop = dropped[key] < limit
+            dropped[key] += drop
+            keep.append(not drop)
+        merged.append(current[keep])
+    return pd.concat(merged, ignore_index=True)
+
+
 class DocumentExtractor:
-    def __init__(self, pdf_path):
+    # Either reads the text from pdf_path, or takes the page texts directly
+    # from the splitter when running in memory (pdf_path and page_numbers then
+    # point at the pages in the OCR file, for bill format templates). With
+    # chunk_tokens set, documents longer than that are extracted in chunks,
+    # chunk_workers at a time. With normalize_text the pages are compacted
+    # first (see text_normalizer.py).
+    def __init__(
+        self,
+        pdf_path=None,
+        page_texts=None,
+        page_numbers=None,
+        patient_id=None,
+        chunk_tokens=None,
+        chunk_overlap_pages=0,
+        chunk_workers=4,
+        structured=False,
+        schema_retries=2,
+        normalize_text=False,
+    ):
         self.pdf_path = pdf_path
-        api_key = os.getenv("OPENAI_API_KEY")
-        self.client = OpenAI(api_key=api_key)
-        self.text = self._load_pdf_text()
+        self.page_numbers = page_numbers
+        self.patient_id = patient_id or patient_id_from_filename(pdf_path)
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_pages = chunk_overlap_pages
+        self.chunk_workers = chunk_workers
+        self.structured = structured
+        self.schema_retries = schema_retries
+        # Shared by every extractor, so connections are reused across documents
+        self.client = get_client()
+        if page_texts is not None:
+            self.pages = list(page_texts)
+        else:
+            self.pages = self._load_pdf_pages()
+        if normalize_text:
+            self.pages = normalize_for_document(self.pages)
+        self.text = "\n".join(self.pages)
 
-    def _load_pdf_text(self):
-        text_content = []
+    def _load_pdf_pages(self):
+        # From the page store when the splitter has already read these pages
         try:
-            pdf_document = fitz.open(self.pdf_path)
-            for page_num in range(pdf_document.page_count):
-                page = pdf_document.load_page(page_num)
-                text_content.append(page.get_text())
-            pdf_document.close()
+            return read_page_texts(self.pdf_path)
         except Exception as e:
             print(f"Error loading PDF: {e}")
-        return "\n".join(text_content)
+            return []
+
+    def _chunks(self):
+        # (chunk text, text repeated from the previous chunk) per chunk
+        if not self.chunk_tokens or estimate_tokens(self.text) <= self.chunk_tokens:
+            return [(self.text, "")]
+        return chunk_pages(self.pages, self.chunk_tokens, self.chunk_overlap_pages)
+
+    def _text_chunks(self):
+        return [text for text, _ in self._chunks()]
+
+    def _call_structured(
+        self, prompt, schema_name, envelope_model, row_model, model=None
+    ):
+        # Ask for rows matching envelope_model and validate them. A response
+        # that is not valid JSON, or that has rows failing validation, is
+        # retried for this document only (bypassing the cached answer). After
+        # the last retry the valid rows are kept and the rest are counted.
+        response_format = json_schema_response_format(schema_name, envelope_model)
+        envelope_key = next(iter(envelope_model.model_fields))
+        rows = None
+        for attempt in range(self.schema_retries + 1):
+            if attempt:
+                record_extraction_stat("schema_retries")
+            response = self._call_chatgpt(
+                prompt,
+                model=model,
+                response_format=response_format,
+                refresh=attempt > 0,
+            )
+            record_extraction_stat("structured_responses")
+            rows, invalid_rows = parse_structured_rows(
+                response, envelope_key, row_model
+            )
+            if rows is not None and not invalid_rows:
+                return rows
 
-    def _call_chatgpt(self, prompt):
+            record_extraction_stat("schema_failures")
+            print(
+                f"Schema validation failed for patient ID {self.patient_id} "
+                f"({'unparseable response' if rows is None else f'{invalid_rows} invalid rows'})"
+            )
+        if rows is not None:
+            record_extraction_stat("invalid_rows", invalid_rows)
+        return rows
+
+    def _extract_with_cascade(self, extract_from_text, text):
+        # Cheaper models extract first; a chunk whose answer could not be
+        # parsed or validated is extracted again by the next model
+        def ask(model, score):
+            return extract_from_text(text, model), None
+
+        return get_model_cascade("extract", EXTRACTION_MODEL).run(ask)
+
+    def _extract_chunks(self, extract_from_text):
+        # Returns one result per chunk, in chunk order. Chunks are extracted
+        # concurrently, so latency is set by the largest chunk.
+        chunks = self._text_chunks()
+        if len(chunks) == 1:
+            return [self._extract_with_cascade(extract_from_text, chunks[0])]
+        print(f"Extracting {len(chunks)} chunks for patient ID {self.patient_id}")
+
+        def extract_chunk(text):
+            return self._extract_with_cascade(extract_from_text, text)
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.chunk_workers, len(chunks))
+        ) as executor:
+            return list(executor.map(bind_context(extract_chunk), chunks))
+
+    def _call_chatgpt(self, prompt, model=None, **params):
         try:
-            chat_completion = self.client.chat.completions.create(
+            return cached_chat_completion(
+                self.client,
                 messages=[{"role": "user", "content": prompt}],
-                model="gpt-4o-mini",
-                max_tokens=5700,
+                model=model
+                or get_model_cascade("extract", EXTRACTION_MODEL).first_model,
+                timeout=EXTRACTION_TIMEOUT,
+                max_tokens=EXTRACTION_MAX_TOKENS,
+                **params,
             )
-            return chat_completion.choices[0].message.content.strip()
+        except LLMRequestError:
+            # Not an answer; the document fails and is retried on the next run
+            raise
         except Exception as e:
             print(f"Error during API call: {e}")
             return None
@@ -76,27 +407,91 @@ class LetterOfGuaranteeExtractor(DocumentExtractor):
         return self._call_chatgpt(prompt)
 
 
+def build_invoice_prompt(text):
+    return (
+        "You are a document processing assistant. Extract information specifically for an Invoice.\n"
+        "Identify and extract the following details in CSV format with exactly these columns:\n"
+        "- Transaction_ID (Use 'NA' if no transaction ID is available)\n"
+        "- Drug/Services (This should include specific drugs, medications, but exclude warding details, medical services, medical procedures, scans, x-rays, dressings, etc., and should exclude generic terms such as 'Pharmacy Invoice' or 'Inpatient Invoice')\n"
+        "- Quantity associated with each item\n"
+        "- Date associated with each entry, in DD.MM.YYYY format (leave blank if not available)\n\n"
+        "Only include rows where 'Drug/Services' refers to a specific drug. Do not include entries with generic terms such as 'Pharmacy Invoice' or 'Inpatient Invoice' in the 'Drug/Services' column.\n\n"
+        "Provide the output in a CSV format with these columns in this order: Transaction_ID, Drug/Services, Quantity, Date.\n"
+        f"Here is the text:\n{text}\n"
+        "Return only the CSV content with no extra explanations or commentary."
+    )
+
+
+def build_structured_invoice_prompt(text):
+    return (
+        "You are a document processing assistant. Extract information specifically for an Invoice.\n"
+        "Return one line item per drug with these fields:\n"
+        "- transaction_id (Use 'NA' if no transaction ID is available)\n"
+        "- drug_services (This should include specific drugs, medications, but exclude warding details, medical services, medical procedures, scans, x-rays, dressings, etc., and should exclude generic terms such as 'Pharmacy Invoice' or 'Inpatient Invoice')\n"
+        "- quantity associated with each item (null if not available)\n"
+        "- date associated with each entry, in DD.MM.YYYY format (empty string if not available)\n\n"
+        "Only include line items where 'drug_services' refers to a specific drug.\n"
+        f"Here is the text:\n{text}\n"
+    )
+
+
 class InvoiceExtractor(DocumentExtractor):
     def extract_info(self):
-        base_name = os.path.basename(self.pdf_path)
-        patient_id = base_name.split("_")[
-            0
-        ].strip()  # Extract the first part of the filename
+        csv_data = self._extract_with_template()
+        if csv_data is not None:
+            return csv_data
 
-        prompt = (
-            "You are a document processing assistant. Extract information specifically for an Invoice.\n"
-            "Identify and extract the following details in CSV format with exactly these columns:\n"
-            "- Transaction_ID (Use 'NA' if no transaction ID is available)\n"
-            "- Drug/Services (This should include specific drugs, medications, but exclude warding details, medical services, medical procedures, scans, x-rays, dressings, etc., and should exclude generic terms such as 'Pharmacy Invoice' or 'Inpatient Invoice')\n"
-            "- Quantity associated with each item\n"
-            "- Date associated with each entry, in DD.MM.YYYY format (leave blank if not available)\n\n"
-            "Only include rows where 'Drug/Services' refers to a specific drug. Do not include entries with generic terms such as 'Pharmacy Invoice' or 'Inpatient Invoice' in the 'Drug/Services' column.\n\n"
-            "Provide the output in a CSV format with these columns in this order: Transaction_ID, Drug/Services, Quantity, Date.\n"
-            f"Here is the text:\n{self.text}\n"
-            "Return only the CSV content with no extra explanations or commentary."
-        )
+        frames = self._extract_chunks(self._extract_from_text)
+        if len(frames) == 1:
+            return frames[0]
+        if any(frame is None for frame in frames):
+            print(f"Error: a chunk failed for patient ID {self.patient_id}")
+            return None
 
-        response = self._call_chatgpt(prompt)
+        if self.chunk_overlap_pages:
+            key_columns = [
+                column
+                for column in ["Transaction_ID", "Drug/Services", "Quantity", "Date"]
+                if all(column in frame.columns for frame in frames)
+            ]
+            overlaps = [overlap for _, overlap in self._chunks()]
+            return drop_overlap_duplicates(frames, overlaps, key_columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def _extract_with_template(self):
+        # Known bill formats are parsed from the word coordinates, no API call.
+        # Returns None for unknown formats, which go to ChatGPT as before.
+        index = get_bill_format_index()
+        if index is None or not index.templates or self.pdf_path is None:
+            return None
+        try:
+            with fitz.open(self.pdf_path) as pdf_document:
+                page_numbers = self.page_numbers
+                if page_numbers is None:
+                    page_numbers = range(pdf_document.page_count)
+                name, items = index.parse_pages(
+                    [pdf_document.load_page(number) for number in page_numbers]
+                )
+        except Exception as e:
+            print(f"Error reading bill format of {self.pdf_path}: {e}")
+            return None
+        if name is None:
+            return None
+
+        csv_data = pd.DataFrame(items, columns=INVOICE_COLUMNS)
+        csv_data["patient_id"] = self.patient_id
+        print(f"Invoice Data parsed as bill format {name}: {len(csv_data)} line items.")
+        return csv_data
+
+    def _extract_from_text(self, text, model=None):
+        if self.structured:
+            return self._extract_structured(text, model)
+
+        patient_id = self.patient_id
+
+        prompt = build_invoice_prompt(text)
+
+        response = self._call_chatgpt(prompt, model)
 
         if response is None:
             print("Error: No response from ChatGPT")
@@ -134,32 +529,95 @@ class InvoiceExtractor(DocumentExtractor):
             print("Invoice Data successfully extracted and stored in DataFrame.")
             print(csv_data)  # Print the DataFrame for verification
             return csv_data
-        except pd.errors.ParserError as e:
+        except (pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+            # No line in the answer looked like a line item
             print("Error parsing CSV response:", e)
             return None
 
+    def _extract_structured(self, text, model=None):
+        rows = self._call_structured(
+            build_structured_invoice_prompt(text),
+            "invoice_line_items",
+            InvoiceExtraction,
+            InvoiceLineItem,
+            model,
+        )
+        if rows is None:
+            print("Error: No valid structured response from ChatGPT")
+            return None
+
+        # Typed columns straight from the validated rows, no CSV repair needed
+        csv_data = pd.DataFrame(
+            {
+                "Transaction_ID": pd.array(
+                    [row.transaction_id for row in rows], dtype="string"
+                ),
+                "Drug/Services": pd.array(
+                    [row.drug_services for row in rows], dtype="string"
+                ),
+                "Quantity": pd.array([row.quantity for row in rows], dtype="Float64"),
+                "Date": pd.array([row.date for row in rows], dtype="string"),
+            }
+        )
+        csv_data["patient_id"] = self.patient_id
+        print(f"Invoice Data extracted: {len(csv_data)} line items.")
+        return csv_data
+
+
+def build_medical_report_prompt(text):
+    return (
+        "You are a document processing assistant. Extract all overarching diagnoses from a Medical Report.\n"
+        "Identify and extract all primary diagnosed conditions in CSV format with exactly these columns:\n"
+        "- Diagnosis (description of the medical condition, focusing on overarching or primary diagnoses rather than specific details)\n"
+        "- Diagnosis Type (classification of the diagnosis based on ICD-10 categories, e.g., 'I21 - Acute myocardial infarction')\n\n"
+        "Be especially attentive to phrases that indicate a diagnosis, such as 'diagnosed with', 'suffers from', 'presents with', 'history of', 'indicates', or 'suggests'.\n"
+        "If there are multiple conditions, list each overarching diagnosis on a separate line in the output.\n\n"
+        "Use the ICD-10 classification to categorize each diagnosis in the 'Diagnosis Type' column, providing the full ICD-10 code and description (e.g., 'I21 - Acute myocardial infarction').\n\n"
+        "Provide the output in a CSV format with columns labeled 'Diagnosis', 'Diagnosis Type' without any extra symbols or Markdown syntax. If a value contains commas, enclose it in double quotes.\n\n"
+        f"Here is the text:\n{text}\n"
+        "Return only the CSV content with no extra explanations or commentary."
+    )
+
+
+def build_structured_medical_report_prompt(text):
+    return (
+        "You are a document processing assistant. Extract all overarching diagnoses from a Medical Report.\n"
+        "Return one entry per primary diagnosed condition with these fields:\n"
+        "- diagnosis (description of the medical condition, focusing on overarching or primary diagnoses rather than specific details)\n"
+        "- diagnosis_type (classification of the diagnosis based on ICD-10 categories, e.g., 'I21 - Acute myocardial infarction')\n\n"
+        "Be especially attentive to phrases that indicate a diagnosis, such as 'diagnosed with', 'suffers from', 'presents with', 'history of', 'indicates', or 'suggests'.\n"
+        "Use 'NA' as diagnosis_type if no ICD-10 category applies.\n\n"
+        f"Here is the text:\n{text}\n"
+    )
+
 
 class MedicalReportExtractor(DocumentExtractor):
     def extract_info(self):
-        base_name = os.path.basename(self.pdf_path)
-        patient_id = base_name.split("_")[
-            0
-        ].strip()  # Extract the first part of the filename
+        frames = self._extract_chunks(self._extract_from_text)
+        if len(frames) == 1:
+            return frames[0]
+        if any(frame is None for frame in frames):
+            print(f"Error: a chunk failed for patient ID {self.patient_id}")
+            return None
 
-        prompt = (
-            "You are a document processing assistant. Extract all overarching diagnoses from a Medical Report.\n"
-            "Identify and extract all primary diagnosed conditions in CSV format with exactly these columns:\n"
-            "- Diagnosis (description of the medical condition, focusing on overarching or primary diagnoses rather than specific details)\n"
-            "- Diagnosis Type (classification of the diagnosis based on ICD-10 categories, e.g., 'I21 - Acute myocardial infarction')\n\n"
-            "Be especially attentive to phrases that indicate a diagnosis, such as 'diagnosed with', 'suffers from', 'presents with', 'history of', 'indicates', or 'suggests'.\n"
-            "If there are multiple conditions, list each overarching diagnosis on a separate line in the output.\n\n"
-            "Use the ICD-10 classification to categorize each diagnosis in the 'Diagnosis Type' column, providing the full ICD-10 code and description (e.g., 'I21 - Acute myocardial infarction').\n\n"
-            "Provide the output in a CSV format with columns labeled 'Diagnosis', 'Diagnosis Type' without any extra symbols or Markdown syntax. If a value contains commas, enclose it in double quotes.\n\n"
-            f"Here is the text:\n{self.text}\n"
-            "Return only the CSV content with no extra explanations or commentary."
-        )
+        # The same diagnosis is often restated in several parts of a report
+        combined = pd.concat(frames, ignore_index=True)
+        subset = [
+            column
+            for column in ["Diagnosis", "Diagnosis Type"]
+            if column in combined.columns
+        ]
+        return combined.drop_duplicates(subset=subset or None, ignore_index=True)
+
+    def _extract_from_text(self, text, model=None):
+        if self.structured:
+            return self._extract_structured(text, model)
+
+        patient_id = self.patient_id
 
-        response = self._call_chatgpt(prompt)
+        prompt = build_medical_report_prompt(text)
+
+        response = self._call_chatgpt(prompt, model)
 
         if response is None:
             print("Error: No response from ChatGPT")
@@ -224,72 +682,213 @@ class MedicalReportExtractor(DocumentExtractor):
                 print("Error parsing cleaned CSV response:", e)
                 return None
 
+    def _extract_structured(self, text, model=None):
+        rows = self._call_structured(
+            build_structured_medical_report_prompt(text),
+            "medical_report_diagnoses",
+            MedicalReportExtraction,
+            DiagnosisItem,
+            model,
+        )
+        if rows is None:
+            print("Error: No valid structured response from ChatGPT")
+            return None
+
+        csv_data = pd.DataFrame(
+            {
+                "Diagnosis": pd.array(
+                    [remove_non_ascii(row.diagnosis) for row in rows], dtype="string"
+                ),
+                "Diagnosis Type": pd.array(
+                    [row.diagnosis_type or "NA" for row in rows], dtype="string"
+                ),
+            }
+        )
+        csv_data["patient_id"] = self.patient_id
+        print(f"Medical Report Data extracted: {len(csv_data)} diagnoses.")
+        return csv_data
+
+
+def combine_patient_data(
+    patient_id,
+    invoice_df,
+    medical_report_df,
+    output_folder,
+    output_format="csv",
+    output_layout="merged",
+    patient_features=False,
+):
+    # Only combine if both invoice and medical report data are available
+    if invoice_df is not None and medical_report_df is not None:
+        # Ensure columns are correctly formatted
+        invoice_df["patient_id"] = invoice_df["patient_id"].astype(str)
+        medical_report_df["patient_id"] = medical_report_df["patient_id"].astype(str)
+        invoice_df["Quantity"] = (
+            pd.to_numeric(invoice_df["Quantity"], errors="coerce").fillna(0).astype(int)
+        )
+
+        tables = build_output_tables(
+            invoice_df, medical_report_df, output_layout, patient_features
+        )
+
+        # Returns the path of the first table (the CSV, or the Parquet file when
+        # only Parquet is written)
+        output_path = None
+        for table, table_df in tables.items():
+            paths = []
+            if writes_parquet(output_format):
+                paths.append(
+                    write_patient_parquet(
+                        table_df,
+                        os.path.join(output_folder, table),
+                        f"{patient_id}_{table}",
+                        TABLE_SCHEMAS[table],
+                    )
+                )
+            if writes_csv(output_format):
+                paths.append(
+                    os.path.join(output_folder, table_filename(patient_id, table))
+                )
+                table_df.to_csv(paths[-1], index=False)
+            for path in paths:
+                print(f"Combined data saved to {path} ({len(table_df)} rows)")
+            output_path = output_path or paths[-1]
+        return output_path
+    else:
+        print(
+            f"Skipping combination for patient ID {patient_id}: Missing either Invoice or Medical Report."
+        )
+        return None
+
+
+# Settings that change the extracted data, used to invalidate resumed runs
+def extraction_settings(extractor_options=None, output_options=None):
+    extractor_options = extractor_options or {}
+    return {
+        "output": output_options or {},
+        "model": EXTRACTION_MODEL,
+        "cascade": get_model_cascade("extract", EXTRACTION_MODEL).settings(),
+        "max_tokens": EXTRACTION_MAX_TOKENS,
+        "chunk_tokens": extractor_options.get("chunk_tokens"),
+        "chunk_overlap_pages": extractor_options.get("chunk_overlap_pages", 0),
+        "invoice_prompt": build_invoice_prompt(""),
+        "medical_report_prompt": build_medical_report_prompt(""),
+        "structured": extractor_options.get("structured", False),
+        "normalization": normalization_settings(
+            extractor_options.get("normalize_text", False)
+        ),
+        "structured_invoice_prompt": build_structured_invoice_prompt(""),
+        "structured_medical_report_prompt": build_structured_medical_report_prompt(""),
+        "invoice_schema": InvoiceExtraction.model_json_schema(),
+        "medical_report_schema": MedicalReportExtraction.model_json_schema(),
+        "bill_formats": bill_format_settings(),
+    }
+
 
 # Helper function to process both Invoices and Medical Reports and combine them
 # Main function to process and combine files with the same patient ID
-def process_and_combine(pdfs_folder, output_folder):
+def process_and_combine(
+    pdfs_folder,
+    output_folder,
+    manifest=None,
+    extractor_options=None,
+    output_options=None,
+):
     os.makedirs(output_folder, exist_ok=True)
+    extractor_options = extractor_options or {}
+    output_options = output_options or {}
 
     # Group files by the starting name (patient ID)
     files_by_patient_id = defaultdict(list)
     for filename in os.listdir(pdfs_folder):
         if filename.endswith(".pdf"):
-            patient_id = filename.split("_")[0].strip()
+            patient_id = patient_id_from_filename(filename)
             files_by_patient_id[patient_id].append(filename)
 
     # Process each group of files with the same starting name (patient ID)
     for patient_id, files in files_by_patient_id.items():
+        # Input documents this patient's split files came from
+        documents = {
+            source_filename(split_source_filename(filename)) for filename in files
+        }
+        if manifest is not None and all(
+            manifest.is_done(document, "extract") for document in documents
+        ):
+            print(f"Skipping patient ID {patient_id}, already extracted")
+            continue
+
         invoice_df = None
         medical_report_df = None
 
         # Extract data for each file type
-        for filename in files:
-            pdf_path = os.path.join(pdfs_folder, filename)
-            if filename.endswith("Invoice.pdf"):
-                invoice_extractor = InvoiceExtractor(pdf_path)
-                invoice_df = invoice_extractor.extract_info()
-            elif filename.endswith("Medical_Report.pdf"):
-                medical_report_extractor = MedicalReportExtractor(pdf_path)
-                medical_report_df = medical_report_extractor.extract_info()
-
-        # Only combine if both invoice and medical report data are available
-        if invoice_df is not None and medical_report_df is not None:
-            # Ensure columns are correctly formatted
-            invoice_df["patient_id"] = invoice_df["patient_id"].astype(str)
-            medical_report_df["patient_id"] = medical_report_df["patient_id"].astype(
-                str
-            )
-            invoice_df["Quantity"] = (
-                pd.to_numeric(invoice_df["Quantity"], errors="coerce")
-                .fillna(0)
-                .astype(int)
-            )
+        try:
+            with get_metrics().document_stage(", ".join(sorted(documents)), "extract"):
+                for filename in files:
+                    pdf_path = os.path.join(pdfs_folder, filename)
+                    if filename.endswith("Invoice.pdf"):
+                        invoice_extractor = InvoiceExtractor(
+                            pdf_path, **extractor_options
+                        )
+                        invoice_df = invoice_extractor.extract_info()
+                    elif filename.endswith("Medical_Report.pdf"):
+                        medical_report_extractor = MedicalReportExtractor(
+                            pdf_path, **extractor_options
+                        )
+                        medical_report_df = medical_report_extractor.extract_info()
+        except LLMRequestError as e:
+            # Left unmarked in the manifest, so the next run retries it
+            print(f"Failed to extract patient ID {patient_id}: {e}")
+            continue
+
+        output_path = combine_patient_data(
+            patient_id, invoice_df, medical_report_df, output_folder, **output_options
+        )
+        if manifest is not None:
+            for document in documents:
+                manifest.mark_done(
+                    document, "extract", [output_path] if output_path else []
+                )
 
-            # Merge on patient_id and save as a single CSV
-            combined_df = pd.merge(
-                invoice_df, medical_report_df, on="patient_id", how="outer"
-            )
-            combined_df = combined_df[
-                [
-                    "patient_id",
-                    "Transaction_ID",
-                    "Date",
-                    "Drug/Services",
-                    "Quantity",
-                    "Diagnosis",
-                    "Diagnosis Type",
-                ]
-            ]
 
-            output_path = os.path.join(
-                output_folder, f"{patient_id}_transformed_data.csv"
-            )
-            combined_df.to_csv(output_path, index=False)
-            print(f"Combined data saved to {output_path}")
-        else:
-            print(
-                f"Skipping combination for patient ID {patient_id}: Missing either Invoice or Medical Report."
-            )
+# In-memory counterpart of process_and_combine for one classified document:
+# takes the page texts per category straight from the splitter
+def process_classified_document(
+    patient_id,
+    classified_texts,
+    output_folder,
+    extractor_options=None,
+    output_options=None,
+    source_pdf=None,
+    source_pages=None,
+):
+    os.makedirs(output_folder, exist_ok=True)
+    extractor_options = extractor_options or {}
+    output_options = output_options or {}
+    source_pages = source_pages or {}
+
+    invoice_df = None
+    medical_report_df = None
+
+    if classified_texts.get("Invoice"):
+        invoice_extractor = InvoiceExtractor(
+            pdf_path=source_pdf,
+            page_texts=classified_texts["Invoice"],
+            page_numbers=source_pages.get("Invoice"),
+            patient_id=patient_id,
+            **extractor_options,
+        )
+        invoice_df = invoice_extractor.extract_info()
+    if classified_texts.get("Medical Report"):
+        medical_report_extractor = MedicalReportExtractor(
+            page_texts=classified_texts["Medical Report"],
+            patient_id=patient_id,
+            **extractor_options,
+        )
+        medical_report_df = medical_report_extractor.extract_info()
+
+    return combine_patient_data(
+        patient_id, invoice_df, medical_report_df, output_folder, **output_options
+    )
 
 
 # # Example usage for all PDFs in a folder
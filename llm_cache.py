@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import get_metrics
+from rate_limiter import estimate_tokens
+
+DEFAULT_CACHE_SIZE_MB = 512
+
+
+def make_cache_key(model, messages, params):
+    # Content-addressed key: identical model, prompt and parameters always
+    # produce the same answer from the cache
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path, max_size_mb=DEFAULT_CACHE_SIZE_MB, refresh=False):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        # In refresh mode nothing is read from the cache, but fresh answers
+        # still overwrite the stored ones
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS llm_cache_last_access "
+            "ON llm_cache (last_access)"
+        )
+        self._connection.commit()
+        self._total_size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM llm_cache"
+        ).fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            if self.refresh:
+                self.misses += 1
+                return None
+            row = self._connection.execute(
+                "SELECT value FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE llm_cache SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._connection.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        serialized = json.dumps(value, ensure_ascii=False)
+        size = len(serialized.encode("utf-8"))
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, serialized, size, time.time()),
+            )
+            self._total_size += size - (previous[0] if previous else 0)
+            if self._total_size > self.max_size_bytes:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back under 90%
+        # of its size budget, so eviction does not run on every insert
+        target = int(self.max_size_bytes * 0.9)
+        rows = self._connection.execute(
+            "SELECT key, size FROM llm_cache ORDER BY last_access ASC"
+        )
+        evicted_keys = []
+        for key, size in rows:
+            if self._total_size <= target:
+                break
+            evicted_keys.append((key,))
+            self._total_size -= size
+        rows.close()
+        self._connection.executemany(
+            "DELETE FROM llm_cache WHERE key = ?", evicted_keys
+        )
+        self.evictions += len(evicted_keys)
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute(
+                "SELECT COUNT(*) FROM llm_cache"
+            ).fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": self._total_size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# Module-level cache shared by classification and extraction, set up by main.py
+_cache = None
+
+
+def configure_cache(path, max_size_mb=DEFAULT_CACHE_SIZE_MB, refresh=False):
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = LLMCache(path, max_size_mb=max_size_mb, refresh=refresh)
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def print_cache_stats():
+    if _cache is None:
+        return
+    stats = _cache.stats()
+    print(
+        f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['evictions']} evictions, {stats['entries']} entries "
+        f"({stats['size_bytes'] / (1024 * 1024):.1f} MB)"
+    )
+
+
+def answer_logprob(choice):
+    # Sum of the token logprobs of the answer, i.e. the log of its probability,
+    # or None when the API returned no logprobs
+    logprobs = getattr(choice, "logprobs", None)
+    tokens = getattr(logprobs, "content", None)
+    if not tokens:
+        return None
+    return sum(token.logprob for token in tokens)
+
+
+def cached_chat_response(
+    client, messages, model, refresh=False, rate_limiter=None, timeout=None, **params
+):
+    # Returns {"content": stripped response text, "logprob": ...}, or None if
+    # the API gave no answer. logprob is only set when params ask for logprobs.
+    # refresh skips the cached answer for this one call and replaces it, e.g.
+    # when the cached answer turned out to be unusable. Only cache misses wait
+    # on the rate limiter, the client's shared one unless another is given.
+    # timeout does not change the answer, so it is not part of the cache key.
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = make_cache_key(model, messages, params)
+        cached = None if refresh else cache.get(key)
+        if cached is not None:
+            get_metrics().record_cache_hit(model)
+            return cached
+
+    rate_limiter = rate_limiter or client.rate_limiter
+    if rate_limiter is not None:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        rate_limiter.acquire(prompt_tokens + params.get("max_tokens", 0))
+
+    chat_completion = client.create(
+        messages=messages, model=model, timeout=timeout, **params
+    )
+    if not chat_completion or not getattr(chat_completion, "choices", None):
+        return None
+    choice = chat_completion.choices[0]
+    content = choice.message.content
+    if content is None:
+        return None
+    response = {"content": content.strip()}
+    if params.get("logprobs"):
+        response["logprob"] = answer_logprob(choice)
+
+    if cache is not None:
+        cache.put(key, response)
+    return response
+
+
+def cached_chat_completion(
+    client, messages, model, refresh=False, rate_limiter=None, timeout=None, **params
+):
+    # Returns the stripped response text, or None if the API gave no answer
+    response = cached_chat_response(
+        client,
+        messages,
+        model,
+        refresh=refresh,
+        rate_limiter=rate_limiter,
+        timeout=timeout,
+        **params,
+    )
+    if response is None:
+        return None
+    return response["content"]
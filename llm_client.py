@@ -0,0 +1,264 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+from openai import OpenAI
+
+from metrics import get_metrics, normalization_tokens
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_MAX_CONNECTIONS = 20
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Consecutive server errors / timeouts after which the circuit opens, and how
+# long it stays open before one trial request is let through
+CIRCUIT_FAILURE_THRESHOLD = 8
+CIRCUIT_COOLDOWN = 30.0
+
+
+class LLMRequestError(RuntimeError):
+    # The API could not be reached or kept refusing the request after every
+    # retry. Callers must not treat this as an answer.
+    pass
+
+
+class CircuitOpenError(LLMRequestError):
+    pass
+
+
+def is_rate_limit_error(error):
+    return isinstance(error, openai.RateLimitError)
+
+
+def is_retryable_error(error):
+    return isinstance(
+        error,
+        (
+            openai.RateLimitError,
+            openai.APIConnectionError,  # includes APITimeoutError
+            openai.InternalServerError,
+        ),
+    ) or (isinstance(error, openai.APIStatusError) and error.status_code == 409)
+
+
+def retry_after_seconds(error):
+    # Seconds the server asked us to wait, from retry-after-ms or retry-after
+    # (either seconds or an HTTP date), or None
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                retry_at = parsedate_to_datetime(value)
+                return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    # Exponential backoff with full jitter; a Retry-After from the server is a
+    # lower bound
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures so a dead endpoint
+    # fails fast instead of every worker sleeping through its retries. After
+    # `cooldown` seconds one trial request is let through while the others
+    # keep failing fast; its success closes the circuit, its failure opens it
+    # for another cooldown.
+    def __init__(
+        self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN
+    ):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.opened_at = None
+        self._failures = 0
+        # Thread making the trial request while the circuit is half-open
+        self._trial_thread = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(
+                    f"LLM API circuit open for another {remaining:.0f}s "
+                    f"after {self._failures} consecutive failures"
+                )
+            if self._trial_thread not in (None, threading.get_ident()):
+                raise CircuitOpenError(
+                    "LLM API circuit open, waiting for the trial request"
+                )
+            self._trial_thread = threading.get_ident()
+
+    def release_trial(self):
+        # This thread's request ended without showing whether the API is back
+        # (e.g. it was rate limited); the next request becomes the trial
+        with self._lock:
+            if self._trial_thread == threading.get_ident():
+                self._trial_thread = None
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.opened_at = None
+            self._trial_thread = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_thread = None
+            if self._failures >= self.failure_threshold:
+                # Also restarts the cooldown when a trial request fails
+                self.opened_at = time.monotonic()
+
+
+class LLMClient:
+    # One OpenAI client and keep-alive connection pool shared by every stage
+    # and thread. The SDK's own retries are disabled; retries happen here so
+    # Retry-After, jitter and the circuit breaker apply to all of them.
+    def __init__(
+        self,
+        api_key=None,
+        base_url=None,
+        timeout=DEFAULT_TIMEOUT,
+        max_retries=DEFAULT_MAX_RETRIES,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        circuit_breaker=None,
+        rate_limiter=None,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        # Requests/min and tokens/min limits are per account, so one limiter
+        # is shared by every stage that calls the API
+        self.rate_limiter = rate_limiter
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+        self._client = OpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"),
+            # Falls back to OPENAI_BASE_URL, so a local fake server can be used
+            base_url=base_url or None,
+            max_retries=0,
+            timeout=timeout,
+            http_client=self._http_client,
+        )
+
+    def create(self, messages, model, timeout=None, **params):
+        # Latency, token usage, retries and the tokens text normalization
+        # saved on every call go to the run metrics
+        start = time.perf_counter()
+        text_tokens = normalization_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.circuit_breaker.check()
+                completion = self._client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    timeout=timeout or self.timeout,
+                    **params,
+                )
+            except Exception as e:
+                if not is_retryable_error(e) or isinstance(e, CircuitOpenError):
+                    self.circuit_breaker.release_trial()
+                    get_metrics().record_api_call(
+                        model,
+                        time.perf_counter() - start,
+                        retries=attempt,
+                        failed=True,
+                        normalization_tokens=text_tokens,
+                    )
+                    if isinstance(e, LLMRequestError):
+                        raise
+                    # Auth, bad request, schema errors: no answer either, so
+                    # callers never mistake them for one
+                    raise LLMRequestError(f"LLM request failed: {e}") from e
+                # Rate limits mean "slow down", not "the service is down", so
+                # they back off without counting towards the circuit breaker
+                if is_rate_limit_error(e):
+                    self.circuit_breaker.release_trial()
+                else:
+                    self.circuit_breaker.record_failure()
+                if attempt == self.max_retries:
+                    get_metrics().record_api_call(
+                        model,
+                        time.perf_counter() - start,
+                        retries=attempt,
+                        failed=True,
+                        normalization_tokens=text_tokens,
+                    )
+                    raise LLMRequestError(
+                        f"LLM request failed after {attempt + 1} attempts: {e}"
+                    ) from e
+                delay = backoff_delay(attempt, retry_after_seconds(e))
+                print(
+                    f"LLM request failed ({type(e).__name__}), "
+                    f"retrying in {delay:.1f}s"
+                )
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+            else:
+                self.circuit_breaker.record_success()
+                usage = getattr(completion, "usage", None)
+                get_metrics().record_api_call(
+                    model,
+                    time.perf_counter() - start,
+                    prompt_tokens=getattr(usage, "prompt_tokens", 0),
+                    completion_tokens=getattr(usage, "completion_tokens", 0),
+                    retries=attempt,
+                    normalization_tokens=text_tokens,
+                )
+                return completion
+
+    def close(self):
+        self._http_client.close()
+
+
+# Module-level client shared by classification and extraction, set up by main.py
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure_client(**options):
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = LLMClient(**options)
+        return _client
+
+
+def get_client():
+    # Built with the defaults on first use when main.py did not configure one
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LLMClient()
+        return _client
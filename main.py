@@ -1,10 +1,67 @@
 import argparse
+import os
+import tempfile
+from collections import Counter
 from datetime import datetime
 
-from combine_extracted_csv import combine_csv_files
-from document_translator import process_and_combine
-from ocr import generate_ocr_files
-from pdf_splitting import process_all_pdfs_in_folder
+from bill_format import configure_bill_formats, print_bill_format_stats
+from combine_extracted_csv import (
+    combine_csv_files,
+    combined_name,
+    consolidate_csv_files,
+    export_consolidated_csv,
+    export_consolidated_parquet,
+)
+from document_translator import (
+    extraction_settings,
+    patient_id_from_filename,
+    print_extraction_stats,
+    process_and_combine,
+    process_classified_document,
+)
+from llm_cache import DEFAULT_CACHE_SIZE_MB, configure_cache, print_cache_stats
+from llm_client import (
+    DEFAULT_MAX_CONNECTIONS,
+    DEFAULT_MAX_RETRIES,
+    LLMRequestError,
+    configure_client,
+)
+from manifest import Manifest
+from metrics import PROFILE_STAGES, configure_metrics, get_metrics
+from model_cascade import (
+    DEFAULT_CONFIDENCE_THRESHOLD,
+    configure_model_cascade,
+    parse_models,
+    print_model_cascade_stats,
+)
+from ocr import generate_ocr_files, ocr_settings, source_filename
+from output_tables import OUTPUT_LAYOUTS, layout_tables
+from page_store import configure_page_store, print_page_store_stats
+from parquet_output import OUTPUT_FORMATS, writes_csv, writes_parquet
+from pdf_splitting import (
+    DEFAULT_BATCH_TOKEN_BUDGET,
+    classification_settings,
+    print_routing_stats,
+    process_all_pdfs_in_folder,
+    split_pdf_by_classification,
+)
+from pipeline import StreamingPipeline, run_streaming_pipeline
+from rate_limiter import TokenBucketRateLimiter
+from service import (
+    DEFAULT_COMBINE_INTERVAL,
+    DEFAULT_HEALTH_PORT,
+    DEFAULT_POLL_INTERVAL,
+    DEFAULT_SETTLE_SECONDS,
+    WatchFolderService,
+)
+from sharding import (
+    DEFAULT_LEASE_TIMEOUT,
+    LeaseManager,
+    combine_once,
+    parse_shard,
+    run_sharded_pipeline,
+)
+from text_normalizer import print_normalization_stats
 
 # input_dir = 'input_files'
 # output_dir = 'output_files'
@@ -13,23 +70,395 @@ from pdf_splitting import process_all_pdfs_in_folder
 # extracted_csv_dir = f'{output_dir}/extracted_csv'
 
 
-def main(input_dir, output_dir):
+# Stages main() times with metrics.stage in each mode, the only ones
+# --profile-stage can profile
+def profiled_stages(streaming, in_memory):
+    if streaming:
+        return ("pipeline", "combine")
+    if in_memory:
+        return ("ocr", "split_extract", "combine")
+    return ("ocr", "classify", "extract", "combine")
+
+
+# Splits each OCR file and hands its page texts straight to the extractors,
+# without writing and re-reading split PDFs in between
+def split_and_extract_in_memory(
+    ocr_output_dir,
+    split_pdf_dir,
+    extracted_csv_dir,
+    write_split_pdfs,
+    classify_options,
+    manifest=None,
+    extractor_options=None,
+    output_options=None,
+):
+    os.makedirs(extracted_csv_dir, exist_ok=True)
+    routing_stats = Counter()
+
+    for filename in os.listdir(ocr_output_dir):
+        if filename.endswith(".pdf"):
+            input_pdf_path = os.path.join(ocr_output_dir, filename)
+            document = source_filename(filename)
+            if manifest is not None and manifest.is_done(document, "extract"):
+                print(f"Skipping {input_pdf_path}, already extracted")
+                continue
+            print(f"Processing {input_pdf_path}")
+            metrics = get_metrics()
+            try:
+                with metrics.document_stage(document, "classify"):
+                    classified = split_pdf_by_classification(
+                        input_pdf_path,
+                        split_pdf_dir,
+                        routing_stats=routing_stats,
+                        write_pdfs=write_split_pdfs,
+                        **classify_options,
+                    )
+                if classified is None:
+                    continue
+                with metrics.document_stage(document, "extract"):
+                    output_path = process_classified_document(
+                        patient_id_from_filename(filename),
+                        classified["texts"],
+                        extracted_csv_dir,
+                        extractor_options,
+                        output_options,
+                        classified["source_pdf"],
+                        classified["pages"],
+                    )
+            except LLMRequestError as e:
+                # Left unmarked in the manifest, so the next run retries it
+                print(f"Failed to process {input_pdf_path}: {e}")
+                continue
+            if manifest is not None:
+                manifest.mark_done(document, "split", classified["outputs"])
+                manifest.mark_done(
+                    document, "extract", [output_path] if output_path else []
+                )
+
+    print_routing_stats(routing_stats)
+
+
+def combine_outputs(
+    output_dir, extracted_csv_dir, tables, output_format, incremental_combine
+):
+    for table in tables:
+        if not writes_csv(output_format):
+            # The per-patient Parquet files already form one dataset per table,
+            # partitioned by extraction date; there is nothing to combine
+            print(
+                f"Combined Parquet dataset at {os.path.join(extracted_csv_dir, table)}"
+            )
+        elif incremental_combine:
+            store_path = os.path.join(output_dir, "consolidated.sqlite")
+            consolidate_csv_files(extracted_csv_dir, store_path, table=table)
+            export_consolidated_csv(
+                store_path,
+                os.path.join(extracted_csv_dir, f"{combined_name(table)}.csv"),
+                table=table,
+            )
+            if writes_parquet(output_format):
+                export_consolidated_parquet(
+                    store_path,
+                    os.path.join(extracted_csv_dir, combined_name(table)),
+                    table=table,
+                )
+        else:
+            combine_csv_files(
+                extracted_csv_dir, extracted_csv_dir, output_format, table=table
+            )
+
+
+def main(
+    input_dir,
+    output_dir,
+    ocr_workers=1,
+    ocr_cores=None,
+    ocr_mode="auto",
+    classify_workers=4,
+    requests_per_minute=500,
+    tokens_per_minute=200000,
+    local_threshold=None,
+    compare_local_with_llm=False,
+    classify_batch_size=1,
+    classify_batch_tokens=DEFAULT_BATCH_TOKEN_BUDGET,
+    segment_pages=False,
+    use_cache=True,
+    refresh_cache=False,
+    cache_size_mb=DEFAULT_CACHE_SIZE_MB,
+    in_memory=False,
+    write_split_pdfs=False,
+    streaming=False,
+    stream_classify_workers=2,
+    extract_workers=4,
+    queue_size=8,
+    resume=True,
+    extract_chunk_tokens=None,
+    extract_chunk_overlap=0,
+    extract_chunk_workers=4,
+    structured_extraction=False,
+    schema_retries=2,
+    llm_base_url=None,
+    llm_max_retries=DEFAULT_MAX_RETRIES,
+    llm_max_connections=DEFAULT_MAX_CONNECTIONS,
+    normalize_text=True,
+    metrics_dir=None,
+    profile_stage=None,
+    incremental_combine=False,
+    output_format="csv",
+    output_layout="merged",
+    patient_features=False,
+    bill_formats_dir=None,
+    use_page_store=True,
+    page_store_path=None,
+    ocr_page_cache=False,
+    ocr_cache_path=None,
+    classification_models=None,
+    extraction_models=None,
+    cascade_confidence=DEFAULT_CONFIDENCE_THRESHOLD,
+    watch=False,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    settle_seconds=DEFAULT_SETTLE_SECONDS,
+    health_port=DEFAULT_HEALTH_PORT,
+    combine_interval=DEFAULT_COMBINE_INTERVAL,
+    shard=None,
+    claim_leases=False,
+    node_id=None,
+    lease_timeout=DEFAULT_LEASE_TIMEOUT,
+    node_cache_dir=None,
+):
     ocr_output_dir = f"{output_dir}/ocr_files"
     split_pdf_dir = f"{output_dir}/split_pdfs"
     extracted_csv_dir = f"{output_dir}/extracted_csv"
 
     start_time = datetime.now()
+    sharded = shard is not None or claim_leases
+    leases = None
+    # SQLite files must not be shared over a network filesystem, so in
+    # sharded runs every node keeps its caches and metrics on its own
+    cache_dir = output_dir
+    if sharded:
+        # Work is handed out per document, which only the streaming pipeline
+        # does
+        streaming = True
+        leases = LeaseManager(
+            os.path.join(output_dir, "leases"), node_id, lease_timeout
+        )
+        cache_dir = node_cache_dir or os.path.join(
+            tempfile.gettempdir(), "document_pipeline", leases.node_id
+        )
+        metrics_dir = metrics_dir or os.path.join(output_dir, "metrics", leases.node_id)
+        print(f"Running as node {leases.node_id}, caches in {cache_dir}")
+    if watch:
+        # The service combines repeatedly, which only the consolidation store
+        # does without rewriting every per-patient file
+        streaming = True
+        incremental_combine = True
+    # OCR'd pages are reused across files and runs by rendered-page hash
+    if ocr_page_cache:
+        ocr_cache_path = ocr_cache_path or os.path.join(cache_dir, "ocr_cache.sqlite")
+    else:
+        ocr_cache_path = None
+    metrics_dir = metrics_dir or os.path.join(output_dir, "metrics")
+    metrics = configure_metrics(
+        profile_stage=profile_stage,
+        profile_path=(
+            os.path.join(metrics_dir, f"profile_{profile_stage}.prof")
+            if profile_stage
+            else None
+        ),
+    )
 
-    generate_ocr_files(input_dir, ocr_output_dir)
-    process_all_pdfs_in_folder(ocr_output_dir, split_pdf_dir)
-    process_and_combine(split_pdf_dir, extracted_csv_dir)
+    if use_cache:
+        configure_cache(
+            os.path.join(cache_dir, "llm_cache.sqlite"),
+            max_size_mb=cache_size_mb,
+            refresh=refresh_cache,
+        )
+
+    # One client, connection pool and rate limiter for classification and
+    # extraction
+    rate_limiter = TokenBucketRateLimiter(requests_per_minute, tokens_per_minute)
+    configure_client(
+        base_url=llm_base_url,
+        max_retries=llm_max_retries,
+        max_connections=llm_max_connections,
+        rate_limiter=rate_limiter,
+    )
+
+    # Every page is parsed from PDF once; classification and extraction read
+    # the texts from the store
+    if use_page_store:
+        configure_page_store(
+            page_store_path or os.path.join(cache_dir, "page_store.sqlite")
+        )
+
+    # Cheaper models answer first; invalid or low-confidence answers move up
+    configure_model_cascade("classify", classification_models, cascade_confidence)
+    configure_model_cascade("extract", extraction_models, cascade_confidence)
+
+    # Invoices in a known bill format are parsed from templates, no API call
+    if bill_formats_dir:
+        configure_bill_formats(bill_formats_dir)
+
+    extractor_options = {
+        "chunk_tokens": extract_chunk_tokens,
+        "chunk_overlap_pages": extract_chunk_overlap,
+        "chunk_workers": extract_chunk_workers,
+        "structured": structured_extraction,
+        "schema_retries": schema_retries,
+        "normalize_text": normalize_text,
+    }
+    output_options = {
+        "output_format": output_format,
+        "output_layout": output_layout,
+        "patient_features": patient_features,
+    }
+
+    # Records finished stages per input file so reruns skip them
+    manifest = Manifest(
+        output_dir,
+        input_dir,
+        {
+            "ocr": ocr_settings(ocr_mode),
+            "split": classification_settings(
+                local_threshold, classify_batch_size, normalize_text, segment_pages
+            ),
+            "extract": extraction_settings(extractor_options, output_options),
+        },
+        force=not resume,
+    )
+
+    classify_options = {
+        "max_workers": classify_workers,
+        "rate_limiter": rate_limiter,
+        "local_threshold": local_threshold,
+        "compare_with_llm": compare_local_with_llm,
+        "batch_size": classify_batch_size,
+        "batch_token_budget": classify_batch_tokens,
+        "normalize_text": normalize_text,
+        "segment_pages": segment_pages,
+    }
+    if streaming:
+        pipeline = StreamingPipeline(
+            ocr_output_dir,
+            split_pdf_dir,
+            extracted_csv_dir,
+            ocr_workers=ocr_workers,
+            total_cores=ocr_cores,
+            ocr_mode=ocr_mode,
+            classify_workers=stream_classify_workers,
+            extract_workers=extract_workers,
+            queue_size=queue_size,
+            classify_options=classify_options,
+            write_split_pdfs=write_split_pdfs,
+            manifest=manifest,
+            extractor_options=extractor_options,
+            output_options=output_options,
+            ocr_cache_path=ocr_cache_path,
+            keep_results=not watch,
+        )
+        # Stages overlap here, so only the whole pipeline is timed as a stage;
+        # per-document stage times are still recorded
+        with metrics.stage("pipeline"):
+            if watch:
+                WatchFolderService(
+                    input_dir,
+                    pipeline,
+                    poll_interval=poll_interval,
+                    settle_seconds=settle_seconds,
+                    health_port=health_port,
+                    combine=lambda: combine_outputs(
+                        output_dir,
+                        extracted_csv_dir,
+                        layout_tables(output_layout, patient_features),
+                        output_format,
+                        incremental_combine,
+                    ),
+                    combine_interval=combine_interval,
+                ).run()
+            elif sharded:
+                run_sharded_pipeline(
+                    input_dir, pipeline, leases, shard, claim_documents=claim_leases
+                )
+            else:
+                run_streaming_pipeline(input_dir, pipeline)
+    elif in_memory:
+        with metrics.stage("ocr"):
+            generate_ocr_files(
+                input_dir,
+                ocr_output_dir,
+                ocr_workers=ocr_workers,
+                total_cores=ocr_cores,
+                ocr_mode=ocr_mode,
+                manifest=manifest,
+                ocr_cache_path=ocr_cache_path,
+            )
+        with metrics.stage("split_extract"):
+            split_and_extract_in_memory(
+                ocr_output_dir,
+                split_pdf_dir,
+                extracted_csv_dir,
+                write_split_pdfs,
+                classify_options,
+                manifest,
+                extractor_options,
+                output_options,
+            )
+    else:
+        with metrics.stage("ocr"):
+            generate_ocr_files(
+                input_dir,
+                ocr_output_dir,
+                ocr_workers=ocr_workers,
+                total_cores=ocr_cores,
+                ocr_mode=ocr_mode,
+                manifest=manifest,
+                ocr_cache_path=ocr_cache_path,
+            )
+        with metrics.stage("classify"):
+            process_all_pdfs_in_folder(
+                ocr_output_dir, split_pdf_dir, manifest=manifest, **classify_options
+            )
+        with metrics.stage("extract"):
+            process_and_combine(
+                split_pdf_dir,
+                extracted_csv_dir,
+                manifest=manifest,
+                extractor_options=extractor_options,
+                output_options=output_options,
+            )
     print(f"Processed data saved to {extracted_csv_dir}")
-    combine_csv_files(extracted_csv_dir, extracted_csv_dir)
+    with metrics.stage("combine"):
+
+        def combine():
+            combine_outputs(
+                output_dir,
+                extracted_csv_dir,
+                layout_tables(output_layout, patient_features),
+                output_format,
+                incremental_combine,
+            )
+
+        if sharded:
+            # Every node's per-patient outputs are merged once, by the last
+            # node to finish
+            combine_once(leases, extracted_csv_dir, combine)
+            leases.close()
+        else:
+            combine()
+    print_normalization_stats()
+    print_extraction_stats()
+    print_bill_format_stats()
+    print_model_cascade_stats()
+    print_page_store_stats()
+    print_cache_stats()
     print(f"Start time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
     end_time = datetime.now()
     print(f"End time: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
     elapsed_time = end_time - start_time
     print(f"Elapsed time: {elapsed_time}")
+    metrics.print_summary()
+    metrics.write(metrics_dir)
 
 
 if __name__ == "__main__":
@@ -46,6 +475,484 @@ if __name__ == "__main__":
         required=True,
         help="The output directory where the extracted.csv files will be stored.",
     )
+    parser.add_argument(
+        "--ocr-workers",
+        type=int,
+        default=1,
+        help="Number of files to OCR concurrently.",
+    )
+    parser.add_argument(
+        "--ocr-cores",
+        type=int,
+        default=None,
+        help="Total cores shared by the OCR workers (defaults to all cores).",
+    )
+    parser.add_argument(
+        "--ocr-mode",
+        choices=["auto", "force"],
+        default="auto",
+        help=(
+            "auto: only OCR pages without a usable text layer. "
+            "force: OCR every page."
+        ),
+    )
+    parser.add_argument(
+        "--classify-workers",
+        type=int,
+        default=4,
+        help="Number of pages classified concurrently.",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        default=500,
+        help="OpenAI request rate limit shared by classification and extraction.",
+    )
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=int,
+        default=200000,
+        help="OpenAI token rate limit shared by classification and extraction.",
+    )
+    parser.add_argument(
+        "--local-threshold",
+        type=float,
+        help=(
+            "Confidence from 0 to 1 at which the local keyword classifier labels a "
+            "page without calling the LLM, e.g. 0.9. Off by default: every page "
+            "goes to the LLM. Check the agreement with --compare-local-with-llm "
+            "before relying on it."
+        ),
+    )
+    parser.add_argument(
+        "--compare-local-with-llm",
+        action="store_true",
+        help=(
+            "Also ask the LLM about locally classified pages and report agreement. "
+            "Needs --local-threshold."
+        ),
+    )
+    parser.add_argument(
+        "--classify-batch-size",
+        type=int,
+        default=1,
+        help="Maximum number of pages of one document sent in a single classification request.",
+    )
+    parser.add_argument(
+        "--classify-batch-tokens",
+        type=int,
+        default=DEFAULT_BATCH_TOKEN_BUDGET,
+        help="Maximum page text tokens in a single batched classification request.",
+    )
+    parser.add_argument(
+        "--classification-models",
+        type=parse_models,
+        default=None,
+        help=(
+            "Comma-separated models for page classification, cheapest first, "
+            "e.g. gpt-4o-mini,gpt-4o. Invalid or low-confidence answers are "
+            "asked again of the next model."
+        ),
+    )
+    parser.add_argument(
+        "--extraction-models",
+        type=parse_models,
+        default=None,
+        help=(
+            "Comma-separated models for extraction, cheapest first. Answers that "
+            "cannot be parsed or validated are extracted again by the next model."
+        ),
+    )
+    parser.add_argument(
+        "--cascade-confidence",
+        type=float,
+        default=DEFAULT_CONFIDENCE_THRESHOLD,
+        help="Confidence from 0 to 1 below which a classification moves up a model.",
+    )
+    parser.add_argument(
+        "--segment-pages",
+        action="store_true",
+        help=(
+            "Split each document into sections from page footers, headers and "
+            "keywords, and classify each section once from its fullest page."
+        ),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not read or write the on-disk LLM response cache.",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Ignore cached LLM responses and overwrite them with fresh ones.",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default=DEFAULT_CACHE_SIZE_MB,
+        help="Size limit of the LLM response cache before old entries are evicted.",
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Pass page texts from the splitter straight to the extractors.",
+    )
+    parser.add_argument(
+        "--write-split-pdfs",
+        action="store_true",
+        help="With --in-memory, still write the per-category split PDFs.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Move each document through OCR, classification and extraction on its "
+            "own, with the stages running concurrently."
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "Run as a service: keep the streaming pipeline running and process "
+            "every PDF written to --input_dir as soon as it is complete. Stops on "
+            "Ctrl+C or SIGTERM after finishing the queued documents."
+        ),
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="With --watch, seconds between scans of the input folder.",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=DEFAULT_SETTLE_SECONDS,
+        help="With --watch, seconds a PDF must stay unchanged before it is queued.",
+    )
+    parser.add_argument(
+        "--health-port",
+        type=int,
+        default=DEFAULT_HEALTH_PORT,
+        help="With --watch, local port for /health and /metrics; 0 disables it.",
+    )
+    parser.add_argument(
+        "--combine-interval",
+        type=float,
+        default=DEFAULT_COMBINE_INTERVAL,
+        help="With --watch, seconds between updates of the combined output.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help=(
+            "Process only shard i of N (e.g. 0/4), chosen by a hash of the file "
+            "name, for running one batch on several nodes."
+        ),
+    )
+    parser.add_argument(
+        "--claim-leases",
+        action="store_true",
+        help=(
+            "Share the batch with other nodes on the same output_dir by claiming "
+            "each document through a lease file under <output_dir>/leases."
+        ),
+    )
+    parser.add_argument(
+        "--node-id",
+        default=None,
+        help="Name of this node in lease files (default: hostname-pid).",
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=DEFAULT_LEASE_TIMEOUT,
+        help="Seconds after which a lease of a node that stopped is taken over.",
+    )
+    parser.add_argument(
+        "--node-cache-dir",
+        default=None,
+        help=(
+            "With --shard or --claim-leases, local directory for this node's "
+            "caches (default: a directory under the system temp dir)."
+        ),
+    )
+    parser.add_argument(
+        "--stream-classify-workers",
+        type=int,
+        default=2,
+        help="With --streaming, number of documents being classified at once.",
+    )
+    parser.add_argument(
+        "--extract-workers",
+        type=int,
+        default=4,
+        help="With --streaming, number of documents being extracted at once.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=8,
+        help="With --streaming, maximum documents waiting between two stages.",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Reprocess every file, even those the manifest records as done.",
+    )
+    parser.add_argument(
+        "--extract-chunk-tokens",
+        type=int,
+        default=None,
+        help=(
+            "Extract invoices and medical reports longer than this many tokens in "
+            "chunks, concurrently."
+        ),
+    )
+    parser.add_argument(
+        "--extract-chunk-overlap",
+        type=int,
+        default=0,
+        help="Pages repeated between neighbouring chunks; repeated line items are dropped.",
+    )
+    parser.add_argument(
+        "--extract-chunk-workers",
+        type=int,
+        default=4,
+        help="Number of chunks of one document extracted at once.",
+    )
+    parser.add_argument(
+        "--structured-extraction",
+        action="store_true",
+        help=(
+            "Extract invoices and medical reports as schema-validated JSON "
+            "instead of repairing CSV text."
+        ),
+    )
+    parser.add_argument(
+        "--schema-retries",
+        type=int,
+        default=2,
+        help="Times a response that fails schema validation is requested again.",
+    )
+    parser.add_argument(
+        "--llm-base-url",
+        default=None,
+        help=(
+            "OpenAI-compatible API base URL, e.g. a local test server "
+            "(default: OPENAI_BASE_URL or the OpenAI API)."
+        ),
+    )
+    parser.add_argument(
+        "--llm-max-retries",
+        type=int,
+        default=DEFAULT_MAX_RETRIES,
+        help="Retries of a rate-limited or failed API request before the document fails.",
+    )
+    parser.add_argument(
+        "--llm-max-connections",
+        type=int,
+        default=DEFAULT_MAX_CONNECTIONS,
+        help="Size of the shared keep-alive connection pool to the API.",
+    )
+    parser.add_argument(
+        "--no-normalize-text",
+        action="store_true",
+        help=(
+            "Send page text to the API as extracted, without collapsing whitespace "
+            "or removing repeated headers, footers and noise lines."
+        ),
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        default=None,
+        help=(
+            "Where the JSON run report and Prometheus textfile are written "
+            "(default: <output_dir>/metrics)."
+        ),
+    )
+    parser.add_argument(
+        "--profile-stage",
+        choices=PROFILE_STAGES,
+        default=None,
+        help=(
+            "Run this stage under cProfile and save the profile in the metrics "
+            "directory: pipeline or combine with --streaming, --watch, --shard or "
+            "--claim-leases; ocr, split_extract or combine with --in-memory; "
+            "otherwise ocr, classify, extract or combine."
+        ),
+    )
+    parser.add_argument(
+        "--incremental-combine",
+        action="store_true",
+        help=(
+            "Add only new or changed patient CSVs to <output_dir>/consolidated.sqlite "
+            "and export it to one combined CSV, instead of re-reading every CSV. "
+            "Not available with --shard or --claim-leases."
+        ),
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help=(
+            "Write extracted data as CSV, as a Parquet dataset partitioned by "
+            "extraction date (typed, with dictionary-encoded categorical "
+            "columns), or both."
+        ),
+    )
+    parser.add_argument(
+        "--output-layout",
+        choices=OUTPUT_LAYOUTS,
+        default="merged",
+        help=(
+            "merged: one table with every invoice line joined to every diagnosis "
+            "of the patient. normalized: separate line_items and diagnoses tables "
+            "keyed by patient_id, growing with the extracted facts."
+        ),
+    )
+    parser.add_argument(
+        "--patient-features",
+        action="store_true",
+        help=(
+            "Also write a patient_features table: total quantity and line count "
+            "per drug/service, crossed with the patient's diagnosis types."
+        ),
+    )
+    parser.add_argument(
+        "--bill-formats",
+        default=None,
+        help=(
+            "Directory of bill format templates (see bill_format.py). Invoices in "
+            "a known format are parsed from the page layout without an API call; "
+            "others go to ChatGPT."
+        ),
+    )
+    parser.add_argument(
+        "--page-store",
+        default=None,
+        help=(
+            "SQLite page-text store, e.g. one filled by pdf_extractor.py "
+            "(default <output_dir>/page_store.sqlite). With --shard or "
+            "--claim-leases the default is page_store.sqlite in the node's "
+            "--node-cache-dir, which is new for every run unless that or "
+            "--node-id is set; a path given here must be on a local disk."
+        ),
+    )
+    parser.add_argument(
+        "--no-page-store",
+        action="store_true",
+        help="Parse page text from the PDFs every time.",
+    )
+    parser.add_argument(
+        "--ocr-page-cache",
+        action="store_true",
+        help=(
+            "OCR page by page, reusing the OCR of pages already seen in any file "
+            "(matched by a hash of the rendered page, in --ocr-cache-path). Only "
+            "new pages go to Tesseract."
+        ),
+    )
+    parser.add_argument(
+        "--ocr-cache-path",
+        default=None,
+        help=(
+            "SQLite OCR page cache for --ocr-page-cache (default "
+            "<output_dir>/ocr_cache.sqlite). With --shard or --claim-leases the "
+            "default is ocr_cache.sqlite in the node's --node-cache-dir, which is "
+            "new for every run unless that or --node-id is set; point this at a "
+            "persistent path on the node's local disk to keep the cache."
+        ),
+    )
     args = parser.parse_args()
+    if args.watch and (args.shard is not None or args.claim_leases):
+        parser.error("--watch cannot be combined with --shard or --claim-leases")
+    streaming = (
+        args.streaming or args.watch or args.shard is not None or args.claim_leases
+    )
+    stages = profiled_stages(streaming, args.in_memory)
+    if args.profile_stage and args.profile_stage not in stages:
+        # The stages of the other modes never run on their own in this one
+        parser.error(
+            f"--profile-stage {args.profile_stage} is not a stage of this run; "
+            f"choose one of {', '.join(stages)}"
+        )
+    if args.incremental_combine and (args.shard is not None or args.claim_leases):
+        # The consolidated store is SQLite with a write-ahead log, which must
+        # not live in the output directory the nodes share over NFS
+        parser.error(
+            "--incremental-combine cannot be combined with --shard or --claim-leases"
+        )
+    if args.compare_local_with_llm and args.local_threshold is None:
+        parser.error("--compare-local-with-llm needs --local-threshold")
+    if args.ocr_cache_path and not args.ocr_page_cache:
+        parser.error("--ocr-cache-path needs --ocr-page-cache")
+    if args.claim_leases and args.no_resume:
+        # Nodes tell the documents another node finished from the manifest,
+        # which --no-resume ignores, so every node would redo the whole batch
+        parser.error(
+            "--no-resume cannot be combined with --claim-leases; remove "
+            "<output_dir>/manifest to reprocess everything"
+        )
 
-    main(args.input_dir, args.output_dir)
+    main(
+        args.input_dir,
+        args.output_dir,
+        ocr_workers=args.ocr_workers,
+        ocr_cores=args.ocr_cores,
+        ocr_mode=args.ocr_mode,
+        classify_workers=args.classify_workers,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        local_threshold=args.local_threshold,
+        compare_local_with_llm=args.compare_local_with_llm,
+        classify_batch_size=args.classify_batch_size,
+        classify_batch_tokens=args.classify_batch_tokens,
+        segment_pages=args.segment_pages,
+        use_cache=not args.no_cache,
+        refresh_cache=args.refresh_cache,
+        cache_size_mb=args.cache_size_mb,
+        in_memory=args.in_memory,
+        write_split_pdfs=args.write_split_pdfs,
+        streaming=args.streaming,
+        stream_classify_workers=args.stream_classify_workers,
+        extract_workers=args.extract_workers,
+        queue_size=args.queue_size,
+        resume=not args.no_resume,
+        extract_chunk_tokens=args.extract_chunk_tokens,
+        extract_chunk_overlap=args.extract_chunk_overlap,
+        extract_chunk_workers=args.extract_chunk_workers,
+        structured_extraction=args.structured_extraction,
+        schema_retries=args.schema_retries,
+        llm_base_url=args.llm_base_url,
+        llm_max_retries=args.llm_max_retries,
+        llm_max_connections=args.llm_max_connections,
+        normalize_text=not args.no_normalize_text,
+        metrics_dir=args.metrics_dir,
+        profile_stage=args.profile_stage,
+        incremental_combine=args.incremental_combine,
+        output_format=args.output_format,
+        output_layout=args.output_layout,
+        patient_features=args.patient_features,
+        bill_formats_dir=args.bill_formats,
+        use_page_store=not args.no_page_store,
+        page_store_path=args.page_store,
+        ocr_page_cache=args.ocr_page_cache,
+        ocr_cache_path=args.ocr_cache_path,
+        classification_models=args.classification_models,
+        extraction_models=args.extraction_models,
+        cascade_confidence=args.cascade_confidence,
+        watch=args.watch,
+        poll_interval=args.poll_interval,
+        settle_seconds=args.settle_seconds,
+        health_port=args.health_port,
+        combine_interval=args.combine_interval,
+        shard=args.shard,
+        claim_leases=args.claim_leases,
+        node_id=args.node_id,
+        lease_timeout=args.lease_timeout,
+        node_cache_dir=args.node_cache_dir,
+    )
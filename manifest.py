@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+# Stages in pipeline order; a stage's fingerprint covers its own settings and
+# those of every stage before it, so changing OCR settings also redoes the
+# classification and extraction of that document
+STAGES = ("ocr", "split", "extract")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def settings_fingerprint(settings):
+    payload = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    # Records, per input document, its content hash and which stages are done
+    # with which outputs. Each document has its own small JSON file under
+    # <output_dir>/manifest, written atomically, so large batches never rewrite
+    # one big file and an interrupted run loses at most the document in flight.
+    def __init__(self, output_dir, input_dir, stage_settings, force=False):
+        self.directory = os.path.join(output_dir, "manifest")
+        self.input_dir = input_dir
+        # With force nothing counts as done, but progress is still recorded
+        self.force = force
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.fingerprints = {}
+        upstream = {}
+        for stage in STAGES:
+            upstream[stage] = stage_settings.get(stage, {})
+            self.fingerprints[stage] = settings_fingerprint(upstream)
+
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _record_path(self, filename):
+        return os.path.join(self.directory, f"{filename}.json")
+
+    def _load(self, filename):
+        try:
+            with open(self._record_path(filename)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, filename, record):
+        path = self._record_path(filename)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(record, f, indent=2)
+        os.replace(temp_path, path)
+
+    def content_hash(self, filename):
+        # Hashing 2,000 PDFs on every run is slow, so the hash stored in the
+        # record is reused while the file's size and mtime are unchanged
+        with self._lock:
+            if filename in self._hashes:
+                return self._hashes[filename]
+        try:
+            stat = os.stat(os.path.join(self.input_dir, filename))
+        except FileNotFoundError:
+            # Left over from an input that is no longer there
+            return None
+        stored = self._load(filename).get("input", {})
+        if stored.get("size") == stat.st_size and stored.get("mtime") == stat.st_mtime:
+            sha256 = stored["sha256"]
+        else:
+            sha256 = file_sha256(os.path.join(self.input_dir, filename))
+        with self._lock:
+            self._hashes[filename] = sha256
+        return sha256
+
+    def forget_hash(self, filename):
+        # For a file replaced under the same name while the process runs
+        with self._lock:
+            self._hashes.pop(filename, None)
+
+    def is_done(self, filename, stage):
+        if self.force:
+            return False
+        sha256 = self.content_hash(filename)
+        record = self._load(filename)
+        if sha256 is None or record.get("input", {}).get("sha256") != sha256:
+            return False
+        for current in STAGES[: STAGES.index(stage) + 1]:
+            entry = record.get("stages", {}).get(current)
+            if entry is None or entry["fingerprint"] != self.fingerprints[current]:
+                return False
+        entry = record["stages"][stage]
+        return all(os.path.exists(output) for output in entry["outputs"])
+
+    def mark_done(self, filename, stage, outputs=()):
+        sha256 = self.content_hash(filename)
+        if sha256 is None:
+            return
+        stat = os.stat(os.path.join(self.input_dir, filename))
+        with self._lock:
+            record = self._load(filename)
+            if record.get("input", {}).get("sha256") != sha256:
+                record = {"stages": {}}
+            record["input"] = {
+                "sha256": sha256,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            stages = record.setdefault("stages", {})
+            # Redoing a stage makes everything downstream of it stale
+            for later in STAGES[STAGES.index(stage) + 1 :]:
+                stages.pop(later, None)
+            stages[stage] = {
+                "fingerprint": self.fingerprints[stage],
+                "outputs": list(outputs),
+                "completed": datetime.now().isoformat(timespec="seconds"),
+            }
+            self._save(filename, record)
+
+    def pending(self, filenames, stage):
+        return [filename for filename in filenames if not self.is_done(filename, stage)]
@@ -0,0 +1,342 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+METRIC_PREFIX = "document_pipeline"
+PROFILE_STAGES = ("ocr", "classify", "extract", "split_extract", "pipeline", "combine")
+
+# Document and stage the current thread is working on, so API calls made deep
+# inside classification or extraction are attributed without passing them down
+current_document = contextvars.ContextVar("current_document", default=None)
+current_stage = contextvars.ContextVar("current_stage", default=None)
+# (tokens before, tokens after) normalization of the pages last normalized in
+# this context, keyed by their normalized text, so each API call can report
+# what normalization saved on the text it sends
+current_normalized_pages = contextvars.ContextVar(
+    "current_normalized_pages", default=None
+)
+
+
+def bind_context(function):
+    # Thread pools do not carry context variables over to their workers; wrap
+    # the function given to executor.map/submit so each task runs in a copy of
+    # the caller's context
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+def normalization_tokens(messages):
+    # Tokens of the normalized pages sent in messages, before and after
+    # normalization
+    pages = current_normalized_pages.get()
+    if not pages:
+        return 0, 0
+    prompt = "\n".join(message["content"] for message in messages)
+    before = after = 0
+    for text, (text_before, text_after) in pages.items():
+        if text in prompt:
+            before += text_before
+            after += text_after
+    return before, after
+
+
+def new_api_totals():
+    return {
+        "calls": 0,
+        "cache_hits": 0,
+        "retries": 0,
+        "failures": 0,
+        "default_answers": 0,
+        "latency_seconds": 0.0,
+        "max_latency_seconds": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "normalization_tokens_before": 0,
+        "normalization_tokens_after": 0,
+    }
+
+
+class Metrics:
+    # Collects wall time per stage and per document, and latency, token usage,
+    # retries and cache hits per API call, for one run of main.py
+    def __init__(self):
+        self.started = datetime.now()
+        self.stage_seconds = defaultdict(float)
+        self.document_seconds = defaultdict(lambda: defaultdict(float))
+        self.api = defaultdict(new_api_totals)
+        self.document_api = defaultdict(new_api_totals)
+        self.profile_stage = None
+        self.profile_path = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        # Wall time of one phase of the run, profiled if it is the chosen stage
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        stage_token = current_stage.set(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            current_stage.reset(stage_token)
+            with self._lock:
+                self.stage_seconds[name] += elapsed
+            if profiler is not None:
+                profiler.disable()
+                self._save_profile(name, profiler)
+
+    @contextmanager
+    def document_stage(self, document, stage):
+        document_token = current_document.set(document)
+        stage_token = current_stage.set(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            current_stage.reset(stage_token)
+            current_document.reset(document_token)
+            self.record_document_time(document, stage, elapsed)
+
+    def record_document_time(self, document, stage, seconds):
+        with self._lock:
+            self.document_seconds[document][stage] += seconds
+
+    def _api_keys(self, model):
+        stage = current_stage.get() or "unknown"
+        return (stage, model), current_document.get()
+
+    def record_api_call(
+        self,
+        model,
+        latency,
+        prompt_tokens=0,
+        completion_tokens=0,
+        retries=0,
+        failed=False,
+        normalization_tokens=(0, 0),
+    ):
+        key, document = self._api_keys(model)
+        with self._lock:
+            totals = [self.api[key]]
+            if document is not None:
+                totals.append(self.document_api[document])
+            for total in totals:
+                total["calls"] += 1
+                total["retries"] += retries
+                total["failures"] += int(failed)
+                total["latency_seconds"] += latency
+                total["max_latency_seconds"] = max(
+                    total["max_latency_seconds"], latency
+                )
+                total["prompt_tokens"] += prompt_tokens or 0
+                total["completion_tokens"] += completion_tokens or 0
+                total["normalization_tokens_before"] += normalization_tokens[0]
+                total["normalization_tokens_after"] += normalization_tokens[1]
+
+    def record_cache_hit(self, model):
+        key, document = self._api_keys(model)
+        with self._lock:
+            self.api[key]["cache_hits"] += 1
+            if document is not None:
+                self.document_api[document]["cache_hits"] += 1
+
+    def record_default_answer(self, model):
+        # No answer could be parsed and the caller fell back to a default
+        key, document = self._api_keys(model)
+        with self._lock:
+            self.api[key]["default_answers"] += 1
+            if document is not None:
+                self.document_api[document]["default_answers"] += 1
+
+    def _save_profile(self, name, profiler):
+        if self.profile_path:
+            os.makedirs(os.path.dirname(self.profile_path) or ".", exist_ok=True)
+            profiler.dump_stats(self.profile_path)
+            print(f"Profile of the {name} stage saved to {self.profile_path}")
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+        print(output.getvalue())
+
+    def report(self):
+        with self._lock:
+            finished = datetime.now()
+            documents = {}
+            for document in sorted(set(self.document_seconds) | set(self.document_api)):
+                documents[document] = {
+                    "stage_seconds": dict(self.document_seconds.get(document, {})),
+                    "api": dict(self.document_api.get(document, new_api_totals())),
+                }
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "finished": finished.isoformat(timespec="seconds"),
+                "elapsed_seconds": (finished - self.started).total_seconds(),
+                "stage_seconds": dict(self.stage_seconds),
+                "api": [
+                    {"stage": stage, "model": model, **totals}
+                    for (stage, model), totals in sorted(self.api.items())
+                ],
+                "documents": documents,
+            }
+
+    def prometheus_lines(self, report):
+        # Prometheus text exposition format, for node_exporter's textfile
+        # collector
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{label}="{label_value}"' for label, label_value in labels.items()
+                )
+                if label_text:
+                    label_text = f"{{{label_text}}}"
+                lines.append(f"{METRIC_PREFIX}_{name}{label_text} {value}")
+
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "Unix time the last run finished.",
+            [({}, int(time.time()))],
+        )
+        metric(
+            "run_duration_seconds",
+            "gauge",
+            "Wall time of the last run.",
+            [({}, report["elapsed_seconds"])],
+        )
+        metric(
+            "stage_duration_seconds",
+            "gauge",
+            "Wall time of each stage in the last run.",
+            [
+                ({"stage": stage}, seconds)
+                for stage, seconds in report["stage_seconds"].items()
+            ],
+        )
+
+        document_stage_seconds = defaultdict(list)
+        for document in report["documents"].values():
+            for stage, seconds in document["stage_seconds"].items():
+                document_stage_seconds[stage].append(seconds)
+        metric(
+            "documents_processed",
+            "gauge",
+            "Documents that went through each stage in the last run.",
+            [
+                ({"stage": stage}, len(times))
+                for stage, times in document_stage_seconds.items()
+            ],
+        )
+        metric(
+            "document_stage_max_seconds",
+            "gauge",
+            "Slowest document in each stage in the last run.",
+            [
+                ({"stage": stage}, max(times))
+                for stage, times in document_stage_seconds.items()
+            ],
+        )
+
+        api_metrics = [
+            ("api_calls", "calls", "API requests sent (cache misses)."),
+            ("api_cache_hits", "cache_hits", "Answers served from the LLM cache."),
+            ("api_retries", "retries", "Retried API requests."),
+            ("api_failures", "failures", "API requests that failed after retries."),
+            (
+                "api_default_answers",
+                "default_answers",
+                "Unparseable answers replaced by a default.",
+            ),
+            ("api_latency_seconds", "latency_seconds", "Total API latency."),
+            ("api_prompt_tokens", "prompt_tokens", "Prompt tokens used."),
+            ("api_completion_tokens", "completion_tokens", "Completion tokens used."),
+            (
+                "api_normalization_tokens_before",
+                "normalization_tokens_before",
+                "Estimated tokens of the page text sent, before normalization.",
+            ),
+            (
+                "api_normalization_tokens_after",
+                "normalization_tokens_after",
+                "Estimated tokens of the same page text after normalization.",
+            ),
+        ]
+        for name, field, help_text in api_metrics:
+            metric(
+                name,
+                "gauge",
+                f"{help_text} Last run.",
+                [
+                    ({"stage": entry["stage"], "model": entry["model"]}, entry[field])
+                    for entry in report["api"]
+                ],
+            )
+        return lines
+
+    def write(self, metrics_dir):
+        os.makedirs(metrics_dir, exist_ok=True)
+        report = self.report()
+        report_path = os.path.join(
+            metrics_dir, f"run_{self.started.strftime('%Y%m%d_%H%M%S')}.json"
+        )
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        # Written under a temporary name and renamed, so the textfile collector
+        # never reads a half-written file
+        prometheus_path = os.path.join(metrics_dir, f"{METRIC_PREFIX}.prom")
+        temp_path = f"{prometheus_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write("\n".join(self.prometheus_lines(report)) + "\n")
+        os.replace(temp_path, prometheus_path)
+        print(f"Metrics saved to {report_path} and {prometheus_path}")
+        return report_path, prometheus_path
+
+    def print_summary(self):
+        report = self.report()
+        for stage, seconds in report["stage_seconds"].items():
+            print(f"Stage {stage}: {seconds:.1f}s")
+        for entry in report["api"]:
+            average = entry["latency_seconds"] / entry["calls"] if entry["calls"] else 0
+            print(
+                f"API {entry['stage']} ({entry['model']}): {entry['calls']} calls, "
+                f"{entry['cache_hits']} cache hits, {entry['retries']} retries, "
+                f"{average:.2f}s average latency, "
+                f"{entry['prompt_tokens']} prompt / "
+                f"{entry['completion_tokens']} completion tokens"
+            )
+
+
+# Module-level metrics for the run, set up by main.py
+_metrics = Metrics()
+
+
+def configure_metrics(profile_stage=None, profile_path=None):
+    global _metrics
+    _metrics = Metrics()
+    _metrics.profile_stage = profile_stage
+    _metrics.profile_path = profile_path
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import Counter
+
+# An answer from a cheaper tier is kept unless it is invalid or its
+# confidence, from 0 to 1, is below this
+DEFAULT_CONFIDENCE_THRESHOLD = 0.8
+CASCADE_TASKS = ("classify", "extract")
+
+
+class ModelCascade:
+    # Models tried in order, cheapest first. Only invalid or low-confidence
+    # answers move up to the next tier; the last tier's answer is final.
+    def __init__(self, task, models, confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD):
+        self.task = task
+        self.models = tuple(models)
+        self.confidence_threshold = confidence_threshold
+
+    @property
+    def first_model(self):
+        return self.models[0]
+
+    def run(self, ask):
+        # ask(model, score) returns (answer, confidence), with answer None when
+        # it is invalid. score is False on the last tier, where the confidence
+        # is not needed (so e.g. no logprobs have to be requested). Returns the
+        # accepted answer, or the first valid one if no tier gave a usable
+        # answer, or None.
+        fallback = None
+        for tier, model in enumerate(self.models):
+            last = tier == len(self.models) - 1
+            start = time.perf_counter()
+            answer, confidence = ask(model, not last)
+            record_cascade_stat(self.task, model, "calls")
+            record_cascade_stat(
+                self.task, model, "seconds", time.perf_counter() - start
+            )
+            if answer is None:
+                record_cascade_stat(self.task, model, "invalid")
+                continue
+            if (
+                not last
+                and confidence is not None
+                and confidence < self.confidence_threshold
+            ):
+                record_cascade_stat(self.task, model, "low_confidence")
+                if fallback is None:
+                    fallback = answer
+                continue
+            record_cascade_stat(self.task, model, "accepted")
+            return answer
+        return fallback
+
+    def settings(self):
+        # None for a single model, so runs without a cascade keep their
+        # manifests valid
+        if len(self.models) == 1:
+            return None
+        return {
+            "models": list(self.models),
+            "confidence_threshold": self.confidence_threshold,
+        }
+
+
+# Calls, answers and seconds per (task, model, field)
+cascade_stats = Counter()
+_cascade_stats_lock = threading.Lock()
+
+
+def record_cascade_stat(task, model, field, count=1):
+    with _cascade_stats_lock:
+        cascade_stats[(task, model, field)] += count
+
+
+# Module-level cascades, set up by main.py; a task without one uses the
+# caller's default model alone
+_cascades = {}
+
+
+def configure_model_cascade(
+    task, models, confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD
+):
+    if models:
+        _cascades[task] = ModelCascade(task, models, confidence_threshold)
+    else:
+        _cascades.pop(task, None)
+    return _cascades.get(task)
+
+
+def get_model_cascade(task, default_model):
+    cascade = _cascades.get(task)
+    if cascade is None:
+        return ModelCascade(task, (default_model,))
+    return cascade
+
+
+def parse_models(value):
+    # Comma-separated model names from the command line, cheapest first
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+def print_model_cascade_stats():
+    with _cascade_stats_lock:
+        stats = Counter(cascade_stats)
+    for task in CASCADE_TASKS:
+        cascade = _cascades.get(task)
+        if cascade is None or len(cascade.models) == 1:
+            continue
+        for model in cascade.models:
+            calls = stats[(task, model, "calls")]
+            average = stats[(task, model, "seconds")] / calls if calls else 0
+            print(
+                f"Model cascade {task} ({model}): {calls} calls, "
+                f"{stats[(task, model, 'accepted')]} accepted, "
+                f"{stats[(task, model, 'low_confidence')]} low confidence, "
+                f"{stats[(task, model, 'invalid')]} invalid, "
+                f"{average:.2f}s average latency"
+            )
@@ -1,13 +1,246 @@
 import logging
 import os
+import re
+import shutil
 import subprocess
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from ctypes.util import find_library
 
+import fitz  # PyMuPDF for the text layer pre-scan
+
+from metrics import get_metrics
+from ocr_cache import ocr_pages_with_cache
+
 find_library("gs")
 
+# A page needs OCR when its text layer is shorter than this many characters...
+MIN_TEXT_CHARS = 50
+# ...or when fewer than this share of its words look like real words
+MIN_TEXT_QUALITY = 0.6
+# Scanned pages are mostly image; a little digital text (a stamp, a header)
+# on such a page does not make it born-digital
+SCANNED_IMAGE_COVERAGE = 0.6
+SCANNED_MAX_TEXT_CHARS = 300
+
+OCR_COMMAND = ["ocrmypdf", "--deskew", "--force-ocr"]
+
+WORD_PATTERN = re.compile(
+    r"^[A-Za-z][a-z'\-]*[a-z]$|^[A-Z]{2,}$|^[A-Za-z]$|^[\d$%.,/:\-]+$"
+)
+
+
+def plan_core_budget(file_count, ocr_workers=1, total_cores=None):
+    # Split the total core budget between files processed concurrently and
+    # ocrmypdf's own per-file --jobs, so the two never oversubscribe the machine
+    total_cores = max(1, total_cores or os.cpu_count() or 1)
+    workers = max(1, min(ocr_workers, file_count or 1, total_cores))
+    jobs_per_file = max(1, total_cores // workers)
+    return workers, jobs_per_file
+
+
+def ocr_output_filename(filename):
+    return filename.replace(".pdf", "_ocr_test.pdf")
+
+
+def source_filename(ocr_filename):
+    # Inverse of ocr_output_filename
+    return ocr_filename.replace("_ocr_test.pdf", ".pdf")
+
 
-def generate_ocr_files(input_folder_path, output_folder_path):
+# Settings that change the OCR output, used to invalidate resumed runs
+def ocr_settings(ocr_mode):
+    return {
+        "command": " ".join(OCR_COMMAND),
+        "mode": ocr_mode,
+        "min_text_chars": MIN_TEXT_CHARS,
+        "min_text_quality": MIN_TEXT_QUALITY,
+    }
+
+
+def text_quality(text):
+    # Share of tokens that look like words or numbers; OCR garbage and broken
+    # font encodings score low
+    tokens = re.findall(r"\S+", text)
+    if not tokens:
+        return 0.0
+    if "\ufffd" in text:
+        return 0.0
+    valid = sum(
+        1 for token in tokens if WORD_PATTERN.match(token.strip(".,;:()[]\"'!?"))
+    )
+    return valid / len(tokens)
+
+
+def scan_text_layer(pdf_path):
+    # Measure text layer coverage and quality of every page with PyMuPDF
+    pages = []
+    with fitz.open(pdf_path) as pdf_document:
+        for page in pdf_document:
+            text = page.get_text()
+            chars = len("".join(text.split()))
+            page_area = abs(page.rect) or 1
+            image_area = sum(
+                abs(fitz.Rect(image["bbox"]) & page.rect)
+                for image in page.get_image_info()
+            )
+            image_coverage = min(1.0, image_area / page_area)
+            quality = text_quality(text)
+            needs_ocr = (
+                chars < MIN_TEXT_CHARS
+                or quality < MIN_TEXT_QUALITY
+                or (
+                    image_coverage >= SCANNED_IMAGE_COVERAGE
+                    and chars < SCANNED_MAX_TEXT_CHARS
+                )
+            )
+            pages.append(
+                {
+                    "page": page.number + 1,
+                    "chars": chars,
+                    "quality": round(quality, 3),
+                    "image_coverage": round(image_coverage, 3),
+                    "needs_ocr": needs_ocr,
+                }
+            )
+    return pages
+
+
+def ocr_single_file(
+    input_filename, output_filename, jobs=None, ocr_mode="auto", ocr_cache_path=None
+):
+    # ocr_mode "force" OCRs every page. "auto" pre-scans the text layer and
+    # only OCRs image-only or low-quality pages; born-digital pages pass
+    # through untouched, and a fully born-digital file is just copied.
+    # With ocr_cache_path, pages whose rendered image was OCR'd before (in
+    # any file) are taken from the page cache and only new pages are OCR'd.
+    result = {
+        "filename": os.path.basename(input_filename),
+        "output": output_filename,
+        "status": "ok",
+        "jobs": jobs,
+        "pages": None,
+        "ocr_pages": None,
+        "skipped_pages": 0,
+        "cached_pages": 0,
+        "elapsed": 0.0,
+        "error": None,
+    }
+    start = time.perf_counter()
+
+    pages_to_ocr = None
+    if ocr_mode == "auto":
+        try:
+            scan = scan_text_layer(input_filename)
+        except Exception as e:
+            print(f"Error scanning text layer of {input_filename}, forcing OCR: {e}")
+        else:
+            pages_to_ocr = [page["page"] for page in scan if page["needs_ocr"]]
+            result["pages"] = len(scan)
+            result["ocr_pages"] = len(pages_to_ocr)
+            result["skipped_pages"] = len(scan) - len(pages_to_ocr)
+
+            if not pages_to_ocr:
+                shutil.copyfile(input_filename, output_filename)
+                result["elapsed"] = time.perf_counter() - start
+                return result
+            if len(pages_to_ocr) == len(scan):
+                pages_to_ocr = None
+
+    command = list(OCR_COMMAND)
+    if jobs:
+        command += ["--jobs", str(jobs)]
+
+    def run_ocr(source_path, target_path, pages=None):
+        page_options = []
+        if pages:
+            page_options = ["--pages", ",".join(str(page) for page in pages)]
+        # Output is captured so concurrent runs do not interleave on the terminal
+        subprocess.run(
+            command + page_options + [source_path, target_path],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+    try:
+        if ocr_cache_path:
+            result["cached_pages"] = ocr_pages_with_cache(
+                input_filename,
+                output_filename,
+                pages_to_ocr,
+                ocr_cache_path,
+                run_ocr,
+                " ".join(OCR_COMMAND),
+            )
+        else:
+            run_ocr(input_filename, output_filename, pages_to_ocr)
+    except subprocess.CalledProcessError as e:
+        stderr_lines = (e.stderr or "").strip().splitlines()
+        result["status"] = "failed"
+        result["error"] = stderr_lines[-1] if stderr_lines else str(e)
+    except OSError as e:
+        # ocrmypdf is not installed or not on PATH
+        result["status"] = "failed"
+        result["error"] = str(e)
+    except RuntimeError as e:
+        # PyMuPDF could not read or write a file of the page cache path
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def record_ocr_result(manifest, result):
+    # OCR runs in worker processes, so its timing is recorded from the result
+    get_metrics().record_document_time(result["filename"], "ocr", result["elapsed"])
+    if manifest is not None and result["status"] == "ok":
+        manifest.mark_done(result["filename"], "ocr", [result["output"]])
+
+
+def print_ocr_summary(results):
+    succeeded = [r for r in results if r["status"] == "ok"]
+    failed = [r for r in results if r["status"] != "ok"]
+    total_elapsed = sum(r["elapsed"] for r in results)
+
+    print("OCR summary:")
+    for r in sorted(results, key=lambda r: r["filename"]):
+        line = f"  {r['status']:<6} {r['elapsed']:8.1f}s  {r['filename']}"
+        if r["pages"] is not None:
+            line += f"  [{r['ocr_pages']}/{r['pages']} pages OCR'd]"
+        if r["cached_pages"]:
+            line += f"  [{r['cached_pages']} from the OCR page cache]"
+        if r["error"]:
+            line += f"  ({r['error']})"
+        print(line)
+    print(
+        f"  {len(succeeded)} succeeded, {len(failed)} failed, "
+        f"{total_elapsed:.1f}s of OCR time across {len(results)} files"
+    )
+
+    scanned = [r for r in succeeded if r["pages"] is not None]
+    if scanned:
+        total_pages = sum(r["pages"] for r in scanned)
+        skipped_pages = sum(r["skipped_pages"] for r in scanned)
+        print(
+            f"  Skipped OCR on {skipped_pages} of {total_pages} pages "
+            f"that already had a good text layer"
+        )
+    cached_pages = sum(r["cached_pages"] for r in succeeded)
+    if cached_pages:
+        print(f"  Reused cached OCR for {cached_pages} pages")
+
+
+def generate_ocr_files(
+    input_folder_path,
+    output_folder_path,
+    ocr_workers=1,
+    total_cores=None,
+    ocr_mode="auto",
+    manifest=None,
+    ocr_cache_path=None,
+):
     os.makedirs(output_folder_path, exist_ok=True)
 
     file_list = []
@@ -16,25 +249,53 @@ def generate_ocr_files(input_folder_path, output_folder_path):
         if filename.endswith("pdf"):
             file_list.append(filename)
 
+    if manifest is not None:
+        pending = manifest.pending(file_list, "ocr")
+        if len(pending) < len(file_list):
+            print(f"Skipping {len(file_list) - len(pending)} files already OCR'd")
+        file_list = pending
+
+    workers, jobs_per_file = plan_core_budget(len(file_list), ocr_workers, total_cores)
+    print(
+        f"Running OCR on {len(file_list)} files with {workers} worker(s), "
+        f"{jobs_per_file} ocrmypdf job(s) each"
+    )
+
+    tasks = []
     for filename in file_list:
-        print("Converting:", filename)
         input_filename = os.path.join(input_folder_path, filename)
         output_filename = os.path.join(
-            output_folder_path, filename.replace(".pdf", "_ocr_test.pdf")
+            output_folder_path, ocr_output_filename(filename)
         )
+        tasks.append((input_filename, output_filename))
 
-        # Use subprocess to call ocrmypdf
-        try:
-            subprocess.run(
-                [
-                    "ocrmypdf",
-                    "--deskew",
-                    "--force-ocr",
+    results = []
+    if workers == 1:
+        for input_filename, output_filename in tasks:
+            print("Converting:", os.path.basename(input_filename))
+            result = ocr_single_file(
+                input_filename, output_filename, jobs_per_file, ocr_mode, ocr_cache_path
+            )
+            record_ocr_result(manifest, result)
+            results.append(result)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    ocr_single_file,
                     input_filename,
                     output_filename,
-                ],
-                check=True,
-            )
-            print(f"Successfully processed: {filename}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error processing {filename}: {e}")
+                    jobs_per_file,
+                    ocr_mode,
+                    ocr_cache_path,
+                )
+                for input_filename, output_filename in tasks
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"Converted: {result['filename']} ({result['status']})")
+                record_ocr_result(manifest, result)
+                results.append(result)
+
+    print_ocr_summary(results)
+    return results
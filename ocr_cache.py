@@ -0,0 +1,171 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+import fitz  # PyMuPDF
+
+DEFAULT_OCR_CACHE_SIZE_MB = 2048
+# Pages are rendered at this resolution, in grayscale, to be hashed
+PAGE_HASH_DPI = 100
+
+
+def page_image_hash(page, settings_key=""):
+    # Exact hash of the rendered page. Two files holding the same scan get the
+    # same hash even when their PDF bytes differ. A perceptual hash is not used:
+    # guarantee letters from one insurer template differ only in names and
+    # amounts, and would wrongly share their OCR text.
+    pixmap = page.get_pixmap(dpi=PAGE_HASH_DPI, colorspace=fitz.csGRAY)
+    digest = hashlib.sha256(settings_key.encode("utf-8"))
+    digest.update(f"{pixmap.width}x{pixmap.height}".encode("ascii"))
+    digest.update(pixmap.samples)
+    return digest.hexdigest()
+
+
+class OCRPageCache:
+    # OCR'd pages (image plus text layer, as a one-page PDF) keyed by the hash
+    # of the rendered page. Opened separately by every OCR worker process;
+    # SQLite's WAL mode lets them share the file.
+    def __init__(self, path, max_size_mb=DEFAULT_OCR_CACHE_SIZE_MB):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_pages ("
+            "key TEXT PRIMARY KEY, page_pdf BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS ocr_pages_last_access "
+            "ON ocr_pages (last_access)"
+        )
+        self._connection.commit()
+
+    def get(self, key):
+        row = self._connection.execute(
+            "SELECT page_pdf FROM ocr_pages WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._connection.execute(
+            "UPDATE ocr_pages SET last_access = ? WHERE key = ?", (time.time(), key)
+        )
+        self._connection.commit()
+        return row[0]
+
+    def put_many(self, entries):
+        # entries: (key, one-page PDF bytes)
+        now = time.time()
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO ocr_pages (key, page_pdf, size, last_access) "
+            "VALUES (?, ?, ?, ?)",
+            [(key, page_pdf, len(page_pdf), now) for key, page_pdf in entries],
+        )
+        self._evict()
+        self._connection.commit()
+
+    def _evict(self):
+        # Drop least recently used pages until the cache is back under 90% of
+        # its size budget
+        total_size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM ocr_pages"
+        ).fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        target = int(self.max_size_bytes * 0.9)
+        evicted_keys = []
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM ocr_pages ORDER BY last_access ASC"
+        ).fetchall():
+            if total_size <= target:
+                break
+            evicted_keys.append((key,))
+            total_size -= size
+        self._connection.executemany(
+            "DELETE FROM ocr_pages WHERE key = ?", evicted_keys
+        )
+
+    def close(self):
+        self._connection.close()
+
+
+def single_page_pdf(pdf_document, page_number):
+    page_document = fitz.open()
+    page_document.insert_pdf(pdf_document, from_page=page_number, to_page=page_number)
+    data = page_document.tobytes(garbage=3, deflate=True)
+    page_document.close()
+    return data
+
+
+def ocr_pages_with_cache(
+    input_filename, output_filename, page_numbers, cache_path, run_ocr, settings_key
+):
+    # OCR the given 1-based pages of input_filename, reusing cached OCR for
+    # pages seen before. Only new pages go to run_ocr(subset_path, ocr_path),
+    # in one call; the output is put back together from the original pages,
+    # the cached pages and the newly OCR'd ones. Returns the number of pages
+    # served from the cache.
+    cache = OCRPageCache(cache_path)
+    try:
+        with fitz.open(input_filename) as input_document:
+            if page_numbers is None:
+                page_numbers = range(1, input_document.page_count + 1)
+            keys = {
+                number: page_image_hash(input_document[number - 1], settings_key)
+                for number in page_numbers
+            }
+            ocr_pages = {}
+            for number, key in keys.items():
+                cached = cache.get(key)
+                if cached is not None:
+                    ocr_pages[number] = cached
+            # One page per new image; repeats within the file reuse its OCR
+            new_pages = []
+            new_keys = set()
+            for number, key in keys.items():
+                if number not in ocr_pages and key not in new_keys:
+                    new_pages.append(number)
+                    new_keys.add(key)
+
+            if new_pages:
+                subset_path = f"{output_filename}.pages.pdf"
+                ocr_path = f"{output_filename}.pages_ocr.pdf"
+                try:
+                    with fitz.open() as subset_document:
+                        for number in new_pages:
+                            subset_document.insert_pdf(
+                                input_document, from_page=number - 1, to_page=number - 1
+                            )
+                        subset_document.save(subset_path)
+                    run_ocr(subset_path, ocr_path)
+                    entries = []
+                    with fitz.open(ocr_path) as ocr_document:
+                        for index, number in enumerate(new_pages):
+                            ocr_pages[number] = single_page_pdf(ocr_document, index)
+                            entries.append((keys[number], ocr_pages[number]))
+                    cache.put_many(entries)
+                    by_key = dict(entries)
+                    for number, key in keys.items():
+                        ocr_pages.setdefault(number, by_key.get(key))
+                finally:
+                    for path in (subset_path, ocr_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+
+            with fitz.open() as output_document:
+                for number in range(1, input_document.page_count + 1):
+                    if number in ocr_pages:
+                        with fitz.open("pdf", ocr_pages[number]) as page_document:
+                            output_document.insert_pdf(page_document)
+                    else:
+                        output_document.insert_pdf(
+                            input_document, from_page=number - 1, to_page=number - 1
+                        )
+                output_document.save(output_filename, garbage=3, deflate=True)
+    finally:
+        cache.close()
+    return len(keys) - len(new_pages)
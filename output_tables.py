@@ -0,0 +1,89 @@
+import pandas as pd
+
+# Tables written per patient. The merged layout is the original one: every
+# invoice line joined with every diagnosis of the patient, which grows with
+# lines x diagnoses. The normalized layout keeps line items and diagnoses in
+# separate tables keyed by patient_id, so output grows with the extracted facts.
+TRANSFORMED_DATA = "transformed_data"
+LINE_ITEMS = "line_items"
+DIAGNOSES = "diagnoses"
+PATIENT_FEATURES = "patient_features"
+OUTPUT_LAYOUTS = ("merged", "normalized")
+
+TABLE_COLUMNS = {
+    TRANSFORMED_DATA: [
+        "patient_id",
+        "Transaction_ID",
+        "Date",
+        "Drug/Services",
+        "Quantity",
+        "Diagnosis",
+        "Diagnosis Type",
+    ],
+    LINE_ITEMS: ["patient_id", "Transaction_ID", "Date", "Drug/Services", "Quantity"],
+    DIAGNOSES: ["patient_id", "Diagnosis", "Diagnosis Type"],
+    # Total quantity and number of lines per drug/service, crossed with the
+    # diagnosis types of the same patient, for the discrepancy models
+    PATIENT_FEATURES: [
+        "patient_id",
+        "Drug/Services",
+        "Diagnosis Type",
+        "Quantity",
+        "Line_Items",
+    ],
+}
+
+
+def layout_tables(output_layout="merged", patient_features=False):
+    if output_layout == "normalized":
+        tables = [LINE_ITEMS, DIAGNOSES]
+    else:
+        tables = [TRANSFORMED_DATA]
+    if patient_features:
+        tables.append(PATIENT_FEATURES)
+    return tables
+
+
+def table_filename(patient_id, table):
+    return f"{patient_id}_{table}.csv"
+
+
+def is_table_file(filename, table):
+    return filename.endswith(f"_{table}.csv")
+
+
+def merged_table(invoice_df, medical_report_df):
+    combined_df = pd.merge(invoice_df, medical_report_df, on="patient_id", how="outer")
+    return combined_df[TABLE_COLUMNS[TRANSFORMED_DATA]]
+
+
+def patient_features_table(invoice_df, medical_report_df):
+    # Aggregated before crossing, so the size is distinct drugs x distinct
+    # diagnosis types per patient rather than lines x diagnoses
+    quantities = (
+        invoice_df.groupby(["patient_id", "Drug/Services"], dropna=False)
+        .agg(Quantity=("Quantity", "sum"), Line_Items=("Quantity", "size"))
+        .reset_index()
+    )
+    diagnosis_types = medical_report_df[
+        ["patient_id", "Diagnosis Type"]
+    ].drop_duplicates()
+    features = pd.merge(quantities, diagnosis_types, on="patient_id", how="left")
+    return features[TABLE_COLUMNS[PATIENT_FEATURES]]
+
+
+def build_output_tables(
+    invoice_df, medical_report_df, output_layout="merged", patient_features=False
+):
+    # Returns {table: DataFrame} for one patient, in layout_tables order
+    tables = {}
+    for table in layout_tables(output_layout, patient_features):
+        if table == TRANSFORMED_DATA:
+            tables[table] = merged_table(invoice_df, medical_report_df)
+        elif table == LINE_ITEMS:
+            tables[table] = invoice_df.reindex(columns=TABLE_COLUMNS[LINE_ITEMS])
+        elif table == DIAGNOSES:
+            tables[table] = medical_report_df.reindex(columns=TABLE_COLUMNS[DIAGNOSES])
+        elif table == PATIENT_FEATURES:
+            tables[table] = patient_features_table(invoice_df, medical_report_df)
+    return tables
@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+
+import fitz  # PyMuPDF
+
+from manifest import file_sha256
+
+
+def extract_page_texts(pdf_path):
+    # Text of every page, in page order
+    with fitz.open(pdf_path) as pdf_document:
+        return [page.get_text() for page in pdf_document]
+
+
+class PageStore:
+    # Page texts keyed by file content hash and page number, so every page is
+    # parsed from PDF once across stages and reruns. Paths are mapped to hashes
+    # by size and mtime, so unchanged files are not hashed again either.
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+            "sha256 TEXT NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "sha256 TEXT PRIMARY KEY, page_count INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "sha256 TEXT NOT NULL, page_number INTEGER NOT NULL, text TEXT NOT NULL, "
+            "PRIMARY KEY (sha256, page_number)) WITHOUT ROWID"
+        )
+        self._connection.commit()
+
+    def file_hash(self, pdf_path):
+        path = os.path.abspath(pdf_path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime = ?",
+                (path, stat.st_size, stat.st_mtime),
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        sha256 = file_sha256(path)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime, sha256) "
+                "VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime, sha256),
+            )
+            self._connection.commit()
+        return sha256
+
+    def has(self, sha256):
+        with self._lock:
+            return (
+                self._connection.execute(
+                    "SELECT 1 FROM documents WHERE sha256 = ?", (sha256,)
+                ).fetchone()
+                is not None
+            )
+
+    def get(self, sha256):
+        # Page texts of a stored file, or None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT page_count FROM documents WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row is None:
+                return None
+            texts = [
+                text
+                for (text,) in self._connection.execute(
+                    "SELECT text FROM pages WHERE sha256 = ? ORDER BY page_number",
+                    (sha256,),
+                )
+            ]
+        if len(texts) != row[0]:
+            return None
+        return texts
+
+    def put(self, sha256, page_texts):
+        with self._lock:
+            self._connection.execute("DELETE FROM pages WHERE sha256 = ?", (sha256,))
+            self._connection.executemany(
+                "INSERT INTO pages (sha256, page_number, text) VALUES (?, ?, ?)",
+                [(sha256, number, text) for number, text in enumerate(page_texts)],
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO documents (sha256, page_count) VALUES (?, ?)",
+                (sha256, len(page_texts)),
+            )
+            self._connection.commit()
+
+    def add_file(self, pdf_path, page_texts):
+        # Record texts already known for a file, e.g. split PDFs made of pages
+        # of an OCR file, so they are never parsed again
+        self.put(self.file_hash(pdf_path), page_texts)
+
+    def page_texts(self, pdf_path):
+        sha256 = self.file_hash(pdf_path)
+        texts = self.get(sha256)
+        if texts is not None:
+            with self._lock:
+                self.hits += 1
+            return texts
+        texts = extract_page_texts(pdf_path)
+        self.put(sha256, texts)
+        with self._lock:
+            self.misses += 1
+        return texts
+
+    def stats(self):
+        with self._lock:
+            documents, pages = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(page_count), 0) FROM documents"
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "documents": documents,
+                "pages": pages,
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# Module-level store, set up by main.py; None means pages are read straight
+# from the PDFs
+_store = None
+
+
+def configure_page_store(path):
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = PageStore(path) if path else None
+    return _store
+
+
+def get_page_store():
+    return _store
+
+
+def read_page_texts(pdf_path):
+    if _store is None:
+        return extract_page_texts(pdf_path)
+    return _store.page_texts(pdf_path)
+
+
+def print_page_store_stats():
+    if _store is None:
+        return
+    stats = _store.stats()
+    print(
+        f"Page store: {stats['hits']} files read from the store, "
+        f"{stats['misses']} parsed from PDF ({stats['documents']} files, "
+        f"{stats['pages']} pages stored in {_store.path})"
+    )
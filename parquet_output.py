@@ -0,0 +1,162 @@
+import glob
+import os
+from datetime import date
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from output_tables import DIAGNOSES, LINE_ITEMS, PATIENT_FEATURES, TRANSFORMED_DATA
+
+OUTPUT_FORMATS = ("csv", "parquet", "both")
+# Each table is its own dataset directory, named after the table, with
+# Hive-style partitions, e.g. line_items/extraction_date=2024-05-01/
+PARTITION_COLUMN = "extraction_date"
+DATE_FORMAT = "%d.%m.%Y"
+
+# Explicit types for the per-patient and combined Parquet files, so every
+# partition has the same schema whatever pandas would have inferred. The
+# partition column lives in the directory name, not in the files.
+DRUG_SERVICES = pa.field("Drug/Services", pa.dictionary(pa.int32(), pa.string()))
+DIAGNOSIS_TYPE = pa.field("Diagnosis Type", pa.dictionary(pa.int32(), pa.string()))
+TABLE_SCHEMAS = {
+    TRANSFORMED_DATA: pa.schema(
+        [
+            ("patient_id", pa.string()),
+            ("Transaction_ID", pa.string()),
+            ("Date", pa.date32()),
+            DRUG_SERVICES,
+            ("Quantity", pa.int64()),
+            ("Diagnosis", pa.string()),
+            DIAGNOSIS_TYPE,
+        ]
+    ),
+    LINE_ITEMS: pa.schema(
+        [
+            ("patient_id", pa.string()),
+            ("Transaction_ID", pa.string()),
+            ("Date", pa.date32()),
+            DRUG_SERVICES,
+            ("Quantity", pa.int64()),
+        ]
+    ),
+    DIAGNOSES: pa.schema(
+        [("patient_id", pa.string()), ("Diagnosis", pa.string()), DIAGNOSIS_TYPE]
+    ),
+    PATIENT_FEATURES: pa.schema(
+        [
+            ("patient_id", pa.string()),
+            DRUG_SERVICES,
+            DIAGNOSIS_TYPE,
+            ("Quantity", pa.int64()),
+            ("Line_Items", pa.int64()),
+        ]
+    ),
+}
+PARQUET_SCHEMA = TABLE_SCHEMAS[TRANSFORMED_DATA]
+
+
+def writes_csv(output_format):
+    return output_format in ("csv", "both")
+
+
+def writes_parquet(output_format):
+    return output_format in ("parquet", "both")
+
+
+def string_column(values):
+    # Missing values stay null instead of becoming the string "nan"
+    return pa.array(
+        [None if pd.isna(value) else str(value) for value in values],
+        type=pa.string(),
+    )
+
+
+def to_arrow_table(df, schema=PARQUET_SCHEMA):
+    # Dates the extractors could not read (or "NA") become null rather than
+    # failing the whole file
+    df = df.reindex(columns=schema.names)
+    columns = []
+    for field in schema:
+        values = df[field.name]
+        if field.type == pa.date32():
+            dates = pd.to_datetime(values, format=DATE_FORMAT, errors="coerce")
+            columns.append(pa.array(dates.dt.date, type=field.type, from_pandas=True))
+        elif field.type == pa.int64():
+            numbers = pd.to_numeric(values, errors="coerce").round()
+            columns.append(pa.array(numbers, type=field.type, from_pandas=True))
+        elif pa.types.is_dictionary(field.type):
+            columns.append(string_column(values).dictionary_encode())
+        else:
+            columns.append(string_column(values))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def partition_dir(dataset_dir, extraction_date=None):
+    extraction_date = extraction_date or date.today().isoformat()
+    return os.path.join(dataset_dir, f"{PARTITION_COLUMN}={extraction_date}")
+
+
+def write_patient_parquet(
+    df, dataset_dir, basename, schema=PARQUET_SCHEMA, extraction_date=None
+):
+    # One file per patient in today's partition. A patient extracted again on a
+    # later day moves to the new partition, so the dataset never holds two
+    # copies of the same patient.
+    output_dir = partition_dir(dataset_dir, extraction_date)
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{basename}.parquet")
+    temp_path = f"{output_path}.tmp"
+    pq.write_table(to_arrow_table(df, schema), temp_path)
+    os.replace(temp_path, output_path)
+    for old_path in glob.glob(
+        os.path.join(dataset_dir, f"{PARTITION_COLUMN}=*", f"{basename}.parquet")
+    ):
+        if old_path != output_path:
+            os.remove(old_path)
+    return output_path
+
+
+class PartitionedParquetWriter:
+    # Appends DataFrames to one Parquet file per extraction date, buffering
+    # rows so the files get reasonably sized row groups
+    def __init__(
+        self, dataset_dir, basename, row_group_rows=50000, schema=PARQUET_SCHEMA
+    ):
+        self.dataset_dir = dataset_dir
+        self.basename = basename
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.rows = 0
+        self._writers = {}
+        self._buffers = {}
+
+    def write(self, df, extraction_date):
+        buffer = self._buffers.setdefault(extraction_date, [])
+        buffer.append(to_arrow_table(df, self.schema))
+        if sum(table.num_rows for table in buffer) >= self.row_group_rows:
+            self._flush(extraction_date)
+        self.rows += len(df)
+
+    def _flush(self, extraction_date):
+        buffer = self._buffers.pop(extraction_date, [])
+        if not buffer:
+            return
+        writer = self._writers.get(extraction_date)
+        if writer is None:
+            output_dir = partition_dir(self.dataset_dir, extraction_date)
+            os.makedirs(output_dir, exist_ok=True)
+            writer = pq.ParquetWriter(
+                os.path.join(output_dir, f"{self.basename}.parquet"), self.schema
+            )
+            self._writers[extraction_date] = writer
+        # Dictionaries differ between the buffered tables; unify them so the
+        # row group gets a single dictionary per column
+        writer.write_table(pa.concat_tables(buffer).unify_dictionaries())
+
+    def close(self):
+        for extraction_date in list(self._buffers):
+            self._flush(extraction_date)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
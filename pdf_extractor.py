@@ -1,18 +1,94 @@
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from docx import Document
-from docx.shared import Inches
-from pypdf import PdfReader
+from page_store import PageStore, extract_page_texts
 
-pdf_path = os.path.join(os.getcwd(), "old_invoice")
-################################################################
-listoffiles = os.listdir(pdf_path)
+# Bulk page-text extraction into the page store (see page_store.py). Files
+# already in the store, by content hash, are skipped, so reruns only parse new
+# or changed PDFs. The pipeline reads the same store with --page-store.
 
 
-################################################################
-for i in range(0, len(listoffiles)):
-    reader = PdfReader(pdf_path + "/" + listoffiles[i])
-    with open(os.path.join(pdf_path, listoffiles[i].replace(".pdf", ".txt")), "a") as f:
-        for page in reader.pages:
-            f.write(page.extract_text() + "\n")
-################################################################
+def write_text_file(text_dir, filename, page_texts):
+    # Overwritten on every run, never appended to
+    os.makedirs(text_dir, exist_ok=True)
+    text_path = os.path.join(text_dir, os.path.splitext(filename)[0] + ".txt")
+    with open(text_path, "w") as f:
+        for text in page_texts:
+            f.write(text + "\n")
+    return text_path
+
+
+def extract_folder(input_dir, store_path, workers=None, text_dir=None):
+    store = PageStore(store_path)
+    counts = {"extracted": 0, "stored": 0, "failed": 0}
+    pending = {}
+    try:
+        for filename in sorted(os.listdir(input_dir)):
+            if not filename.lower().endswith(".pdf"):
+                continue
+            pdf_path = os.path.join(input_dir, filename)
+            sha256 = store.file_hash(pdf_path)
+            if store.has(sha256):
+                counts["stored"] += 1
+                if text_dir:
+                    write_text_file(text_dir, filename, store.get(sha256))
+                continue
+            pending[pdf_path] = sha256
+
+        # Pages are parsed in worker processes and written to the store by
+        # this one, so SQLite only ever has one writer
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(extract_page_texts, pdf_path): pdf_path
+                for pdf_path in pending
+            }
+            for future in as_completed(futures):
+                pdf_path = futures[future]
+                try:
+                    page_texts = future.result()
+                except Exception as e:
+                    print(f"Error extracting {pdf_path}: {e}")
+                    counts["failed"] += 1
+                    continue
+                store.put(pending[pdf_path], page_texts)
+                counts["extracted"] += 1
+                print(f"Extracted {len(page_texts)} pages from {pdf_path}")
+                if text_dir:
+                    write_text_file(text_dir, os.path.basename(pdf_path), page_texts)
+    finally:
+        store.close()
+
+    print(
+        f"Extracted {counts['extracted']} files into {store_path} "
+        f"({counts['stored']} already stored, {counts['failed']} failed)"
+    )
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract the text of every PDF page into the page store."
+    )
+    parser.add_argument(
+        "input_dir", nargs="?", default=os.path.join(os.getcwd(), "old_invoice")
+    )
+    parser.add_argument(
+        "--store",
+        default="page_store.sqlite",
+        help="SQLite page store; main.py uses <output_dir>/page_store.sqlite.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes (default: one per core).",
+    )
+    parser.add_argument(
+        "--text-dir",
+        default=None,
+        help="Also write one .txt per PDF here, replacing earlier ones.",
+    )
+    args = parser.parse_args()
+
+    extract_folder(args.input_dir, args.store, args.workers, args.text_dir)
@@ -1,143 +1,785 @@
+import json
+import math
 import os
-import time
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import fitz  # PyMuPDF for text extraction
-import PyPDF2
-from openai import OpenAI
 
-# Set your OpenAI API key
-api_key = os.getenv("OPENAI_API_KEY")
+from llm_cache import cached_chat_completion, cached_chat_response
+from llm_client import LLMRequestError, get_client
+from metrics import bind_context, get_metrics
+from model_cascade import get_model_cascade
+from ocr import source_filename
+from page_store import get_page_store, read_page_texts
+from rate_limiter import estimate_tokens
+from text_normalizer import normalization_settings, normalize_for_document
 
-# Create the OpenAI client instance
-client = OpenAI(api_key=api_key)
+CLASSIFICATION_MODEL = "gpt-4o-mini"
+CLASSIFICATION_MAX_TOKENS = 20
+# Per-request timeout in seconds; classification answers are a few tokens
+CLASSIFICATION_TIMEOUT = 30
 
+# Page text tokens allowed in one batched classification request
+DEFAULT_BATCH_TOKEN_BUDGET = 6000
+# A malformed batch answer is asked for again this many times before the
+# pages are classified one by one
+BATCH_CLASSIFICATION_RETRIES = 1
 
-def classify_page_with_chatgpt(page_text):
-    try:
-        if not page_text.strip():
-            print("everything viewed as empty.")
-            return "Medical Report"  # Default classification for empty pages
-
-        prompt = (
-            "You are a highly advanced document classification assistant. Your task is to categorize the following page text into one of four categories: "
-            "1. Bill Audit Form\n"
-            "2. Invoice\n"
-            "3. Letter of Guarantee\n"
-            "4. Medical Report\n\n"
-            "Carefully analyze the provided text and categorize it based on the following detailed guidelines:\n\n"
-            "**Bill Audit Form**:\n"
-            "- Contains notes or comments specifically regarding **auditing** or **verifying** charges on medical bills.\n"
-            "- Often includes **patient details**, **itemized charges**, and **audit notes**.\n"
-            "- Look for terms like 'audit', 'reconciliation', 'review', 'charges audited', 'summary of charges', 'quantity', 'charged', 'why so many', or 'charges correct'.\n"
-            "- **Important**: If the text includes phrases like 'Revise invoice', 'It is correct', or audit-related questions (e.g., 'why so many?', 'is the charge correct?'), this is likely a Bill Audit Form rather than an Invoice.\n\n"
-            "**Invoice**:\n"
-            "- Any document labeled as a **Tax Invoice** should be classified as an Invoice, regardless of the specific items or services listed.\n"
-            "- Primarily used for **billing purposes**, listing items, prices, discounts, and total amounts.\n"
-            "- Includes billing-related details like **hospital charges**, **consumables**, **bed charges**, or other general medical service fees.\n"
-            "- Look for terms like **'Invoice Number'**, **'Due Date'**, or **'Payment Due'**.\n"
-            "- Excludes detailed audit-specific comments but may include general notes for billing accuracy.\n\n"
-            "**Letter of Guarantee**:\n"
-            "- A formal document ensuring **payment or coverage** from an insurer or healthcare provider.\n"
-            "- Look for terms like 'guarantee', 'coverage', 'guarantor', 'terms of coverage', or 'formal letter'.\n"
-            "- Typically includes **names, conditions, and guarantees**.\n\n"
-            "**Medical Report**:\n"
-            "- Contains detailed medical information such as **diagnosis**, **treatment**, **clinical notes**, and **patient history**.\n"
-            "- Look for terms like 'diagnosis', 'treatment plan', 'medical history', 'clinical notes', or 'symptoms'.\n"
-            "- Usually includes **doctor’s notes**, **patient health information**, or **treatment details**.\n"
-            "- If the document contains consumable lists, medical supplies, or references to items used during treatment without billing or invoice details, categorize it as Medical Report.\n\n"
-            "To classify each page:\n"
-            "1. Analyze the **overall context** of the text, including phrases, sections, and headers.\n"
-            "2. If the text mentions 'Tax Invoice', classify it as an **Invoice**.\n"
-            "3. Pay attention to **key terms** and **the absence of expected words** (e.g., missing 'Tax Invoice' should raise suspicion of a misclassification).\n\n"
-            "**Important**: Provide **only** the category name (Bill Audit Form, Invoice, Letter of Guarantee, Medical Report). Do not provide any additional text or explanation.\n\n"
-            "Here is the text for classification:\n"
-            f"Text: {page_text}\n\n"
-            "Provide only the category name."
-        )
+CLASSIFICATION_CATEGORIES = (
+    "Bill Audit Form",
+    "Invoice",
+    "Letter of Guarantee",
+    "Medical Report",
+)
+
+# Category guidelines shared by the single-page and batched prompts
+CLASSIFICATION_GUIDELINES = (
+    "1. Bill Audit Form\n"
+    "2. Invoice\n"
+    "3. Letter of Guarantee\n"
+    "4. Medical Report\n\n"
+    "Carefully analyze the provided text and categorize it based on the following detailed guidelines:\n\n"
+    "**Bill Audit Form**:\n"
+    "- Contains notes or comments specifically regarding **auditing** or **verifying** charges on medical bills.\n"
+    "- Often includes **patient details**, **itemized charges**, and **audit notes**.\n"
+    "- Look for terms like 'audit', 'reconciliation', 'review', 'charges audited', 'summary of charges', 'quantity', 'charged', 'why so many', or 'charges correct'.\n"
+    "- **Important**: If the text includes phrases like 'Revise invoice', 'It is correct', or audit-related questions (e.g., 'why so many?', 'is the charge correct?'), this is likely a Bill Audit Form rather than an Invoice.\n\n"
+    "**Invoice**:\n"
+    "- Any document labeled as a **Tax Invoice** should be classified as an Invoice, regardless of the specific items or services listed.\n"
+    "- Primarily used for **billing purposes**, listing items, prices, discounts, and total amounts.\n"
+    "- Includes billing-related details like **hospital charges**, **consumables**, **bed charges**, or other general medical service fees.\n"
+    "- Look for terms like **'Invoice Number'**, **'Due Date'**, or **'Payment Due'**.\n"
+    "- Excludes detailed audit-specific comments but may include general notes for billing accuracy.\n\n"
+    "**Letter of Guarantee**:\n"
+    "- A formal document ensuring **payment or coverage** from an insurer or healthcare provider.\n"
+    "- Look for terms like 'guarantee', 'coverage', 'guarantor', 'terms of coverage', or 'formal letter'.\n"
+    "- Typically includes **names, conditions, and guarantees**.\n\n"
+    "**Medical Report**:\n"
+    "- Contains detailed medical information such as **diagnosis**, **treatment**, **clinical notes**, and **patient history**.\n"
+    "- Look for terms like 'diagnosis', 'treatment plan', 'medical history', 'clinical notes', or 'symptoms'.\n"
+    "- Usually includes **doctor’s notes**, **patient health information**, or **treatment details**.\n"
+    "- If the document contains consumable lists, medical supplies, or references to items used during treatment without billing or invoice details, categorize it as Medical Report.\n\n"
+    "To classify each page:\n"
+    "1. Analyze the **overall context** of the text, including phrases, sections, and headers.\n"
+    "2. If the text mentions 'Tax Invoice', classify it as an **Invoice**.\n"
+    "3. Pay attention to **key terms** and **the absence of expected words** (e.g., missing 'Tax Invoice' should raise suspicion of a misclassification).\n\n"
+)
+
+
+def build_classification_prompt(page_text):
+    return (
+        "You are a highly advanced document classification assistant. Your task is to categorize the following page text into one of four categories: "
+        + CLASSIFICATION_GUIDELINES
+        + "**Important**: Provide **only** the category name (Bill Audit Form, Invoice, Letter of Guarantee, Medical Report). Do not provide any additional text or explanation.\n\n"
+        "Here is the text for classification:\n"
+        f"Text: {page_text}\n\n"
+        "Provide only the category name."
+    )
+
+
+def parse_classification_label(response_content):
+    # The category named by an answer, ignoring case, quotes and trailing
+    # punctuation, or None if it names none or several of the categories
+    if not isinstance(response_content, str):
+        return None
+    answer = response_content.strip().strip("*\"'`.").strip().lower()
+    for category in CLASSIFICATION_CATEGORIES:
+        if answer == category.lower():
+            return category
+    named = [
+        category for category in CLASSIFICATION_CATEGORIES if category.lower() in answer
+    ]
+    return named[0] if len(named) == 1 else None
 
-        # Make a request to the ChatGPT API using the client
-        chat_completion = client.chat.completions.create(
+
+def classification_confidence(label, logprob, page_text):
+    # Probability of the answer from its logprobs. Without logprobs, an
+    # agreement check: the answer is doubted as much as the local classifier
+    # is sure of a different label.
+    if logprob is not None:
+        return math.exp(logprob)
+    local_label, local_confidence = local_classify_page(page_text)
+    return 1.0 if local_label == label else 1.0 - local_confidence
+
+
+def classify_page_with_chatgpt(page_text, rate_limiter=None):
+    if not page_text.strip():
+        print("everything viewed as empty.")
+        return "Medical Report"  # Default classification for empty pages
+
+    prompt = build_classification_prompt(page_text)
+
+    def ask(model, score):
+        # Make a request to the ChatGPT API using the shared client,
+        # reusing any cached answer for the same prompt. Logprobs are only
+        # requested when a stronger model could still be asked.
+        response = cached_chat_response(
+            get_client(),
             messages=[
                 {
                     "role": "user",
                     "content": prompt,
                 }
             ],
-            model="gpt-4o-mini",
-            max_tokens=20,
+            model=model,
+            rate_limiter=rate_limiter,
+            timeout=CLASSIFICATION_TIMEOUT,
+            max_tokens=CLASSIFICATION_MAX_TOKENS,
+            **({"logprobs": True} if score else {}),
+        )
+        if response is None:
+            return None, None
+        label = parse_classification_label(response["content"])
+        if label is None:
+            print(f"Unrecognized classification from {model}: {response['content']}")
+            return None, None
+        if not score:
+            return label, None
+        return label, classification_confidence(
+            label, response.get("logprob"), page_text
         )
 
-        # Extract response content
-        if chat_completion and hasattr(chat_completion, "choices"):
-            response_content = chat_completion.choices[0].message.content.strip()
-            return response_content
-        else:
-            print("No valid response received.")
-            return "Medical Report"  # Default classification if no valid response is received
+    # Cheaper models answer first; invalid or unsure answers escalate
+    cascade = get_model_cascade("classify", CLASSIFICATION_MODEL)
+    label = cascade.run(ask)
+    if label is not None:
+        return label
+    else:
+        # The API answered but no answer could be parsed. API failures raise
+        # LLMRequestError instead, so the document fails rather than being
+        # mislabelled.
+        print("No valid response received.")
+        get_metrics().record_default_answer(cascade.models[-1])
+        # Default classification if no valid response is received
+        return "Medical Report"
 
-    except Exception as e:
-        print(f"Error during classification: {e}")
-        return "Medical Report"  # Default classification in case of an error
 
+def build_batch_classification_prompt(page_texts):
+    pages = "".join(
+        f'<page number="{page_number}">\n{page_text}\n</page>\n'
+        for page_number, page_text in enumerate(page_texts, start=1)
+    )
+    return (
+        "You are a highly advanced document classification assistant. Your task is to categorize each of the following pages of one document into one of four categories: "
+        + CLASSIFICATION_GUIDELINES
+        + f"You will receive {len(page_texts)} pages, each wrapped in <page> tags. Classify every page on its own.\n"
+        "**Important**: Respond with a JSON object of the form "
+        '{"labels": ["<category>", ...]} holding exactly one category name '
+        "(Bill Audit Form, Invoice, Letter of Guarantee, Medical Report) per page, in page order. "
+        "Do not provide any additional text or explanation.\n\n"
+        "Here are the pages for classification:\n"
+        f"{pages}\n"
+        "Provide only the JSON object."
+    )
 
-def split_pdf_by_classification(input_pdf_path, output_directory):
-    # Extract the base name of the input PDF file without extension
-    input_filename = os.path.splitext(os.path.basename(input_pdf_path))[0]
 
-    # Load the PDF
+def parse_batch_labels(response_content, expected_count):
+    # Returns the per-page labels, or None if the response is malformed or
+    # does not hold exactly one valid label per page
+    if response_content is None:
+        return None
+    response_content = (
+        response_content.replace("```json", "").replace("```", "").strip()
+    )
     try:
-        pdf_document = fitz.open(input_pdf_path)
-    except Exception as e:
-        print(f"Error opening PDF: {e}")
-        return
+        parsed = json.loads(response_content)
+    except json.JSONDecodeError:
+        return None
+    labels = parsed.get("labels") if isinstance(parsed, dict) else parsed
+    if not isinstance(labels, list) or len(labels) != expected_count:
+        return None
+    labels = [parse_classification_label(label) for label in labels]
+    if any(label is None for label in labels):
+        return None
+    return labels
+
+
+def classify_batch_with_chatgpt(page_texts, rate_limiter=None):
+    # Classify several pages in one request. Returns (labels, fell_back) where
+    # fell_back is True when the batch answer was unusable and every page was
+    # retried on its own. An unusable answer is asked for once more bypassing
+    # the cache, so it does not stay cached for later runs. Batches go to the
+    # cheapest model of the cascade; the pages of a failed batch escalate one
+    # by one.
+    prompt = build_batch_classification_prompt(page_texts)
+    max_tokens = CLASSIFICATION_MAX_TOKENS * len(page_texts) + 20
+
+    for attempt in range(BATCH_CLASSIFICATION_RETRIES + 1):
+        try:
+            response_content = cached_chat_completion(
+                get_client(),
+                messages=[{"role": "user", "content": prompt}],
+                model=get_model_cascade("classify", CLASSIFICATION_MODEL).first_model,
+                refresh=attempt > 0,
+                rate_limiter=rate_limiter,
+                timeout=CLASSIFICATION_TIMEOUT,
+                max_tokens=max_tokens,
+                response_format={"type": "json_object"},
+            )
+        except LLMRequestError:
+            raise
+        except Exception as e:
+            print(f"Error during batch classification: {e}")
+            response_content = None
+
+        labels = parse_batch_labels(response_content, len(page_texts))
+        if labels is not None:
+            return labels, False
+
+    print(
+        f"Malformed batch classification response, "
+        f"retrying {len(page_texts)} pages individually"
+    )
+    return [
+        classify_page_with_chatgpt(page_text, rate_limiter) for page_text in page_texts
+    ], True
+
+
+def build_classification_batches(indexed_texts, batch_size, batch_token_budget):
+    # Group (index, text) pairs into batches of at most batch_size pages whose
+    # page text fits the token budget. An oversized page gets a batch to itself.
+    batches = []
+    current = []
+    current_tokens = 0
+    for index, page_text in indexed_texts:
+        page_tokens = estimate_tokens(page_text)
+        if current and (
+            len(current) >= batch_size
+            or current_tokens + page_tokens > batch_token_budget
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((index, page_text))
+        current_tokens += page_tokens
+    if current:
+        batches.append(current)
+    return batches
 
-    classified_pages = {
-        "Bill Audit Form": [],
-        "Invoice": [],
-        "Letter of Guarantee": [],
-        "Medical Report": [],
+
+# Keyword features taken from the classification prompt guidelines, with
+# weights reflecting how decisive each phrase is for its category
+LOCAL_CLASSIFIER_KEYWORDS = {
+    "Bill Audit Form": {
+        "bill audit": 3.0,
+        "charges audited": 3.0,
+        "revise invoice": 3.0,
+        "why so many": 3.0,
+        "charges correct": 3.0,
+        "charge correct": 3.0,
+        "it is correct": 2.0,
+        "summary of charges": 2.0,
+        "reconciliation": 2.0,
+        "audit": 1.5,
+        "review": 0.5,
+    },
+    "Invoice": {
+        "tax invoice": 4.0,
+        "invoice number": 2.0,
+        "invoice no": 2.0,
+        "payment due": 2.0,
+        "due date": 1.5,
+        "bed charges": 1.5,
+        "hospital charges": 1.5,
+        "total amount": 1.0,
+        "consumables": 0.5,
+        "discount": 0.5,
+        "invoice": 0.5,
+    },
+    "Letter of Guarantee": {
+        "letter of guarantee": 4.0,
+        "guarantor": 2.0,
+        "terms of coverage": 2.0,
+        "guarantee": 1.5,
+        "coverage": 1.0,
+    },
+    "Medical Report": {
+        "treatment plan": 2.0,
+        "medical history": 2.0,
+        "clinical notes": 2.0,
+        "diagnosed with": 2.0,
+        "diagnosis": 1.5,
+        "symptoms": 1.0,
+        "history of": 1.0,
+        "presents with": 1.0,
+        "treatment": 0.5,
+    },
+}
+
+# Score needed before the local classifier trusts its own answer fully
+LOCAL_CLASSIFIER_FULL_EVIDENCE = 4.0
+
+
+def local_classify_page(page_text):
+    # Returns (label, confidence) from keyword scores alone, without the API
+    text = " ".join(page_text.lower().split())
+    if not text:
+        return "Medical Report", 1.0
+
+    scores = {
+        category: sum(
+            weight * min(text.count(keyword), 3) for keyword, weight in keywords.items()
+        )
+        for category, keywords in LOCAL_CLASSIFIER_KEYWORDS.items()
     }
 
-    # Classify each page using ChatGPT
-    for page_number in range(len(pdf_document)):
-        page = pdf_document.load_page(page_number)
-        page_text = page.get_text()
+    # Deterministic rule from the prompt: "Tax Invoice" means Invoice, unless
+    # the page also carries audit remarks about the charges
+    if "tax invoice" in text and scores["Bill Audit Form"] < 3.0:
+        return "Invoice", 0.95
 
-        # Classify page using ChatGPT
-        classification = classify_page_with_chatgpt(page_text)
-        classified_pages[classification].append(page_number)
-        print(f"Page {page_number + 1} classified as: {classification}")
+    label = max(scores, key=scores.get)
+    total = sum(scores.values())
+    if total == 0:
+        return "Medical Report", 0.0
 
-        # Add delay to avoid rate limiting issues with OpenAI API
-        time.sleep(1)
+    # Confidence is the winning share of the evidence, discounted when there is
+    # too little evidence overall
+    share = scores[label] / total
+    evidence = min(1.0, scores[label] / LOCAL_CLASSIFIER_FULL_EVIDENCE)
+    return label, round(share * evidence, 3)
+
+
+def route_page_locally(page_text, local_threshold=None):
+    # Label empty pages and pages the local classifier is confident about.
+    # Anything else is returned with route "llm" and no label yet.
+    if not page_text.strip():
+        return {"label": "Medical Report", "route": "empty", "confidence": 1.0}
+
+    confidence = None
+    if local_threshold is not None:
+        label, confidence = local_classify_page(page_text)
+        if confidence >= local_threshold:
+            return {"label": label, "route": "local", "confidence": confidence}
+
+    return {"label": None, "route": "llm", "confidence": confidence}
+
+
+def classify_page(
+    page_text, rate_limiter=None, local_threshold=None, compare_with_llm=False
+):
+    # Pages the local classifier is confident about skip the API call. With
+    # compare_with_llm the API is still asked, so the two labels can be
+    # compared when tuning the threshold.
+    result = route_page_locally(page_text, local_threshold)
+    if result["route"] == "llm":
+        result["label"] = classify_page_with_chatgpt(page_text, rate_limiter)
+    elif result["route"] == "local" and compare_with_llm:
+        result["llm_label"] = classify_page_with_chatgpt(page_text, rate_limiter)
+    return result
+
+
+def classify_pages_batched(
+    page_texts,
+    max_workers=1,
+    rate_limiter=None,
+    local_threshold=None,
+    compare_with_llm=False,
+    batch_size=10,
+    batch_token_budget=DEFAULT_BATCH_TOKEN_BUDGET,
+):
+    results = [
+        route_page_locally(page_text, local_threshold) for page_text in page_texts
+    ]
+    indexed_texts = [
+        (index, page_texts[index])
+        for index, result in enumerate(results)
+        if result["route"] == "llm" or (result["route"] == "local" and compare_with_llm)
+    ]
+    batches = build_classification_batches(
+        indexed_texts, batch_size, batch_token_budget
+    )
+
+    def classify_batch(batch):
+        return classify_batch_with_chatgpt(
+            [page_text for _, page_text in batch], rate_limiter
+        )
+
+    if max_workers <= 1:
+        batch_results = [classify_batch(batch) for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            batch_results = list(executor.map(bind_context(classify_batch), batches))
+
+    # Put every label back at its page index so page order is kept
+    for batch, (labels, fell_back) in zip(batches, batch_results):
+        for position, ((index, _), label) in enumerate(zip(batch, labels)):
+            result = results[index]
+            if result["route"] == "llm":
+                result["label"] = label
+            else:
+                result["llm_label"] = label
+            result["batch_start"] = position == 0
+            result["batch_fallback"] = fell_back
+    return results
+
+
+def classify_pages(
+    page_texts,
+    max_workers=1,
+    rate_limiter=None,
+    local_threshold=None,
+    compare_with_llm=False,
+    batch_size=1,
+    batch_token_budget=DEFAULT_BATCH_TOKEN_BUDGET,
+):
+    if batch_size > 1:
+        return classify_pages_batched(
+            page_texts,
+            max_workers,
+            rate_limiter,
+            local_threshold,
+            compare_with_llm,
+            batch_size,
+            batch_token_budget,
+        )
+
+    def classify(page_text):
+        return classify_page(page_text, rate_limiter, local_threshold, compare_with_llm)
+
+    if max_workers <= 1:
+        return [classify(page_text) for page_text in page_texts]
+
+    # executor.map yields results in input order, whatever order they finish in
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(bind_context(classify), page_texts))
 
-    # Split and save pages based on classification
-    input_pdf = open(input_pdf_path, "rb")
-    pdf_reader = PyPDF2.PdfReader(input_pdf)
 
+# Segmentation: consecutive pages that belong to one section of a bundle are
+# found from local signals, and each section is classified once from its
+# representative page instead of page by page
+PAGE_FOOTER_PATTERN = re.compile(r"\bpage\s*(\d{1,3})\s*(?:of|/)\s*(\d{1,3})\b", re.I)
+# Lines at the top of a page compared to tell a letterhead or title change
+SEGMENT_HEADER_LINES = 5
+# Header token overlap at which a page continues the previous section
+SEGMENT_HEADER_MATCH = 0.5
+# Pages with less text than this are continuations of the previous section
+SEGMENT_MIN_TEXT = 200
+# Local classifier confidence at which two differing labels mark a boundary.
+# Lower than a routing threshold: a spurious boundary costs one more
+# classification call, a missed one mislabels a whole section.
+SEGMENT_LABEL_CONFIDENCE = 0.75
+
+
+def page_footer_numbers(page_text):
+    # (x, y) from the last "Page x of y" on the page, or None
+    matches = PAGE_FOOTER_PATTERN.findall(page_text)
+    if not matches:
+        return None
+    number, total = (int(value) for value in matches[-1])
+    if not 1 <= number <= total:
+        return None
+    return number, total
+
+
+def header_tokens(page_text):
+    lines = [line for line in page_text.splitlines() if line.strip()]
+    header = " ".join(lines[:SEGMENT_HEADER_LINES]).lower()
+    # Digits are dropped so dates, page and invoice numbers do not count
+    return set(re.findall(r"[a-z]{3,}", header))
+
+
+def jaccard(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def starts_new_segment(previous, current):
+    # previous and current are per-page signals from find_page_segments
+    if current["footer"] is not None:
+        number, total = current["footer"]
+        if previous["footer"] is not None:
+            previous_number, previous_total = previous["footer"]
+            if number != previous_number + 1 or total != previous_total:
+                return True
+        elif number == 1:
+            return True
+    # Bundles are often numbered as a whole, so continuous numbering does not
+    # rule out a boundary; a confident switch of category still marks one
+    if (
+        previous["label"] != current["label"]
+        and min(previous["confidence"], current["confidence"])
+        >= SEGMENT_LABEL_CONFIDENCE
+    ):
+        return True
+    if current["footer"] is not None and previous["footer"] is not None:
+        # Continuous numbering: the letterhead may change within a section
+        return False
+    if current["length"] < SEGMENT_MIN_TEXT:
+        return False
+    return jaccard(previous["header"], current["header"]) < SEGMENT_HEADER_MATCH
+
+
+def find_page_segments(page_texts):
+    # Returns lists of page indexes, one per section, in page order
+    signals = []
+    for page_text in page_texts:
+        label, confidence = local_classify_page(page_text)
+        signals.append(
+            {
+                "footer": page_footer_numbers(page_text),
+                "header": header_tokens(page_text),
+                "length": len(page_text.strip()),
+                "label": label,
+                "confidence": confidence,
+            }
+        )
+
+    segments = []
+    for index, signal in enumerate(signals):
+        if not segments or starts_new_segment(signals[index - 1], signal):
+            segments.append([])
+        segments[-1].append(index)
+    return segments
+
+
+def classify_pages_by_segment(page_texts, prompt_texts, classify):
+    # Segments are found on the raw texts, whose page footers normalization
+    # may strip. classify(texts) labels one representative page per segment,
+    # the one with the most text, and every page of the segment gets its label.
+    segments = find_page_segments(page_texts)
+    representatives = [
+        max(segment, key=lambda index: len(page_texts[index].strip()))
+        for segment in segments
+    ]
+    segment_results = classify([prompt_texts[index] for index in representatives])
+
+    results = [None] * len(page_texts)
+    for segment, representative, segment_result in zip(
+        segments, representatives, segment_results
+    ):
+        for index in segment:
+            if index == representative:
+                result = dict(segment_result)
+            else:
+                result = {
+                    "label": segment_result["label"],
+                    "route": "segment",
+                    "confidence": segment_result["confidence"],
+                }
+            result["segment_start"] = index == segment[0]
+            results[index] = result
+    return results
+
+
+def update_routing_stats(routing_stats, results):
+    for result in results:
+        routing_stats[result["route"]] += 1
+        if "segment_start" in result:
+            routing_stats["segmented"] += 1
+            routing_stats["segments"] += result["segment_start"]
+        if "batch_start" in result:
+            routing_stats["batched"] += 1
+            routing_stats["batch_requests"] += result["batch_start"]
+            if result["batch_fallback"]:
+                routing_stats["batch_fallback"] += 1
+        if "llm_label" in result:
+            agreed = result["llm_label"] == result["label"]
+            routing_stats["local_agreed" if agreed else "local_disagreed"] += 1
+
+
+def print_routing_stats(routing_stats):
+    print(
+        f"Page routing: {routing_stats['local']} local, "
+        f"{routing_stats['llm']} LLM, {routing_stats['empty']} empty, "
+        f"{routing_stats['segment']} from their segment"
+    )
+    if routing_stats["segmented"]:
+        print(
+            f"Segmented classification: {routing_stats['segmented']} pages in "
+            f"{routing_stats['segments']} segments"
+        )
+    if routing_stats["batched"]:
+        print(
+            f"Batched classification: {routing_stats['batched']} pages in "
+            f"{routing_stats['batch_requests']} requests, "
+            f"{routing_stats['batch_fallback']} retried individually"
+        )
+    compared = routing_stats["local_agreed"] + routing_stats["local_disagreed"]
+    if compared:
+        print(
+            f"Local classifier agreed with the LLM on "
+            f"{routing_stats['local_agreed']}/{compared} pages"
+        )
+
+
+# Create the output path with the modified file name
+def split_output_path(output_directory, input_filename, category):
+    output_filename = f"{input_filename}_{category.replace(' ', '_')}.pdf"
+    return os.path.join(output_directory, output_filename)
+
+
+# Name of the OCR file a split PDF was cut from
+def split_source_filename(split_filename):
+    for category in CLASSIFICATION_CATEGORIES:
+        suffix = f"_{category.replace(' ', '_')}.pdf"
+        if split_filename.endswith(suffix):
+            return split_filename[: -len(suffix)] + ".pdf"
+    return split_filename
+
+
+# Settings that change the classification, used to invalidate resumed runs
+def classification_settings(
+    local_threshold=None, batch_size=1, normalize_text=False, segment_pages=False
+):
+    return {
+        "model": CLASSIFICATION_MODEL,
+        "cascade": get_model_cascade("classify", CLASSIFICATION_MODEL).settings(),
+        "prompt": build_classification_prompt(""),
+        "batch_prompt": (
+            build_batch_classification_prompt([]) if batch_size > 1 else None
+        ),
+        "local_threshold": local_threshold,
+        "local_keywords": (
+            LOCAL_CLASSIFIER_KEYWORDS if local_threshold is not None else None
+        ),
+        "normalization": normalization_settings(normalize_text),
+        "segmentation": (
+            {
+                "footer_pattern": PAGE_FOOTER_PATTERN.pattern,
+                "header_lines": SEGMENT_HEADER_LINES,
+                "header_match": SEGMENT_HEADER_MATCH,
+                "min_text": SEGMENT_MIN_TEXT,
+                "label_confidence": SEGMENT_LABEL_CONFIDENCE,
+                "local_keywords": LOCAL_CLASSIFIER_KEYWORDS,
+            }
+            if segment_pages
+            else None
+        ),
+    }
+
+
+def write_split_pdfs(pdf_document, classified_pages, input_filename, output_directory):
+    # One fitz insert_pdf pass per category, copying contiguous page runs at once
     for category, pages in classified_pages.items():
         if not pages:
             continue
 
-        pdf_writer = PyPDF2.PdfWriter()
-        for page_number in pages:
+        split_document = fitz.open()
+        run_start = previous = pages[0]
+        for page_number in pages[1:] + [None]:
+            if page_number is not None and page_number == previous + 1:
+                previous = page_number
+                continue
             try:
-                pdf_writer.add_page(pdf_reader.pages[page_number])
+                split_document.insert_pdf(
+                    pdf_document, from_page=run_start, to_page=previous
+                )
             except Exception as e:
-                print(f"Error adding page {page_number + 1} to {category}: {e}")
+                print(
+                    f"Error adding pages {run_start + 1}-{previous + 1} "
+                    f"to {category}: {e}"
+                )
+            run_start = previous = page_number
 
-        # Create the output path with the modified file name
-        output_filename = f"{input_filename}_{category.replace(' ', '_')}.pdf"
-        output_path = os.path.join(output_directory, output_filename)
+        output_path = split_output_path(output_directory, input_filename, category)
 
         try:
-            with open(output_path, "wb") as output_pdf:
-                pdf_writer.write(output_pdf)
-                print(f"Created: {output_path}")
+            split_document.save(output_path)
+            print(f"Created: {output_path}")
         except Exception as e:
             print(f"Error writing {category} to file: {e}")
+        finally:
+            split_document.close()
+
+
+# Returns the page numbers and page texts of each category, so the extraction
+# stage can use them directly instead of re-reading the split PDFs
+def split_pdf_by_classification(
+    input_pdf_path,
+    output_directory,
+    max_workers=1,
+    rate_limiter=None,
+    local_threshold=None,
+    compare_with_llm=False,
+    routing_stats=None,
+    batch_size=1,
+    batch_token_budget=DEFAULT_BATCH_TOKEN_BUDGET,
+    write_pdfs=True,
+    normalize_text=False,
+    segment_pages=False,
+):
+    # Extract the base name of the input PDF file without extension
+    input_filename = os.path.splitext(os.path.basename(input_pdf_path))[0]
+
+    # Page texts come from the page store when it has seen this file before
+    try:
+        page_texts = read_page_texts(input_pdf_path)
+    except Exception as e:
+        print(f"Error opening PDF: {e}")
+        return None
+
+    classified_pages = {category: [] for category in CLASSIFICATION_CATEGORIES}
+    classified_texts = {category: [] for category in CLASSIFICATION_CATEGORIES}
 
-    input_pdf.close()
+    # Repeated letterhead, footers and noise are stripped before classifying.
+    # The returned texts stay raw; the extractors normalize their own pages.
+    prompt_texts = page_texts
+    if normalize_text:
+        prompt_texts = normalize_for_document(page_texts)
+
+    # Classify each page locally or with ChatGPT, results come back in page order
+    def classify(texts):
+        return classify_pages(
+            texts,
+            max_workers,
+            rate_limiter,
+            local_threshold,
+            compare_with_llm,
+            batch_size,
+            batch_token_budget,
+        )
+
+    if segment_pages:
+        results = classify_pages_by_segment(page_texts, prompt_texts, classify)
+    else:
+        results = classify(prompt_texts)
+    for page_number, result in enumerate(results):
+        classification = result["label"]
+        classified_pages[classification].append(page_number)
+        classified_texts[classification].append(page_texts[page_number])
+        print(
+            f"Page {page_number + 1} classified as: {classification} "
+            f"({result['route']})"
+        )
+    if routing_stats is not None:
+        update_routing_stats(routing_stats, results)
+
+    # Split and save pages based on classification
+    outputs = []
+    if write_pdfs:
+        os.makedirs(output_directory, exist_ok=True)
+        with fitz.open(input_pdf_path) as pdf_document:
+            write_split_pdfs(
+                pdf_document, classified_pages, input_filename, output_directory
+            )
+        outputs = [
+            split_output_path(output_directory, input_filename, category)
+            for category, pages in classified_pages.items()
+            if pages
+        ]
+        # The split PDFs hold pages whose text is already known; store it so
+        # the extraction stage does not parse them again
+        page_store = get_page_store()
+        if page_store is not None:
+            for category, pages in classified_pages.items():
+                output_path = split_output_path(
+                    output_directory, input_filename, category
+                )
+                if pages and os.path.exists(output_path):
+                    page_store.add_file(
+                        output_path, [page_texts[number] for number in pages]
+                    )
+
+    return {
+        "source_pdf": input_pdf_path,
+        "pages": classified_pages,
+        "texts": classified_texts,
+        "outputs": outputs,
+    }
 
 
 # Example usage for single file
@@ -148,14 +790,54 @@ def split_pdf_by_classification(input_pdf_path, output_directory):
 
 
 # Example usage for all files in a folder
-def process_all_pdfs_in_folder(input_folder, output_folder):
+def process_all_pdfs_in_folder(
+    input_folder,
+    output_folder,
+    max_workers=1,
+    rate_limiter=None,
+    local_threshold=None,
+    compare_with_llm=False,
+    batch_size=1,
+    batch_token_budget=DEFAULT_BATCH_TOKEN_BUDGET,
+    manifest=None,
+    normalize_text=False,
+    segment_pages=False,
+):
     os.makedirs(output_folder, exist_ok=True)
+    routing_stats = Counter()
 
     for filename in os.listdir(input_folder):
         if filename.endswith(".pdf"):
             input_pdf_path = os.path.join(input_folder, filename)
+            document = source_filename(filename)
+            if manifest is not None and manifest.is_done(document, "split"):
+                print(f"Skipping {input_pdf_path}, already split")
+                continue
             print(f"Processing {input_pdf_path}")
-            split_pdf_by_classification(input_pdf_path, output_folder)
+            try:
+                with get_metrics().document_stage(document, "classify"):
+                    classified = split_pdf_by_classification(
+                        input_pdf_path,
+                        output_folder,
+                        max_workers=max_workers,
+                        rate_limiter=rate_limiter,
+                        local_threshold=local_threshold,
+                        compare_with_llm=compare_with_llm,
+                        routing_stats=routing_stats,
+                        batch_size=batch_size,
+                        batch_token_budget=batch_token_budget,
+                        normalize_text=normalize_text,
+                        segment_pages=segment_pages,
+                    )
+            except LLMRequestError as e:
+                # Left unmarked in the manifest, so the next run retries it
+                print(f"Failed to classify {input_pdf_path}: {e}")
+                continue
+            if manifest is not None and classified is not None:
+                manifest.mark_done(document, "split", classified["outputs"])
+
+    print_routing_stats(routing_stats)
+    return routing_stats
 
 
 # # Example usage
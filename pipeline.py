@@ -0,0 +1,271 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from document_translator import patient_id_from_filename, process_classified_document
+from metrics import get_metrics
+from ocr import ocr_output_filename, ocr_single_file, plan_core_budget
+from pdf_splitting import print_routing_stats, split_pdf_by_classification
+
+# Marks the end of the input on a stage queue
+_STOP = object()
+
+
+class StreamingPipeline:
+    # Moves every document through OCR -> classify -> extract/write on its own.
+    # Stages are joined by bounded queues and have their own worker pools, so
+    # CPU-bound OCR of one document overlaps the API calls of the others and
+    # each per-patient CSV is written as soon as its document is done.
+    def __init__(
+        self,
+        ocr_output_dir,
+        split_pdf_dir,
+        extracted_csv_dir,
+        ocr_workers=1,
+        total_cores=None,
+        ocr_mode="auto",
+        classify_workers=2,
+        extract_workers=4,
+        queue_size=8,
+        classify_options=None,
+        write_split_pdfs=False,
+        on_document_done=None,
+        manifest=None,
+        extractor_options=None,
+        output_options=None,
+        ocr_cache_path=None,
+        keep_results=True,
+    ):
+        self.ocr_output_dir = ocr_output_dir
+        self.split_pdf_dir = split_pdf_dir
+        self.extracted_csv_dir = extracted_csv_dir
+        self.ocr_mode = ocr_mode
+        self.ocr_cache_path = ocr_cache_path
+        self.classify_options = classify_options or {}
+        self.write_split_pdfs = write_split_pdfs
+        self.on_document_done = on_document_done
+        self.manifest = manifest
+        self.extractor_options = extractor_options or {}
+        self.output_options = output_options or {}
+        # A long-running service counts finished documents itself instead
+        self.keep_results = keep_results
+
+        # OCR is never given more workers than there are cores in the budget
+        self.ocr_workers, self.ocr_jobs = plan_core_budget(
+            ocr_workers, ocr_workers, total_cores
+        )
+        self.stage_workers = {
+            "ocr": self.ocr_workers,
+            "classify": classify_workers,
+            "extract": extract_workers,
+        }
+        self.queues = {
+            stage: queue.Queue(maxsize=queue_size) for stage in self.stage_workers
+        }
+
+        self.routing_stats = Counter()
+        self.results = []
+        self._lock = threading.Lock()
+        self._stopped_workers = Counter()
+        self._threads = []
+        self._ocr_pool = None
+
+    def start(self):
+        os.makedirs(self.ocr_output_dir, exist_ok=True)
+        os.makedirs(self.extracted_csv_dir, exist_ok=True)
+        self._ocr_pool = ProcessPoolExecutor(max_workers=self.ocr_workers)
+        stage_functions = {
+            "ocr": self._run_ocr,
+            "classify": self._run_classify,
+            "extract": self._run_extract,
+        }
+        for stage, workers in self.stage_workers.items():
+            for _ in range(workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, stage_functions[stage]),
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def submit(self, input_pdf_path):
+        # Blocks while the OCR queue is full, which keeps memory bounded
+        document = {
+            "input": input_pdf_path,
+            "filename": os.path.basename(input_pdf_path),
+            "status": "ok",
+            "stage": None,
+            "error": None,
+            "submitted": time.perf_counter(),
+            "stage_times": {},
+        }
+        self.queues["ocr"].put(document)
+
+    def pending(self):
+        return {stage: q.qsize() for stage, q in self.queues.items()}
+
+    def close(self):
+        # Stop accepting documents and wait until every queued one is finished
+        for _ in range(self.stage_workers["ocr"]):
+            self.queues["ocr"].put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._ocr_pool.shutdown()
+        return self.results
+
+    def _next_stage(self, stage):
+        stages = list(self.stage_workers)
+        index = stages.index(stage)
+        return stages[index + 1] if index + 1 < len(stages) else None
+
+    def _worker(self, stage, function):
+        stage_queue = self.queues[stage]
+        next_stage = self._next_stage(stage)
+        while True:
+            document = stage_queue.get()
+            if document is _STOP:
+                self._stop_worker(stage, next_stage)
+                return
+
+            start = time.perf_counter()
+            try:
+                with get_metrics().document_stage(document["filename"], stage):
+                    function(document)
+            except Exception as e:
+                document["status"] = "failed"
+                document["stage"] = stage
+                document["error"] = str(e)
+            document["stage_times"][stage] = time.perf_counter() - start
+
+            if document["status"] != "ok" or next_stage is None:
+                self._finish(document)
+            else:
+                self.queues[next_stage].put(document)
+
+    def _stop_worker(self, stage, next_stage):
+        # The last worker of a stage to stop passes the stop on downstream
+        with self._lock:
+            self._stopped_workers[stage] += 1
+            last = self._stopped_workers[stage] == self.stage_workers[stage]
+        if last and next_stage is not None:
+            for _ in range(self.stage_workers[next_stage]):
+                self.queues[next_stage].put(_STOP)
+
+    def _finish(self, document):
+        document["elapsed"] = time.perf_counter() - document.pop("submitted")
+        if self.keep_results:
+            with self._lock:
+                self.results.append(document)
+        if document["status"] == "ok":
+            print(
+                f"Finished {document['filename']} in {document['elapsed']:.1f}s "
+                f"-> {document.get('csv_path')}"
+            )
+        else:
+            print(
+                f"Failed {document['filename']} at {document['stage']} stage: "
+                f"{document['error']}"
+            )
+        if self.on_document_done is not None:
+            self.on_document_done(document)
+
+    def _mark_done(self, document, stage, outputs):
+        if self.manifest is not None:
+            self.manifest.mark_done(document["filename"], stage, outputs)
+
+    def _run_ocr(self, document):
+        document["ocr_path"] = os.path.join(
+            self.ocr_output_dir, ocr_output_filename(document["filename"])
+        )
+        if self.manifest is not None and self.manifest.is_done(
+            document["filename"], "ocr"
+        ):
+            document["ocr"] = {"status": "skipped"}
+            return
+        result = self._ocr_pool.submit(
+            ocr_single_file,
+            document["input"],
+            document["ocr_path"],
+            self.ocr_jobs,
+            self.ocr_mode,
+            self.ocr_cache_path,
+        ).result()
+        document["ocr"] = result
+        if result["status"] != "ok":
+            raise RuntimeError(result["error"])
+        self._mark_done(document, "ocr", [document["ocr_path"]])
+
+    def _run_classify(self, document):
+        routing_stats = Counter()
+        classified = split_pdf_by_classification(
+            document["ocr_path"],
+            self.split_pdf_dir,
+            routing_stats=routing_stats,
+            write_pdfs=self.write_split_pdfs,
+            **self.classify_options,
+        )
+        if classified is None:
+            raise RuntimeError(f"could not open {document['ocr_path']}")
+        document["classified"] = classified
+        self._mark_done(document, "split", classified["outputs"])
+        with self._lock:
+            self.routing_stats.update(routing_stats)
+
+    def _run_extract(self, document):
+        classified = document.pop("classified")
+        document["csv_path"] = process_classified_document(
+            # From the OCR file name, as in the other modes; the input name
+            # still carries its ".pdf" when it has no "_"
+            patient_id_from_filename(document["ocr_path"]),
+            classified["texts"],
+            self.extracted_csv_dir,
+            self.extractor_options,
+            self.output_options,
+            classified["source_pdf"],
+            classified["pages"],
+        )
+        csv_path = document["csv_path"]
+        self._mark_done(document, "extract", [csv_path] if csv_path else [])
+
+    def print_summary(self):
+        succeeded = [r for r in self.results if r["status"] == "ok"]
+        failed = [r for r in self.results if r["status"] != "ok"]
+        print(
+            f"Streaming pipeline: {len(succeeded)} documents done, "
+            f"{len(failed)} failed"
+        )
+        for stage in self.stage_workers:
+            times = [
+                r["stage_times"][stage]
+                for r in self.results
+                if stage in r["stage_times"]
+            ]
+            if times:
+                print(
+                    f"  {stage}: {sum(times):.1f}s total, "
+                    f"{max(times):.1f}s slowest document"
+                )
+        print_routing_stats(self.routing_stats)
+
+
+def run_streaming_pipeline(input_dir, pipeline):
+    filenames = sorted(
+        filename for filename in os.listdir(input_dir) if filename.endswith(".pdf")
+    )
+    if pipeline.manifest is not None:
+        pending = pipeline.manifest.pending(filenames, "extract")
+        if len(pending) < len(filenames):
+            print(f"Skipping {len(filenames) - len(pending)} documents already done")
+        filenames = pending
+
+    pipeline.start()
+    for filename in filenames:
+        pipeline.submit(os.path.join(input_dir, filename))
+    results = pipeline.close()
+    pipeline.print_summary()
+    return results
@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+def estimate_tokens(text):
+    # Rough rule of thumb for OpenAI tokenizers: about four characters per token
+    return max(1, len(text) // 4)
+
+
+class TokenBucketRateLimiter:
+    # Two token buckets (requests and tokens) refilled continuously at the
+    # per-minute rates. Either limit can be left as None to disable it.
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute or 0)
+        self._token_allowance = float(tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._request_allowance = min(
+                float(self.requests_per_minute),
+                self._request_allowance + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._token_allowance = min(
+                float(self.tokens_per_minute),
+                self._token_allowance + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def acquire(self, tokens=1):
+        # Block until one request and `tokens` tokens are available
+        if self.tokens_per_minute:
+            # A request bigger than the whole bucket goes through once it is full
+            tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute and self._request_allowance < 1:
+                    wait = max(
+                        wait,
+                        (1 - self._request_allowance) * 60 / self.requests_per_minute,
+                    )
+                if self.tokens_per_minute and self._token_allowance < tokens:
+                    wait = max(
+                        wait,
+                        (tokens - self._token_allowance) * 60 / self.tokens_per_minute,
+                    )
+                if wait == 0:
+                    if self.requests_per_minute:
+                        self._request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self._token_allowance -= tokens
+                    return
+            time.sleep(wait)
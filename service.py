@@ -0,0 +1,234 @@
+import json
+import os
+import signal
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import get_metrics
+from pdf_splitting import print_routing_stats
+
+# Watch-folder service: one long-running process keeps the streaming
+# pipeline's stage workers, the API client and the caches warm, and feeds
+# every new PDF to them as soon as it has been completely written.
+
+DEFAULT_POLL_INTERVAL = 1.0
+# A file whose size and mtime have not changed for this long is taken to be
+# completely written
+DEFAULT_SETTLE_SECONDS = 2.0
+DEFAULT_HEALTH_PORT = 8765
+DEFAULT_COMBINE_INTERVAL = 60.0
+# Finished documents counted in the throughput and latency figures
+THROUGHPUT_WINDOW = 300.0
+
+
+class FolderWatcher:
+    # Polls a folder for new or changed PDFs. Only files whose stat changed
+    # since the last poll are looked at, and each version of a file is handed
+    # out once. Hidden files (e.g. ".upload.pdf" from rsync) are ignored.
+    def __init__(self, input_dir, settle_seconds=DEFAULT_SETTLE_SECONDS):
+        self.input_dir = input_dir
+        self.settle_seconds = settle_seconds
+        # filename -> ((size, mtime), first seen with that stat)
+        self._candidates = {}
+        # filename -> (size, mtime) of the version handed out
+        self._handed_out = {}
+
+    def poll(self):
+        # Returns the filenames that became ready since the last poll
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        with os.scandir(self.input_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.endswith(".pdf") or name.startswith("."):
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime)
+                seen.add(name)
+                if self._handed_out.get(name) == signature:
+                    continue
+                candidate = self._candidates.get(name)
+                if candidate is None or candidate[0] != signature:
+                    self._candidates[name] = (signature, now)
+                    continue
+                if stat.st_size and now - candidate[1] >= self.settle_seconds:
+                    ready.append(name)
+                    self._handed_out[name] = signature
+                    del self._candidates[name]
+
+        # A file that is removed and put back is processed again
+        for tracked in (self._candidates, self._handed_out):
+            for name in list(tracked):
+                if name not in seen:
+                    del tracked[name]
+        return sorted(ready)
+
+
+class WatchFolderService:
+    # Runs until SIGINT/SIGTERM. Documents already done according to the
+    # manifest are skipped, so restarting the service does not redo them.
+    # combine, if given, is called every combine_interval seconds while new
+    # documents have finished; main.py combines once more after shutdown.
+    def __init__(
+        self,
+        input_dir,
+        pipeline,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        settle_seconds=DEFAULT_SETTLE_SECONDS,
+        health_port=DEFAULT_HEALTH_PORT,
+        combine=None,
+        combine_interval=DEFAULT_COMBINE_INTERVAL,
+    ):
+        self.input_dir = input_dir
+        self.pipeline = pipeline
+        self.manifest = pipeline.manifest
+        self.poll_interval = poll_interval
+        self.health_port = health_port
+        self.combine = combine
+        self.combine_interval = combine_interval
+        self.watcher = FolderWatcher(input_dir, settle_seconds)
+        pipeline.on_document_done = self._document_done
+
+        self.started = time.monotonic()
+        self.counts = Counter()
+        # (finish time, seconds from submission to finish) of recent documents
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._finished_since_combine = False
+        self._last_combine = time.monotonic()
+        self._http_server = None
+
+    def _document_done(self, document):
+        with self._lock:
+            self.counts["done" if document["status"] == "ok" else "failed"] += 1
+            self._recent.append((time.monotonic(), document["elapsed"]))
+            self._finished_since_combine = True
+
+    def stop(self, *args):
+        self._stop.set()
+
+    def health(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0][0] > THROUGHPUT_WINDOW:
+                self._recent.popleft()
+            recent = list(self._recent)
+            counts = dict(self.counts)
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        window = min(THROUGHPUT_WINDOW, now - self.started) or 1.0
+        return {
+            "status": "stopping" if self._stop.is_set() else "ok",
+            "uptime_seconds": round(now - self.started, 1),
+            "queue_depth": self.pipeline.pending(),
+            "in_flight": counts.get("submitted", 0) - finished,
+            "documents": {
+                "submitted": counts.get("submitted", 0),
+                "done": counts.get("done", 0),
+                "failed": counts.get("failed", 0),
+                "skipped": counts.get("skipped", 0),
+            },
+            "throughput_per_minute": round(len(recent) / window * 60, 2),
+            "average_latency_seconds": (
+                round(sum(elapsed for _, elapsed in recent) / len(recent), 2)
+                if recent
+                else None
+            ),
+        }
+
+    def _start_health_server(self):
+        service = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/health":
+                    body = json.dumps(service.health(), indent=2).encode("utf-8")
+                    content_type = "application/json"
+                elif self.path == "/metrics":
+                    metrics = get_metrics()
+                    lines = metrics.prometheus_lines(metrics.report())
+                    body = ("\n".join(lines) + "\n").encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Health checks every few seconds would flood the output
+                pass
+
+        # Local only; put a proxy in front to expose it
+        self._http_server = ThreadingHTTPServer(
+            ("127.0.0.1", self.health_port), HealthHandler
+        )
+        threading.Thread(target=self._http_server.serve_forever, daemon=True).start()
+        print(f"Health endpoint at http://127.0.0.1:{self.health_port}/health")
+
+    def _submit_ready(self):
+        for filename in self.watcher.poll():
+            if self.manifest is not None:
+                # The file may have been replaced under the same name
+                self.manifest.forget_hash(filename)
+                if self.manifest.is_done(filename, "extract"):
+                    print(f"Skipping {filename}, already done")
+                    with self._lock:
+                        self.counts["skipped"] += 1
+                    continue
+            print(f"Queued {filename}")
+            with self._lock:
+                self.counts["submitted"] += 1
+            self.pipeline.submit(os.path.join(self.input_dir, filename))
+
+    def _combine_if_due(self):
+        if self.combine is None:
+            return
+        with self._lock:
+            due = (
+                self._finished_since_combine
+                and time.monotonic() - self._last_combine >= self.combine_interval
+            )
+            if due:
+                self._finished_since_combine = False
+        if due:
+            self.combine()
+            self._last_combine = time.monotonic()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.pipeline.start()
+        if self.health_port:
+            self._start_health_server()
+        print(f"Watching {self.input_dir} for new PDFs (Ctrl+C to stop)")
+        try:
+            while not self._stop.is_set():
+                self._submit_ready()
+                self._combine_if_due()
+                self._stop.wait(self.poll_interval)
+        finally:
+            print("Stopping; finishing the documents already queued")
+            self.pipeline.close()
+            if self._http_server is not None:
+                self._http_server.shutdown()
+                self._http_server.server_close()
+        self.print_summary()
+
+    def print_summary(self):
+        health = self.health()
+        documents = health["documents"]
+        print(
+            f"Watch service: {documents['done']} documents done, "
+            f"{documents['failed']} failed, {documents['skipped']} skipped "
+            f"in {health['uptime_seconds']:.0f}s"
+        )
+        print_routing_stats(self.pipeline.routing_stats)
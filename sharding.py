@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from combine_extracted_csv import is_combined_output
+
+# Sharded execution: several nodes mounting the same input and output tree
+# (e.g. over NFS) each run the streaming pipeline on part of the documents.
+# Documents are split up statically with --shard i/N, or claimed one at a
+# time through lease files, or both. Leases are plain files created with
+# O_EXCL, which is atomic on NFSv3 and later, and kept alive by touching them.
+
+DEFAULT_LEASE_TIMEOUT = 120.0
+LEASE_SUFFIX = ".lease"
+NODE_LEASE_PREFIX = "node-"
+DOCUMENT_LEASE_PREFIX = "doc-"
+COMBINE_LEASE = "combine"
+COMBINED_MARKER = "combined.json"
+
+
+def parse_shard(value):
+    # "i/N" from the command line, 0 <= i < N
+    index, count = (int(part) for part in value.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"shard must be i/N with 0 <= i < N, got {value}")
+    return index, count
+
+
+def in_shard(filename, shard):
+    # Stable across nodes and runs, unlike hash()
+    index, count = shard
+    digest = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+    return int(digest, 16) % count == index
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseManager:
+    # Lease files under lease_dir. Held leases are touched every
+    # lease_timeout / 4 seconds; a lease not touched for lease_timeout belongs
+    # to a dead node and may be taken over. Ages are measured against the file
+    # server's clock, so clock skew between nodes does not matter.
+    def __init__(self, lease_dir, node_id=None, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        self.lease_dir = lease_dir
+        self.node_id = node_id or default_node_id()
+        self.lease_timeout = lease_timeout
+        os.makedirs(lease_dir, exist_ok=True)
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._clock_offset = self._server_clock_offset()
+        self._heartbeat = threading.Thread(target=self._touch_held, daemon=True)
+        self._heartbeat.start()
+
+    def _path(self, name):
+        return os.path.join(self.lease_dir, name + LEASE_SUFFIX)
+
+    def _server_clock_offset(self):
+        # mtimes on a network filesystem are set by the server
+        probe = os.path.join(self.lease_dir, f".clock-{uuid.uuid4().hex}")
+        with open(probe, "w"):
+            pass
+        try:
+            return os.stat(probe).st_mtime - time.time()
+        finally:
+            os.remove(probe)
+
+    def _age(self, path):
+        return time.time() + self._clock_offset - os.stat(path).st_mtime
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def acquire(self, name):
+        path = self._path(name)
+        token = f"{self.node_id} {uuid.uuid4().hex}"
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt or not self._reclaim(path):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(token)
+            with self._lock:
+                self._held[name] = token
+            return True
+        return False
+
+    def _reclaim(self, path):
+        # Moves a stale lease aside. Another node may have reclaimed it and
+        # taken a fresh lease between our check and the rename; that lease is
+        # recognised by its token and linked back. Returns True if the lease
+        # is gone.
+        try:
+            if self._age(path) < self.lease_timeout:
+                return False
+        except FileNotFoundError:
+            return True
+        stale = self._read(path)
+        tombstone = f"{path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return True
+        taken_over = self._read(tombstone) != stale
+        if taken_over:
+            try:
+                os.link(tombstone, path)
+            except FileExistsError:
+                pass
+        os.remove(tombstone)
+        if taken_over:
+            return False
+        print(f"Reclaimed stale lease {os.path.basename(path)} from {stale}")
+        return True
+
+    def release(self, name):
+        with self._lock:
+            token = self._held.pop(name, None)
+        path = self._path(name)
+        if token is not None and self._read(path) == token:
+            os.remove(path)
+
+    def live(self, prefix, include_expired=False):
+        # Names of unexpired leases starting with prefix, held by any node
+        names = []
+        for filename in os.listdir(self.lease_dir):
+            if not filename.startswith(prefix) or not filename.endswith(LEASE_SUFFIX):
+                continue
+            try:
+                if (
+                    include_expired
+                    or self._age(os.path.join(self.lease_dir, filename))
+                    < self.lease_timeout
+                ):
+                    names.append(filename[: -len(LEASE_SUFFIX)])
+            except FileNotFoundError:
+                continue
+        return names
+
+    def _touch_held(self):
+        while not self._stop.wait(self.lease_timeout / 4):
+            with self._lock:
+                held = list(self._held)
+            for name in held:
+                try:
+                    os.utime(self._path(name))
+                except FileNotFoundError:
+                    print(f"Lost lease {name}; another node took it over")
+                    with self._lock:
+                        self._held.pop(name, None)
+
+    def close(self):
+        self._stop.set()
+        self._heartbeat.join()
+        with self._lock:
+            held = list(self._held)
+        for name in held:
+            self.release(name)
+
+
+def document_lease(filename):
+    return DOCUMENT_LEASE_PREFIX + filename
+
+
+def node_lease(node_id):
+    return NODE_LEASE_PREFIX + node_id
+
+
+def run_sharded_pipeline(
+    input_dir, pipeline, leases, shard=None, claim_documents=False
+):
+    # Feeds this node's documents to the streaming pipeline. With
+    # claim_documents every document is leased before it is submitted, so
+    # nodes share the work dynamically; the folder is scanned again until no
+    # other node holds a document lease, so the documents of a node that died
+    # are picked up once its leases expire. Each node tries a document at
+    # most once per run.
+    manifest = pipeline.manifest
+    leases.acquire(node_lease(leases.node_id))
+    if claim_documents:
+
+        def release_document(document):
+            leases.release(document_lease(document["filename"]))
+
+        pipeline.on_document_done = release_document
+
+    pipeline.start()
+    attempted = set()
+    skipped = 0
+    while True:
+        filenames = sorted(
+            filename
+            for filename in os.listdir(input_dir)
+            if filename.endswith(".pdf")
+            and filename not in attempted
+            and (shard is None or in_shard(filename, shard))
+        )
+        for filename in filenames:
+            if claim_documents and not leases.acquire(document_lease(filename)):
+                continue
+            attempted.add(filename)
+            if manifest is not None and manifest.is_done(filename, "extract"):
+                skipped += 1
+                if claim_documents:
+                    leases.release(document_lease(filename))
+                continue
+            pipeline.submit(os.path.join(input_dir, filename))
+
+        if not claim_documents:
+            break
+        # Documents still leased by other nodes may yet be released, or be
+        # taken over on the next scan once their lease has expired
+        others = [
+            name
+            for name in leases.live(DOCUMENT_LEASE_PREFIX, include_expired=True)
+            if name[len(DOCUMENT_LEASE_PREFIX) :] not in attempted
+        ]
+        if not others:
+            break
+        time.sleep(leases.lease_timeout / 4)
+
+    if skipped:
+        print(f"Skipping {skipped} documents already done")
+    results = pipeline.close()
+    pipeline.print_summary()
+    leases.release(node_lease(leases.node_id))
+    return results
+
+
+def output_signature(extracted_csv_dir):
+    # Hash of the names, sizes and mtimes of every per-patient output, to
+    # tell whether anything changed since the last combine
+    entries = []
+    for root, dirs, files in os.walk(extracted_csv_dir):
+        dirs[:] = sorted(name for name in dirs if not is_combined_output(name))
+        for name in files:
+            if is_combined_output(name):
+                continue
+            stat = os.stat(os.path.join(root, name))
+            relative = os.path.relpath(os.path.join(root, name), extracted_csv_dir)
+            entries.append([relative, stat.st_size, stat.st_mtime])
+    return hashlib.sha256(json.dumps(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+def combine_once(leases, extracted_csv_dir, combine):
+    # Only the last node to finish combines, and only if the per-patient
+    # outputs changed since the last combine. Returns True if it combined.
+    others = leases.live(NODE_LEASE_PREFIX)
+    if others:
+        print(
+            f"{len(others)} other nodes still running; the last one to finish "
+            f"combines the outputs"
+        )
+        return False
+    if not leases.acquire(COMBINE_LEASE):
+        print("Another node is combining the outputs")
+        return False
+    try:
+        marker_path = os.path.join(leases.lease_dir, COMBINED_MARKER)
+        signature = output_signature(extracted_csv_dir)
+        try:
+            with open(marker_path) as f:
+                combined = json.load(f).get("signature")
+        except (OSError, ValueError):
+            combined = None
+        if combined == signature:
+            print("Outputs already combined by another node")
+            return False
+        combine()
+        temp_path = f"{marker_path}.{leases.node_id}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"signature": signature, "node": leases.node_id}, f)
+        os.replace(temp_path, marker_path)
+        return True
+    finally:
+        leases.release(COMBINE_LEASE)
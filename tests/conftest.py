@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules live at the repository root, the synthetic PDF generator in
+# benchmarks/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
@@ -0,0 +1,71 @@
+import fitz  # PyMuPDF
+
+from bill_format import learn_template, parse_table_page
+
+HEADER = [
+    (50, "Date"),
+    (130, "Description"),
+    (320, "Qty"),
+    (380, "Unit Price"),
+    (470, "Amount"),
+]
+ROWS = [
+    ["01/02/2024", "Paracetamol 500mg", "2", "1.50", "3.00"],
+    ["02/02/2024", "Amoxicillin 250mg", "14", "0.80", "11.20"],
+]
+
+
+def write_bill(path, rows=ROWS):
+    with fitz.open() as pdf_document:
+        page = pdf_document.new_page(width=595, height=842)
+        page.insert_text((50, 60), "City General Hospital Statement of Charges")
+        for x, label in HEADER:
+            page.insert_text((x, 200), label)
+        for number, row in enumerate(rows):
+            for (x, _), text in zip(HEADER, row):
+                page.insert_text((x, 230 + 20 * number), text)
+        pdf_document.save(path)
+
+
+def test_unmapped_columns_do_not_run_into_the_quantity(tmp_path):
+    path = str(tmp_path / "bill.pdf")
+    write_bill(path)
+    columns = {"Date": "Date", "Drug/Services": "Description", "Quantity": "Qty"}
+    template, items = learn_template(path, "city", columns, date_format="%d/%m/%Y")
+
+    assert template["ignore_labels"] == ["Unit Price Amount"]
+    assert [(item["Drug/Services"], item["Quantity"]) for item in items] == [
+        ("Paracetamol 500mg", 2.0),
+        ("Amoxicillin 250mg", 14.0),
+    ]
+
+
+def test_column_range_overrides_the_labels(tmp_path):
+    path = str(tmp_path / "bill.pdf")
+    write_bill(path)
+    template = {
+        "name": "city",
+        "columns": {"Date": "Date", "Drug/Services": "Description", "Quantity": "Qty"},
+        "date_format": "%d/%m/%Y",
+        "column_ranges": {"Quantity": [310, 350]},
+    }
+    with fitz.open(path) as pdf_document:
+        items = parse_table_page(pdf_document.load_page(0), template)
+    assert [item["Quantity"] for item in items] == [2.0, 14.0]
+    assert items[0]["Drug/Services"] == "Paracetamol 500mg"
+
+
+def test_total_and_ward_rows_are_not_line_items(tmp_path):
+    path = str(tmp_path / "bill.pdf")
+    rows = ROWS + [
+        ["03/02/2024", "Ward charges (2 days)", "2", "150.00", "300.00"],
+        ["", "Total", "", "", "314.20"],
+    ]
+    write_bill(path, rows)
+    columns = {"Date": "Date", "Drug/Services": "Description", "Quantity": "Qty"}
+    _, items = learn_template(path, "city", columns, date_format="%d/%m/%Y")
+
+    assert [item["Drug/Services"] for item in items] == [
+        "Paracetamol 500mg",
+        "Amoxicillin 250mg",
+    ]
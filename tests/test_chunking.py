@@ -0,0 +1,45 @@
+import pandas as pd
+
+from document_translator import chunk_pages, drop_overlap_duplicates
+
+KEYS = ["Drug/Services", "Quantity", "Date"]
+
+
+def items(*rows):
+    return pd.DataFrame(rows, columns=KEYS)
+
+
+def test_each_chunk_records_the_pages_it_repeats():
+    pages = ["page one " * 10, "page two " * 10, "page three " * 10]
+    # About 22 tokens a page, so two pages fit in a chunk
+    chunks = chunk_pages(pages, max_tokens=50, overlap_pages=1)
+    assert [overlap for _, overlap in chunks] == ["", pages[1]]
+    assert chunks[1][0] == "\n".join(pages[1:])
+
+
+def test_only_rows_from_the_shared_pages_are_dropped():
+    # Paracetamol is given on page 1 and again on page 3; page 2 is shared
+    frames = [
+        items(("Paracetamol", 2, "01.01.2024"), ("Ibuprofen", 1, "01.01.2024")),
+        items(("Ibuprofen", 1, "01.01.2024"), ("Paracetamol", 2, "01.01.2024")),
+    ]
+    overlaps = ["", "Ibuprofen 400mg 1 01.01.2024"]
+    merged = drop_overlap_duplicates(frames, overlaps, KEYS)
+    assert list(merged["Drug/Services"]) == ["Paracetamol", "Ibuprofen", "Paracetamol"]
+
+
+def test_quantities_match_whether_read_as_int_float_or_text():
+    # The chunks' answers were parsed into different column types
+    frames = [
+        items(("Paracetamol", 2, "01.01.2024")),
+        items(("Paracetamol", 2.0, "01.01.2024"), ("Ibuprofen", "1", "02.01.2024")),
+    ]
+    overlaps = ["", "Paracetamol 500mg 2 01.01.2024"]
+    merged = drop_overlap_duplicates(frames, overlaps, KEYS)
+    assert list(merged["Drug/Services"]) == ["Paracetamol", "Ibuprofen"]
+
+
+def test_chunks_are_concatenated_without_key_columns():
+    frames = [items(("Paracetamol", 2, "")), items(("Paracetamol", 2, ""))]
+    merged = drop_overlap_duplicates(frames, ["", "Paracetamol 2"], [])
+    assert len(merged) == 2
@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+
+from combine_extracted_csv import consolidate_csv_files, export_consolidated_csv
+
+
+def write_patient(folder, patient_id, drugs):
+    path = folder / f"{patient_id}_transformed_data.csv"
+    pd.DataFrame(
+        {"patient_id": patient_id, "Drug/Services": drugs, "Quantity": "1"}
+    ).to_csv(path, index=False)
+    return path
+
+
+def exported_drugs(store_path, tmp_path):
+    output_path = str(tmp_path / "combined.csv")
+    export_consolidated_csv(store_path, output_path)
+    combined = pd.read_csv(output_path, dtype=str)
+    return list(zip(combined["patient_id"], combined["Drug/Services"]))
+
+
+def test_changed_file_replaces_its_rows_and_others_are_not_reread(tmp_path):
+    folder = tmp_path / "extracted_csv"
+    folder.mkdir()
+    store_path = str(tmp_path / "consolidated.sqlite")
+    write_patient(folder, "101", ["Paracetamol", "Ibuprofen"])
+    write_patient(folder, "102", ["Amoxicillin"])
+    counts = consolidate_csv_files(str(folder), store_path, chunk_rows=1)
+    assert (counts["added"], counts["updated"]) == (2, 0)
+
+    path = write_patient(folder, "101", ["Metformin", "Insulin", "Aspirin"])
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    counts = consolidate_csv_files(str(folder), store_path, chunk_rows=1)
+    assert (counts["added"], counts["updated"], counts["unchanged"]) == (0, 1, 1)
+
+    assert exported_drugs(store_path, tmp_path) == [
+        ("101", "Metformin"),
+        ("101", "Insulin"),
+        ("101", "Aspirin"),
+        ("102", "Amoxicillin"),
+    ]
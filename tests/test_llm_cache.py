@@ -0,0 +1,49 @@
+import itertools
+
+import pytest
+
+import llm_cache
+from llm_cache import LLMCache
+
+# Serialized as a 100-byte JSON string
+VALUE = "x" * 98
+
+
+@pytest.fixture
+def ticking_clock(monkeypatch):
+    # Every access gets a later timestamp, so the LRU order is exact
+    ticks = itertools.count()
+    monkeypatch.setattr(llm_cache.time, "time", lambda: float(next(ticks)))
+
+
+def test_eviction_drops_least_recently_used_down_to_90_percent(tmp_path, ticking_clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), max_size_mb=1000 / 1024**2)
+    for number in range(10):
+        cache.put(f"key{number}", VALUE)
+    assert cache.stats()["evictions"] == 0
+
+    # Reading key0 makes key1 and key2 the least recently used
+    assert cache.get("key0") == VALUE
+    cache.put("key10", VALUE)
+
+    stats = cache.stats()
+    assert (stats["evictions"], stats["entries"], stats["size_bytes"]) == (2, 9, 900)
+    assert cache.get("key1") is None and cache.get("key2") is None
+    assert cache.get("key0") == VALUE and cache.get("key10") == VALUE
+    cache.close()
+
+
+def test_refresh_ignores_stored_answers_but_replaces_them(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMCache(path)
+    cache.put("key", "old answer")
+    cache.close()
+
+    cache = LLMCache(path, refresh=True)
+    assert cache.get("key") is None
+    cache.put("key", "new answer")
+    cache.close()
+
+    cache = LLMCache(path)
+    assert cache.get("key") == "new answer"
+    cache.close()
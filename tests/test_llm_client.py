@@ -0,0 +1,75 @@
+import threading
+from email.utils import formatdate
+
+import httpx
+import openai
+import pytest
+
+import llm_client
+from llm_client import CircuitBreaker, CircuitOpenError, retry_after_seconds
+
+
+def check_in_other_thread(breaker):
+    # The error another worker's check() raises, or None if it may go ahead
+    errors = []
+
+    def check():
+        try:
+            breaker.check()
+            errors.append(None)
+        except CircuitOpenError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=check)
+    thread.start()
+    thread.join()
+    return errors[0]
+
+
+def test_half_open_circuit_lets_a_single_trial_through(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(llm_client.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=30)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    # After the cooldown this thread makes the trial and the others fail fast
+    now[0] = 31
+    breaker.check()
+    assert "trial" in str(check_in_other_thread(breaker))
+    breaker.check()
+
+    # A failed trial opens the circuit for another cooldown
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert check_in_other_thread(breaker) is not None
+
+    # A successful trial closes it for everyone
+    now[0] = 62
+    breaker.check()
+    breaker.record_success()
+    assert check_in_other_thread(breaker) is None
+
+
+def rate_limit_error(headers):
+    request = httpx.Request("POST", "http://127.0.0.1/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_retry_after_header_formats(monkeypatch):
+    monkeypatch.setattr(llm_client.time, "time", lambda: 1_700_000_000.0)
+    assert retry_after_seconds(rate_limit_error({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(rate_limit_error({"Retry-After": "3"})) == 3.0
+    http_date = formatdate(1_700_000_010, usegmt=True)
+    assert retry_after_seconds(rate_limit_error({"retry-after": http_date})) == 10.0
+    # A date in the past means no wait rather than a negative one
+    http_date = formatdate(1_699_999_990, usegmt=True)
+    assert retry_after_seconds(rate_limit_error({"retry-after": http_date})) == 0.0
+    assert retry_after_seconds(rate_limit_error({"retry-after": "soon"})) is None
+    assert retry_after_seconds(rate_limit_error({})) is None
+    assert retry_after_seconds(ValueError("no response")) is None
@@ -0,0 +1,35 @@
+from pdf_splitting import route_page_locally
+
+REPORT_PAGE = (
+    "The patient was diagnosed with asthma. Medical history: none. "
+    "Treatment plan: inhaler. Clinical notes attached."
+)
+WEAK_REPORT_PAGE = "Diagnosis: influenza"
+
+
+def test_pages_go_to_the_llm_unless_a_threshold_is_set():
+    assert route_page_locally(REPORT_PAGE) == {
+        "label": None,
+        "route": "llm",
+        "confidence": None,
+    }
+    # Empty pages never need a classifier
+    assert route_page_locally("  \n")["route"] == "empty"
+
+
+def test_only_pages_at_or_above_the_threshold_are_labelled_locally():
+    assert route_page_locally(REPORT_PAGE, local_threshold=0.9) == {
+        "label": "Medical Report",
+        "route": "local",
+        "confidence": 1.0,
+    }
+    # "Tax Invoice" is decisive by the prompt's own rule
+    routed = route_page_locally("TAX INVOICE No. 5", local_threshold=0.95)
+    assert (routed["label"], routed["route"]) == ("Invoice", "local")
+
+    # A single keyword is too little evidence; its confidence is kept for the
+    # comparison with the LLM
+    routed = route_page_locally(WEAK_REPORT_PAGE, local_threshold=0.9)
+    assert routed["route"] == "llm" and routed["label"] is None
+    assert routed["confidence"] < 0.9
+    assert route_page_locally(REPORT_PAGE, local_threshold=1.01)["route"] == "llm"
@@ -0,0 +1,55 @@
+import os
+
+from manifest import STAGES, Manifest
+
+SETTINGS = {"ocr": {"mode": "auto"}, "split": {"model": "gpt-4o-mini"}, "extract": {}}
+
+
+def finished_manifest(tmp_path, settings=SETTINGS):
+    # A manifest recording every stage of doc.pdf as done
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "doc.pdf").write_bytes(b"%PDF-1.4 first version")
+    output = tmp_path / "output.txt"
+    output.write_text("done")
+    manifest = Manifest(str(tmp_path), str(input_dir), settings)
+    for stage in STAGES:
+        manifest.mark_done("doc.pdf", stage, [str(output)])
+    return manifest
+
+
+def done_stages(manifest):
+    return [stage for stage in STAGES if manifest.is_done("doc.pdf", stage)]
+
+
+def test_settings_change_redoes_that_stage_and_later_ones(tmp_path):
+    manifest = finished_manifest(tmp_path)
+    assert done_stages(manifest) == list(STAGES)
+
+    settings = dict(SETTINGS, split={"model": "gpt-4o"})
+    manifest = Manifest(str(tmp_path), manifest.input_dir, settings)
+    assert done_stages(manifest) == ["ocr"]
+
+
+def test_changed_input_file_redoes_every_stage(tmp_path):
+    manifest = finished_manifest(tmp_path)
+    path = os.path.join(manifest.input_dir, "doc.pdf")
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4 second, longer version")
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    manifest = Manifest(str(tmp_path), manifest.input_dir, SETTINGS)
+    assert done_stages(manifest) == []
+
+
+def test_force_redoes_everything_but_still_records_progress(tmp_path):
+    manifest = finished_manifest(tmp_path)
+    forced = Manifest(str(tmp_path), manifest.input_dir, SETTINGS, force=True)
+    assert done_stages(forced) == []
+    assert forced.pending(["doc.pdf"], "extract") == ["doc.pdf"]
+
+    forced.mark_done("doc.pdf", "ocr")
+    manifest = Manifest(str(tmp_path), manifest.input_dir, SETTINGS)
+    # Redoing OCR made the recorded split and extraction stale
+    assert done_stages(manifest) == ["ocr"]
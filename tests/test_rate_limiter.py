@@ -0,0 +1,61 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import TokenBucketRateLimiter
+
+
+class FakeClock:
+    # Stands in for time.monotonic and time.sleep; sleeping advances the clock
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_requests_block_until_the_bucket_refills(clock):
+    limiter = TokenBucketRateLimiter(requests_per_minute=60)
+    for _ in range(60):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+    # The bucket is empty and refills one request a second
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+    # Idle time refills the bucket, but never beyond one minute's worth
+    clock.now += 600
+    clock.sleeps.clear()
+    for _ in range(60):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_tokens_block_until_enough_have_refilled(clock):
+    limiter = TokenBucketRateLimiter(tokens_per_minute=600)
+    limiter.acquire(tokens=500)
+    assert clock.sleeps == []
+
+    # 100 tokens are left and 10 refill a second, so 300 more take 20 seconds
+    limiter.acquire(tokens=300)
+    assert sum(clock.sleeps) == pytest.approx(20.0)
+
+    # A request larger than the bucket waits for a full bucket, not forever
+    clock.sleeps.clear()
+    limiter.acquire(tokens=10000)
+    assert sum(clock.sleeps) == pytest.approx(60.0)
@@ -0,0 +1,20 @@
+from page_store import extract_page_texts
+from pdf_splitting import find_page_segments
+from synthetic_pdfs import generate_documents
+
+
+def test_bundle_numbered_as_a_whole_is_split_into_sections(tmp_path):
+    # Every page carries "Page x of 7", numbered across the whole bundle:
+    # letter of guarantee, 3 invoice pages, 2 medical report pages, bill audit
+    paths, _ = generate_documents(
+        str(tmp_path), documents=4, invoice_pages=3, report_pages=2, image_page_share=0
+    )
+    for path in paths:
+        segments = find_page_segments(extract_page_texts(path))
+        assert segments == [[0], [1, 2, 3], [4, 5], [6]], path
+
+
+def test_continuous_numbering_keeps_a_section_together():
+    page = "Riverside Specialist Centre\n\nTAX INVOICE\nInvoice Number 12\n{}\nPage {} of 3"
+    texts = [page.format("Paracetamol 2 " * 30, number) for number in (1, 2, 3)]
+    assert find_page_segments(texts) == [[0, 1, 2]]
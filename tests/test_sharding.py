@@ -0,0 +1,73 @@
+import os
+import time
+
+from sharding import LEASE_SUFFIX, LeaseManager
+
+
+def lease_path(lease_dir, name):
+    return os.path.join(lease_dir, name + LEASE_SUFFIX)
+
+
+def age_lease(path, seconds):
+    mtime = os.stat(path).st_mtime - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_only_one_node_claims_a_lease_until_it_is_released(tmp_path):
+    lease_dir = str(tmp_path / "leases")
+    first = LeaseManager(lease_dir, "node-a", lease_timeout=60)
+    second = LeaseManager(lease_dir, "node-b", lease_timeout=60)
+    try:
+        assert first.acquire("doc-1.pdf")
+        assert not second.acquire("doc-1.pdf")
+        assert second.live("doc-") == ["doc-1.pdf"]
+
+        first.release("doc-1.pdf")
+        assert second.acquire("doc-1.pdf")
+        # Releasing a lease another node holds leaves it alone
+        first.release("doc-1.pdf")
+        assert os.path.exists(lease_path(lease_dir, "doc-1.pdf"))
+    finally:
+        first.close()
+        second.close()
+
+
+def test_heartbeat_keeps_held_leases_alive(tmp_path):
+    lease_dir = str(tmp_path / "leases")
+    holder = LeaseManager(lease_dir, "node-a", lease_timeout=2)
+    other = LeaseManager(lease_dir, "node-b", lease_timeout=2)
+    try:
+        assert holder.acquire("doc-1.pdf")
+        path = lease_path(lease_dir, "doc-1.pdf")
+        age_lease(path, 100)
+        # The heartbeat touches held leases every lease_timeout / 4 seconds
+        deadline = time.monotonic() + 5
+        while holder._age(path) > 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert holder._age(path) <= 1
+        assert not other.acquire("doc-1.pdf")
+    finally:
+        holder.close()
+        other.close()
+
+
+def test_stale_lease_of_a_dead_node_is_taken_over(tmp_path):
+    lease_dir = str(tmp_path / "leases")
+    manager = LeaseManager(lease_dir, "node-b", lease_timeout=60)
+    try:
+        path = lease_path(lease_dir, "doc-1.pdf")
+        with open(path, "w") as f:
+            f.write("node-a 0123")
+        # A fresh lease of another node is respected
+        assert not manager.acquire("doc-1.pdf")
+
+        age_lease(path, 120)
+        assert manager.live("doc-") == []
+        assert manager.live("doc-", include_expired=True) == ["doc-1.pdf"]
+        assert manager.acquire("doc-1.pdf")
+        with open(path) as f:
+            assert f.read().startswith("node-b ")
+        # The tombstone the stale lease was moved to is cleaned up
+        assert sorted(os.listdir(lease_dir)) == ["doc-1.pdf" + LEASE_SUFFIX]
+    finally:
+        manager.close()
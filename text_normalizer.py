@@ -0,0 +1,137 @@
+import re
+from collections import Counter
+
+from metrics import current_normalized_pages, get_metrics
+from rate_limiter import estimate_tokens
+
+# Only the first and last few lines of a page are checked for running
+# headers and footers
+HEADER_FOOTER_LINES = 4
+# A header/footer line is removed when it repeats on at least this share of a
+# document's pages (and on at least MIN_REPEATED_PAGES pages). The threshold is
+# high on purpose: letterhead and footers repeat on nearly every page, while a
+# section title such as "TAX INVOICE" only repeats on some of them and is
+# needed by the classifier.
+REPEATED_LINE_SHARE = 0.8
+MIN_REPEATED_PAGES = 3
+# Lines with fewer letters and digits than this share are OCR noise
+# (rules, box drawing, speckles read as punctuation)
+MIN_ALNUM_SHARE = 0.4
+
+INLINE_WHITESPACE = re.compile(r"[ \t\f\v\u00a0]+")
+DIGITS = re.compile(r"\d+")
+
+
+def collapse_whitespace(text):
+    lines = [INLINE_WHITESPACE.sub(" ", line).strip() for line in text.splitlines()]
+    return [line for line in lines if line]
+
+
+def is_noise_line(line):
+    alnum = sum(1 for char in line if char.isalnum())
+    if alnum == 0:
+        return True
+    # A lone letter is noise, a lone digit may be a quantity
+    if len(line) == 1:
+        return not line.isdigit()
+    return alnum / len(line) < MIN_ALNUM_SHARE
+
+
+def line_key(line):
+    # Page numbers and dates change from page to page, so "Page 2 of 7" and
+    # "Page 3 of 7" count as the same footer
+    return DIGITS.sub("#", line.lower())
+
+
+def edge_line_count(lines):
+    # Header/footer zone at each end of a page; on short pages it shrinks so
+    # the body of the page is never treated as a header or footer
+    return min(HEADER_FOOTER_LINES, len(lines) // 3)
+
+
+def repeated_lines(pages_lines):
+    # Keys of header/footer lines repeated across the pages of one document.
+    # Lines without letters (a lone quantity, a total) are never removed.
+    if len(pages_lines) < MIN_REPEATED_PAGES:
+        return set()
+    counts = Counter()
+    for lines in pages_lines:
+        edge = edge_line_count(lines)
+        edge_lines = lines[:edge] + lines[len(lines) - edge :]
+        counts.update({line_key(line) for line in edge_lines})
+    needed = max(MIN_REPEATED_PAGES, REPEATED_LINE_SHARE * len(pages_lines))
+    return {
+        key
+        for key, count in counts.items()
+        if count >= needed and any(char.isalpha() for char in key)
+    }
+
+
+def normalize_pages(page_texts):
+    # Returns the page texts with whitespace collapsed, noise lines dropped and
+    # repeated headers/footers kept on the first page only. Pages stay in
+    # order and empty pages stay empty.
+    pages_lines = [
+        [line for line in collapse_whitespace(text) if not is_noise_line(line)]
+        for text in page_texts
+    ]
+    repeated = repeated_lines(pages_lines)
+    seen = set()
+    normalized = []
+    for lines in pages_lines:
+        kept = []
+        edge = edge_line_count(lines)
+        for index, line in enumerate(lines):
+            key = line_key(line)
+            on_edge = index < edge or index >= len(lines) - edge
+            if key in repeated and on_edge:
+                if key in seen:
+                    continue
+                seen.add(key)
+            kept.append(line)
+        normalized.append("\n".join(kept))
+    return normalized
+
+
+def normalize_for_document(page_texts):
+    # Normalizes the pages of one document and registers their token counts
+    # before and after in the metrics context, where every API call sending
+    # them records what normalization saved
+    normalized = normalize_pages(page_texts)
+    current_normalized_pages.set(
+        {
+            text: (estimate_tokens(raw_text), estimate_tokens(text))
+            for raw_text, text in zip(page_texts, normalized)
+            if text
+        }
+    )
+    return normalized
+
+
+def print_normalization_stats():
+    totals = {}
+    for entry in get_metrics().report()["api"]:
+        if not entry["normalization_tokens_before"]:
+            continue
+        stage = totals.setdefault(entry["stage"], Counter())
+        stage["calls"] += entry["calls"]
+        stage["before"] += entry["normalization_tokens_before"]
+        stage["after"] += entry["normalization_tokens_after"]
+    for stage, total in totals.items():
+        before, after = total["before"], total["after"]
+        print(
+            f"Text normalization ({stage}): {before} -> {after} estimated tokens "
+            f"({(before - after) / before:.0%} saved) over {total['calls']} API calls"
+        )
+
+
+# Settings that change the normalized text, used to invalidate resumed runs
+def normalization_settings(normalize_text):
+    if not normalize_text:
+        return None
+    return {
+        "header_footer_lines": HEADER_FOOTER_LINES,
+        "repeated_line_share": REPEATED_LINE_SHARE,
+        "min_repeated_pages": MIN_REPEATED_PAGES,
+        "min_alnum_share": MIN_ALNUM_SHARE,
+    }